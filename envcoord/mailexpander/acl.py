@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+""" Precomputed permitted senders of a role. """
+import fnmatch
+import re
+
+__version__ = """$Id$"""
+
+GLOB_CHARS = '*?['
+
+
+def _compile_globs(patterns):
+    """ Compile fnmatch patterns into one regular expression """
+    if not patterns:
+        return None
+    regexes = []
+    for pattern in patterns:
+        regex = fnmatch.translate(pattern)
+        if regex.endswith('(?ms)'):  # python 2 puts the flags at the end
+            regex = regex[:-len('(?ms)')]
+        regexes.append('(?:%s)' % regex)
+    return re.compile('|'.join(regexes), re.S | re.M)
+
+
+class SenderACL(object):
+    """ The effective permitted senders of a role, built once from the role
+    and its parents (see `Expander.add_inherited_senders`):
+
+    * `addresses` -- lower cased literal e-mail addresses
+    * `patterns` -- fnmatch patterns, matched with a single compiled regex
+    * `dns` -- normalized DNs of users allowed with any of their addresses
+      (owners, members, permittedPerson)
+    * `first_mail_dns` -- normalized DNs of users allowed only with their
+      first address (permittedPerson of the parent roles)
+    * `other_dns` -- allowed DNs outside `users_dn`, these can't be found
+      by e-mail and are fetched when needed
+
+    ACLs only hold strings and can be pickled and cached.
+
+    """
+
+    def __init__(self, anyone=False, addresses=(), patterns=(), dns=(),
+                 first_mail_dns=(), other_dns=()):
+        self.anyone = anyone
+        self.addresses = frozenset(addresses)
+        self.patterns = tuple(patterns)
+        self.dns = frozenset(dns)
+        self.first_mail_dns = frozenset(first_mail_dns)
+        self.other_dns = tuple(other_dns)
+        self._matcher = _compile_globs(self.patterns)
+
+    @classmethod
+    def from_role(cls, role_data, agent):
+        """ Build the ACL of a role from its attributes, after the parents'
+        senders were added with `add_inherited_senders` """
+        anyone = False
+        addresses = set()
+        patterns = []
+        dns = []
+        for sender_pattern in role_data.get('permittedSender', []):
+            sender_pattern = sender_pattern.lower()
+            if sender_pattern == 'anyone':
+                anyone = True
+            elif sender_pattern == 'owners':
+                dns.extend(role_data.get('owner', []))
+            elif sender_pattern == 'members':
+                if 'uniqueMember' in role_data:
+                    dns.extend(role_data['uniqueMember'])
+                elif 'members_data' in role_data:
+                    dns.extend(role_data['members_data'].keys())
+            elif [c for c in GLOB_CHARS if c in sender_pattern]:
+                patterns.append(sender_pattern)
+            else:
+                addresses.add(sender_pattern)
+        dns.extend(role_data.get('permittedPerson', []))
+        dns.extend(role_data.get('inheritedSenders', []))
+        first_mail_dns = role_data.get('inheritedPersons', [])
+
+        other_dns = []
+        for dn in set(dns) | set(first_mail_dns):
+            if dn and not agent._is_user_dn(dn):
+                other_dns.append((dn, dn in first_mail_dns and dn not in dns))
+
+        return cls(anyone=anyone, addresses=addresses, patterns=patterns,
+                   dns=[agent._normalize_dn(dn) for dn in dns if dn],
+                   first_mail_dns=[agent._normalize_dn(dn)
+                                   for dn in first_mail_dns if dn],
+                   other_dns=other_dns)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_matcher']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._matcher = _compile_globs(self.patterns)
+
+    def matches_address(self, email):
+        """ Check `email` (lower cased) against the addresses and patterns,
+        without looking anything up """
+        if self.anyone or email in self.addresses:
+            return True
+        return self._matcher is not None and \
+            self._matcher.match(email) is not None
+
+    def allows(self, email, agent):
+        """ May `email` (lower cased) send to the role? Users allowed by DN
+        are found by looking the sender up once with `agent`. """
+        if self.matches_address(email):
+            return True
+        if not (self.dns or self.first_mail_dns):
+            return False
+
+        for dn, mails in agent.users_with_email(email).items():
+            if dn in self.dns:
+                return True
+            if dn in self.first_mail_dns and mails[0] == email:
+                return True
+
+        # Users outside `users_dn` are not found by the lookup above
+        first_mail_only = dict(self.other_dns)
+        for dn, attrs in agent._query_many(first_mail_only.keys()).items():
+            mails = [mail.lower() for mail in attrs.get('mail', [])]
+            if first_mail_only[dn]:
+                mails = mails[:1]
+            if email in mails:
+                return True
+
+        return False
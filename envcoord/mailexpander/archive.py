@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+""" The archive copies of the messages.
+
+Appending every message to the archive (`mailbox` in [expander]) while
+delivering it costs time, and the copy was dropped when another expander
+held the lock. With `archive_spool` the expander only writes the message
+and its envelope to a spool directory (in `tmp/`, then moved to `new/` so
+a record is never seen half written); `roleexpander archive flush` appends
+the spooled records to the archive in bulk, waiting for the lock.
+
+With `archive_dir` the archive is sharded instead of one mbox file: one
+mbox per role and month (`<archive_dir>/<role>/2024-05.mbox`) and an
+SQLite index of where every message is, so `roleexpander archive find`
+reads a message without scanning the shards. Shards of past months are
+compressed by `roleexpander archive rotate`.
+
+"""
+from headers import read_headers
+from message import FileMessage, message_chunks
+from store import SqliteStore
+import errno
+import fcntl
+import gzip
+import json
+import logging
+import os
+import re
+import socket
+import sqlite3
+import time
+
+__version__ = """$Id$"""
+
+log = logging.getLogger('rolesexpander')
+
+COPY_SIZE = 64 * 1024
+
+
+def from_line(from_email, date=None):
+    """ The mbox From_ line of a message """
+    return 'From %s  %s\n' % (from_email, time.asctime(time.localtime(date)))
+
+
+class MboxArchive(object):
+    """ The single mbox file archive """
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, records):
+        """ Append the (from_email, role, date, content) `records` under an
+        exclusive lock, waiting for it """
+        mbox = open(self.path, 'ab')
+        try:
+            fcntl.lockf(mbox, fcntl.LOCK_EX)
+            for from_email, role, date, content in records:
+                mbox.write(from_line(from_email, date))
+                for data in message_chunks(content):
+                    mbox.write(data)
+                mbox.write('\n')
+            mbox.flush()
+            os.fsync(mbox.fileno())
+            fcntl.lockf(mbox, fcntl.LOCK_UN)
+        finally:
+            mbox.close()
+
+    def rotate(self, now=None):
+        return 0  # Nothing to compress
+
+
+class ArchiveIndex(SqliteStore):
+    """ Where every archived message is: the shard (relative to the
+    archive directory) and the offset and length of the message in it,
+    after the From_ line. Offsets of compressed shards are those of the
+    uncompressed data. """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS messages ('
+        ' message_id TEXT, role TEXT, sender TEXT, date REAL,'
+        ' shard TEXT, offset INTEGER, length INTEGER)',
+        'CREATE INDEX IF NOT EXISTS messages_message_id ON messages '
+        '(message_id)',
+        'CREATE INDEX IF NOT EXISTS messages_role ON messages (role, date)',
+        'CREATE INDEX IF NOT EXISTS messages_shard ON messages (shard)',
+    )
+
+    columns = ('message_id', 'role', 'sender', 'date', 'shard', 'offset',
+               'length')
+
+    def find(self, message_id, role=None):
+        """ The entries of `message_id`, archived by any role or `role`
+        (a role id or address) """
+        sql = 'SELECT %s FROM messages WHERE message_id = ?' % \
+            ', '.join(self.columns)
+        params = [message_id]
+        if role:
+            sql += ' AND (role = ? OR role LIKE ?)'
+            params += [role, role + '@%']
+        return [dict(zip(self.columns, row))
+                for row in self.execute(sql + ' ORDER BY date', params)]
+
+    def stats(self):
+        """ The number of messages and shards indexed """
+        conn = self.conn
+        return {
+            'messages': conn.execute(
+                'SELECT COUNT(*) FROM messages').fetchone()[0],
+            'shards': conn.execute(
+                'SELECT COUNT(DISTINCT shard) FROM messages').fetchone()[0],
+        }
+
+
+class ShardedArchive(object):
+    """ One mbox file per role and month, indexed in `index.sqlite` """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index = ArchiveIndex(index_path or
+                                  os.path.join(path, 'index.sqlite'))
+
+    def shard_name(self, role, date=None):
+        """ The shard of the messages archived for `role` at `date` (the
+        file name, relative to the archive directory) """
+        role = re.sub(r'[^\w.@+-]', '_', role or '') or '_unknown'
+        if role.startswith('.'):
+            role = '_' + role
+        return os.path.join(role, time.strftime('%Y-%m.mbox',
+                                                time.localtime(date)))
+
+    def _open_shard(self, name):
+        """ Open and lock a shard for appending. A shard compressed by
+        `rotate` while we waited for the lock is created again. """
+        path = os.path.join(self.path, name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        while True:
+            shard = open(path, 'ab')
+            fcntl.lockf(shard, fcntl.LOCK_EX)
+            if os.fstat(shard.fileno()).st_nlink:
+                shard.seek(0, os.SEEK_END)
+                return shard
+            shard.close()
+
+    def append(self, records):
+        """ Append the (from_email, role, date, content) `records` to the
+        shards of their role and date, and index them """
+        shards = {}
+        for record in records:
+            shards.setdefault(self.shard_name(record[1], record[2]),
+                              []).append(record)
+        for name, shard_records in sorted(shards.items()):
+            shard = self._open_shard(name)
+            try:
+                rows = []
+                for from_email, role, date, content in shard_records:
+                    line = from_line(from_email, date)
+                    shard.write(line)
+                    offset = shard.tell()
+                    for data in message_chunks(content):
+                        shard.write(data)
+                    length = shard.tell() - offset
+                    shard.write('\n')
+                    message_id = read_headers(content)[0].get('message-id')
+                    rows.append(((message_id or '').strip(), role,
+                                 from_email, date, name, offset, length))
+                shard.flush()
+                os.fsync(shard.fileno())
+                # Indexed before unlocking, so `rotate` can't compress the
+                # shard in between
+                with self.index.transaction() as conn:
+                    conn.executemany('INSERT INTO messages VALUES '
+                                     '(?, ?, ?, ?, ?, ?, ?)', rows)
+                fcntl.lockf(shard, fcntl.LOCK_UN)
+            finally:
+                shard.close()
+
+    def find(self, message_id, role=None):
+        return self.index.find(message_id, role)
+
+    def read(self, entry):
+        """ The message of an index entry: a `FileMessage` in a plain
+        shard, a string from a compressed one """
+        path = os.path.join(self.path, entry['shard'])
+        if not path.endswith('.gz') and os.path.exists(path):
+            return FileMessage(path, entry['offset'], entry['length'])
+        if not path.endswith('.gz'):
+            path += '.gz'  # Compressed since it was looked up
+        shard = gzip.open(path, 'rb')
+        try:
+            shard.seek(entry['offset'])
+            return shard.read(entry['length'])
+        finally:
+            shard.close()
+
+    def shards(self):
+        """ The names of the shards, relative to the archive directory """
+        names = []
+        for role in sorted(os.listdir(self.path)):
+            directory = os.path.join(self.path, role)
+            if os.path.isdir(directory):
+                names.extend(os.path.join(role, name)
+                             for name in sorted(os.listdir(directory))
+                             if name.endswith(('.mbox', '.mbox.gz')))
+        return names
+
+    def rotate(self, now=None):
+        """ Compress the shards of past months, returns how many """
+        if not os.path.isdir(self.path):
+            return 0
+        current = time.strftime('%Y-%m.mbox', time.localtime(now))
+        rotated = 0
+        for name in self.shards():
+            if not name.endswith('.mbox') or \
+                    os.path.basename(name) >= current:
+                continue
+            if os.path.exists(os.path.join(self.path, name + '.gz')):
+                log.warning("Not compressing %s, %s.gz exists", name, name)
+                continue
+            self._compress(name)
+            rotated += 1
+        return rotated
+
+    def _compress(self, name):
+        path = os.path.join(self.path, name)
+        shard = open(path, 'ab')
+        try:
+            fcntl.lockf(shard, fcntl.LOCK_EX)
+            tmp_path = path + '.gz.tmp'
+            source = open(path, 'rb')
+            target = gzip.open(tmp_path, 'wb')
+            try:
+                while True:
+                    data = source.read(COPY_SIZE)
+                    if not data:
+                        break
+                    target.write(data)
+            finally:
+                target.close()
+                source.close()
+            compressed = open(tmp_path, 'rb')
+            try:
+                os.fsync(compressed.fileno())
+            finally:
+                compressed.close()
+            os.rename(tmp_path, path + '.gz')
+            with self.index.transaction() as conn:
+                conn.execute('UPDATE messages SET shard = ? WHERE shard = ?',
+                             (name + '.gz', name))
+            # Appenders waiting for the lock see the unlinked file and
+            # open a new one
+            os.unlink(path)
+            fcntl.lockf(shard, fcntl.LOCK_UN)
+        finally:
+            shard.close()
+
+
+class ArchiveSpool(object):
+    """ Messages waiting to be appended to `archive` (a `MboxArchive` or
+    `ShardedArchive`). A record is a JSON envelope line followed by the
+    message. """
+
+    def __init__(self, path, archive):
+        self.path = path
+        self.archive = archive
+        self._counter = 0
+
+    def _path(self, subdir, name):
+        return os.path.join(self.path, subdir, name)
+
+    def _unique_name(self):
+        self._counter += 1
+        return '%d_%d.%d.%s' % (time.time() * 1000000, self._counter,
+                                os.getpid(),
+                                socket.gethostname().replace('.', '_'))
+
+    def put(self, from_email, content, role=None):
+        """ Spool a message, returns the name of its record """
+        for subdir in ('tmp', 'new'):
+            directory = os.path.join(self.path, subdir)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        name = self._unique_name()
+        tmp_path = self._path('tmp', name)
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(json.dumps({'from': from_email, 'role': role,
+                                'date': time.time()}) + '\n')
+            for data in message_chunks(content):
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, self._path('new', name))
+        return name
+
+    def pending(self):
+        """ Names of the spooled records, oldest first """
+        directory = os.path.join(self.path, 'new')
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.listdir(directory))
+
+    def _record(self, name):
+        """ The (from_email, role, date, content) of a spooled record """
+        path = self._path('new', name)
+        f = open(path, 'rb')
+        try:
+            envelope = f.readline()
+        finally:
+            f.close()
+        data = json.loads(envelope)
+        return (data['from'], data.get('role'), data['date'],
+                FileMessage(path, len(envelope)))
+
+    def flush(self, limit=None):
+        """ Append the spooled records to the archive, returns how many
+        were archived """
+        names = self.pending()
+        if limit:
+            names = names[:limit]
+        if not names:
+            return 0
+        records = [self._record(name) for name in names]
+        try:
+            self.archive.append(records)
+        finally:
+            for record in records:
+                record[3].close()
+        for name in names:
+            os.unlink(self._path('new', name))
+        return len(names)
+
+    def run(self, interval=10, should_stop=lambda: False):
+        """ Flush every `interval` seconds until `should_stop()`, and
+        compress the shards of past months """
+        while not should_stop():
+            try:
+                archived = self.flush()
+                rotated = self.archive.rotate()
+            except (IOError, OSError, ValueError, sqlite3.Error) as e:
+                log.error("Cannot append to the archive %s: %s",
+                          self.archive.path, e)
+            else:
+                if archived:
+                    log.info("Archived %d messages to %s", archived,
+                             self.archive.path)
+                if rotated:
+                    log.info("Compressed %d shards of %s", rotated,
+                             self.archive.path)
+            time.sleep(interval)
+
+
+def archive_store_from_config(config):
+    """ The archive the messages are appended to: sharded in `archive_dir`
+    or the `mailbox` file of [expander], None without either """
+    path = config.get('archive_dir', '').strip()
+    if path:
+        return ShardedArchive(path)
+    mailbox = config.get('mailbox', '').strip()
+    if mailbox:
+        return MboxArchive(mailbox)
+    return None
+
+
+def archive_from_config(config):
+    """ The archive spool of the `archive_spool` option of [expander], or
+    None when it or the archive is not set """
+    path = config.get('archive_spool', '').strip()
+    archive = archive_store_from_config(config)
+    if not (path and archive):
+        return None
+    return ArchiveSpool(path, archive)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+""" Bounce digests.
+
+Every delivery-failure notice for a role used to be forwarded on its own
+to `bounce_send_to`; one post to a large role with stale addresses made
+hundreds of them. With `bounce_digest_path` the notices that are DSNs
+(RFC 3464, a `message/delivery-status` part) are parsed instead, their
+failed recipients are recorded per role, and one digest per role is sent
+at most every `bounce_digest_interval` seconds. Notices that can't be
+parsed are still forwarded as they are.
+
+"""
+from email.mime.text import MIMEText
+from email.parser import Parser
+from store import COUNTERS_SCHEMA, SqliteStore
+import logging
+import time
+
+__version__ = """$Id$"""
+
+log = logging.getLogger('rolesexpander')
+
+# Recipients of a DSN worth reporting, the others were delivered
+FAILED_ACTIONS = ('failed', 'delayed')
+
+
+def _field_value(value):
+    """ The value of a typed DSN field (`rfc822; user@example.com`),
+    unfolded """
+    return ' '.join((value or '').split(';', 1)[-1].split())
+
+
+def parse_dsn(content):
+    """ The failed recipients of a DSN, as dicts with their `recipient`,
+    `status`, `action` and `diagnostic`. Returns None when `content` (a
+    string or `SpooledMessage`) has no delivery status. """
+    if isinstance(content, basestring):
+        message = Parser().parsestr(content)
+    else:
+        message = Parser().parse(content.open())
+    failures = None
+    for part in message.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        blocks = part.get_payload()
+        if not isinstance(blocks, list):
+            continue
+        # The first block is about the message, one block per recipient
+        for block in blocks[1:]:
+            recipient = _field_value(block.get('final-recipient') or
+                                     block.get('original-recipient'))
+            if not recipient:
+                continue
+            if failures is None:
+                failures = []
+            action = (block.get('action') or '').strip().lower()
+            if action not in FAILED_ACTIONS:
+                continue
+            failures.append({
+                'recipient': recipient,
+                'status': (block.get('status') or '').strip(),
+                'action': action,
+                'diagnostic': _field_value(block.get('diagnostic-code')),
+            })
+    return failures
+
+
+class BounceStore(SqliteStore):
+    """ The failed recipients of each role since its last digest """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS bounces ('
+        ' role TEXT, recipient TEXT, status TEXT, action TEXT,'
+        ' diagnostic TEXT, received REAL, count INTEGER)',
+        'CREATE INDEX IF NOT EXISTS bounces_role ON bounces (role)',
+        'CREATE TABLE IF NOT EXISTS digests ('
+        ' role TEXT PRIMARY KEY, sent REAL)',
+        COUNTERS_SCHEMA,
+    )
+
+    def __init__(self, path, interval=3600, timeout=30):
+        super(BounceStore, self).__init__(path, timeout)
+        self.interval = float(interval)
+
+    def record(self, role, failures):
+        """ Record the failed recipients of a DSN for `role`, returns how
+        many """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO bounces VALUES (?, ?, ?, ?, ?, ?, 1)',
+                [(role, failure['recipient'].lower(), failure['status'],
+                  failure['action'], failure['diagnostic'], now)
+                 for failure in failures])
+            self._count(conn, 'notices')
+            self._count(conn, 'recipients', len(failures))
+        return len(failures)
+
+    def take(self, role=None, interval=None):
+        """ Remove the failures of the roles (or `role`) whose last digest
+        is more than `interval` seconds old. Returns them by role, one
+        entry per recipient and status with its `count` and `last` time. """
+        if interval is None:
+            interval = self.interval
+        now = time.time()
+        taken = {}
+        with self.transaction() as conn:
+            if role is None:
+                roles = [row[0] for row in conn.execute(
+                    'SELECT DISTINCT role FROM bounces')]
+            else:
+                roles = [role]
+            for name in roles:
+                row = conn.execute('SELECT sent FROM digests WHERE role = ?',
+                                   (name,)).fetchone()
+                if row is not None and row[0] > now - interval:
+                    continue
+                # The other columns come from the row of MAX(received)
+                entries = [dict(zip(('recipient', 'status', 'action',
+                                     'diagnostic', 'count', 'last'), values))
+                           for values in conn.execute(
+                               'SELECT recipient, status, action, '
+                               'diagnostic, SUM(count), MAX(received) '
+                               'FROM bounces WHERE role = ? '
+                               'GROUP BY recipient, status '
+                               'ORDER BY recipient', (name,))]
+                if not entries:
+                    continue
+                conn.execute('DELETE FROM bounces WHERE role = ?', (name,))
+                conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?)',
+                             (name, now))
+                self._count(conn, 'digests')
+                taken[name] = entries
+        return taken
+
+    def restore(self, role, entries):
+        """ Put back what `take` returned, when its digest wasn't sent """
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO bounces VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(role, entry['recipient'], entry['status'], entry['action'],
+                  entry['diagnostic'], entry['last'], entry['count'])
+                 for entry in entries])
+            conn.execute('DELETE FROM digests WHERE role = ?', (role,))
+            self._count(conn, 'digests', -1)
+
+    def purge(self):
+        """ Forget every failure and digest, returns how many failures """
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM digests')
+            self._reset_counters(conn)
+            return conn.execute('DELETE FROM bounces').rowcount
+
+    def stats(self):
+        """ The failures waiting for a digest and for how many roles, how
+        many notices and recipients were recorded and digests sent """
+        conn = self.conn
+        stats = {'notices': 0, 'recipients': 0, 'digests': 0}
+        stats['pending'], stats['roles'] = conn.execute(
+            'SELECT COALESCE(SUM(count), 0), COUNT(DISTINCT role) '
+            'FROM bounces').fetchone()
+        stats.update(self.counters())
+        return stats
+
+
+def digest_message(role, entries, from_email, to_email):
+    """ The digest of the failed recipients of `role` """
+    lines = ["Delivery failed for %d recipients of messages sent to the "
+             "role %s:" % (len(entries), role), ""]
+    for entry in entries:
+        lines.append("%s  %s %s, %d times, last on %s" % (
+            entry['recipient'], entry['status'] or '-', entry['action'],
+            entry['count'], time.asctime(time.localtime(entry['last']))))
+        if entry['diagnostic']:
+            lines.append("    " + entry['diagnostic'])
+    message = MIMEText('\n'.join(lines) + '\n', 'plain', 'utf-8')
+    message['Subject'] = "Bounces for role %s: %d recipients" % (
+        role, len(entries))
+    message['From'] = from_email
+    message['To'] = to_email
+    return message.as_string()
+
+
+def send_digests(store, send, from_email, to_email, role=None,
+                 interval=None):
+    """ Send the digests that are due with `send(from_email, emails,
+    content)` (which returns an exit code). A digest that could not be sent
+    is kept for the next time. Returns the number of digests sent. """
+    sent = 0
+    for name, entries in sorted(store.take(role, interval).items()):
+        retval = send(from_email, [to_email],
+                      digest_message(name, entries, from_email, to_email))
+        if retval:
+            log.error("Error %s while sending the bounce digest of %s to "
+                      "%s", retval, name, to_email)
+            store.restore(name, entries)
+            continue
+        log.info("Sent the digest of %d bounces of %s to %s", len(entries),
+                 name, to_email)
+        sent += 1
+    return sent
+
+
+def bounce_store_from_config(config):
+    """ Build the store from the `bounce_digest_*` options of [expander].
+    Returns None when no `bounce_digest_path` is configured. """
+    path = config.get('bounce_digest_path', '').strip()
+    if not path:
+        return None
+    return BounceStore(path, interval=config.get('bounce_digest_interval',
+                                                 3600))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+""" Persistent LDAP lookup cache shared between expander invocations. """
+from store import COUNTERS_SCHEMA, SqliteStore
+import cPickle
+import os
+import sqlite3
+import time
+
+__version__ = """$Id$"""
+
+
+class LdapCache(SqliteStore):
+    """ Key/value cache for LDAP results with a TTL and a size cap.
+    When the cache holds more than `max_entries` the least recently used
+    entries are evicted.
+
+    A lookup is a plain read, so the processes sharing the cache don't
+    wait for each other's reads. The access times, the hit and miss
+    counters and the removal of expired entries are kept in memory and
+    written at most every `flush_interval` seconds, when the write lock is
+    free (and always by `set`, `stats` and `close`).
+
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS cache ('
+        ' key TEXT PRIMARY KEY, value BLOB,'
+        ' created REAL, accessed REAL)',
+        'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)',
+        COUNTERS_SCHEMA,
+    )
+    journal_mode = 'WAL'
+
+    def __init__(self, path, ttl=300, max_entries=10000, timeout=30,
+                 flush_interval=1):
+        super(LdapCache, self).__init__(path, timeout)
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.flush_interval = float(flush_interval)
+        self._flushed = 0
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self._accessed = {}
+        self._expired = set()
+        self._hits = self._misses = 0
+
+    def get(self, key, default=None):
+        """ Returns the cached value for `key`, or `default` when it is
+        missing or expired """
+        now = time.time()
+        row = self.conn.execute('SELECT value, created FROM cache '
+                                'WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] + self.ttl < now:
+            if row is not None:
+                self._expired.add(key)
+            self._misses += 1
+            value = default
+        else:
+            self._accessed[key] = now
+            self._hits += 1
+            value = cPickle.loads(str(row[0]))
+        if now - self._flushed >= self.flush_interval:
+            self._try_flush()
+        return value
+
+    def _write_pending(self, conn):
+        """ Write the access times, counters and expired entries kept
+        since the last flush, in the transaction of `conn` """
+        now = time.time()
+        conn.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                         [(accessed, key)
+                          for key, accessed in self._accessed.items()])
+        # Unless it was set again meanwhile
+        conn.executemany('DELETE FROM cache WHERE key = ? AND created < ?',
+                         [(key, now - self.ttl) for key in self._expired])
+        if self._hits:
+            self._count(conn, 'hits', self._hits)
+        if self._misses:
+            self._count(conn, 'misses', self._misses)
+
+    def flush(self):
+        """ Write what the lookups kept in memory, waiting for the lock """
+        if not (self._accessed or self._expired or self._hits or
+                self._misses):
+            return
+        with self.transaction() as conn:
+            self._write_pending(conn)
+        self._reset_pending()
+        self._flushed = time.time()
+
+    def _try_flush(self):
+        """ `flush` unless another process holds the write lock, the
+        updates are then kept for the next time """
+        conn = self.conn
+        conn.execute('PRAGMA busy_timeout = 0')
+        try:
+            self.flush()
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.execute('PRAGMA busy_timeout = %d' % (self.timeout * 1000))
+
+    def set(self, key, value):
+        now = time.time()
+        data = sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        with self.transaction() as conn:
+            self._write_pending(conn)
+            conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                         (key, data, now, now))
+            size = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            if size > self.max_entries:
+                conn.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                    'ORDER BY accessed LIMIT ?)', (size - self.max_entries,))
+                self._count(conn, 'evictions', size - self.max_entries)
+        self._reset_pending()
+        self._flushed = now
+
+    def purge(self, expired_only=False):
+        """ Remove all (or only the expired) entries. Returns how many
+        entries were removed. """
+        self._reset_pending()
+        with self.transaction() as conn:
+            if expired_only:
+                cursor = conn.execute('DELETE FROM cache WHERE created < ?',
+                                      (time.time() - self.ttl,))
+            else:
+                cursor = conn.execute('DELETE FROM cache')
+                self._reset_counters(conn)
+            return cursor.rowcount
+
+    def stats(self):
+        """ Returns a dictionary with the number of entries and the
+        hit/miss/eviction counters """
+        self.flush()
+        stats = {'entries': 0, 'expired': 0,
+                 'hits': 0, 'misses': 0, 'evictions': 0}
+        conn = self.conn
+        stats['entries'] = conn.execute(
+            'SELECT COUNT(*) FROM cache').fetchone()[0]
+        stats['expired'] = conn.execute(
+            'SELECT COUNT(*) FROM cache WHERE created < ?',
+            (time.time() - self.ttl,)).fetchone()[0]
+        stats.update(self.counters())
+        return stats
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass  # Only statistics and access times are lost
+        super(LdapCache, self).close()
+
+    def keys(self):
+        return [row[0] for row in
+                self.conn.execute('SELECT key FROM cache ORDER BY accessed')]
+
+
+def cache_from_config(config):
+    """ Build the cache from the `cache_*` options of the [ldap] section.
+    Returns None when no `cache_path` is configured. """
+    path = config.get('cache_path', '').strip()
+    if not path:
+        return None
+    return LdapCache(path, ttl=config.get('cache_ttl', 300),
+                     max_entries=config.get('cache_max_entries', 10000))
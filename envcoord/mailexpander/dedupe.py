@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+""" Duplicate suppression between roles.
+
+A message sent to a role and to some of its subroles reaches the expander
+once per role, and the members of several of them would get a copy from
+each. `DeliveredSet` lets the first role that claims a recipient of a
+Message-Id send to it; the other roles skip that recipient for `window`
+seconds. Claims are taken in one write transaction, so expanders running
+at the same time never both send. The claims on recipients that did not
+accept the message are released, so a role that failed doesn't keep them
+from the others.
+
+"""
+from plan import normalize_address
+from store import COUNTERS_SCHEMA, SqliteStore
+import time
+
+__version__ = """$Id$"""
+
+
+class DeliveredSet(SqliteStore):
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS claims ('
+        ' message_id TEXT, recipient TEXT, role TEXT, claimed REAL,'
+        ' PRIMARY KEY (message_id, recipient))',
+        'CREATE INDEX IF NOT EXISTS claims_claimed ON claims (claimed)',
+        COUNTERS_SCHEMA,
+    )
+
+    def __init__(self, path, window=3600, timeout=30):
+        super(DeliveredSet, self).__init__(path, timeout)
+        self.window = float(window)
+
+    def claim(self, message_id, role, recipients):
+        """ Claim `recipients` of `message_id` for `role`. Returns the
+        recipients claimed by another role in the window, which must be
+        skipped. A role may claim its own recipients again (retries). """
+        now = time.time()
+        suppressed = []
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM claims WHERE claimed < ?',
+                         (now - self.window,))
+            for recipient in recipients:
+                key = normalize_address(recipient)
+                if conn.execute(
+                        'INSERT OR IGNORE INTO claims VALUES (?, ?, ?, ?)',
+                        (message_id, key, role, now)).rowcount:
+                    continue
+                owner = conn.execute(
+                    'SELECT role FROM claims WHERE message_id = ? AND '
+                    'recipient = ?', (message_id, key)).fetchone()[0]
+                if owner != role:
+                    suppressed.append(recipient)
+            self._count(conn, 'claimed', len(recipients) - len(suppressed))
+            if suppressed:
+                self._count(conn, 'suppressed', len(suppressed))
+                self._count(conn, 'messages_suppressed')
+        return suppressed
+
+    def release(self, message_id, role, recipients):
+        """ Give up the claims of `role` on `recipients` (they didn't get
+        the message), so another role sends to them. Returns how many. """
+        with self.transaction() as conn:
+            released = 0
+            for recipient in recipients:
+                released += conn.execute(
+                    'DELETE FROM claims WHERE message_id = ? AND '
+                    'recipient = ? AND role = ?',
+                    (message_id, normalize_address(recipient),
+                     role)).rowcount
+            if released:
+                self._count(conn, 'released', released)
+        return released
+
+    def purge(self, expired_only=True):
+        """ Remove the claims older than the window (or all of them),
+        returns how many """
+        with self.transaction() as conn:
+            if expired_only:
+                return conn.execute('DELETE FROM claims WHERE claimed < ?',
+                                    (time.time() - self.window,)).rowcount
+            self._reset_counters(conn)
+            return conn.execute('DELETE FROM claims').rowcount
+
+    def stats(self):
+        """ The claims in the window, how many recipients were claimed and
+        suppressed, and in how many messages something was suppressed """
+        conn = self.conn
+        stats = {'claimed': 0, 'suppressed': 0, 'messages_suppressed': 0,
+                 'released': 0}
+        stats['claims'] = conn.execute(
+            'SELECT COUNT(*) FROM claims WHERE claimed >= ?',
+            (time.time() - self.window,)).fetchone()[0]
+        stats.update(self.counters())
+        return stats
+
+
+def delivered_set_from_config(config):
+    """ Build the set from the `dedupe_*` options of [expander]. Returns
+    None when no `dedupe_path` is configured. """
+    path = config.get('dedupe_path', '').strip()
+    if not path:
+        return None
+    return DeliveredSet(path, window=config.get('dedupe_window', 3600))
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+""" Outbound delivery of the expanded messages.
+
+Everything the expander sends (the batches of members, owner and bounce
+forwarding, notices and confirmations) goes through a `Transport`:
+
+* `SendmailTransport` -- runs the sendmail program for every transaction
+* `SMTPTransport` -- persistent, pipelined SMTP sessions to the MTA
+* `LMTPTransport` -- the same over LMTP, e.g. to a local delivery agent
+* `MaildirTransport` -- writes the messages to a maildir, to benchmark the
+  expander without an MTA
+
+Forking sendmail for every batch of recipients (or opening a new SMTP
+connection for every message) is the most expensive part of expanding a
+large role. `SMTPSession` keeps one connection to the MTA open and sends
+every transaction over it.
+
+Messages are strings or `SpooledMessage`s, which are streamed to sendmail
+and the SMTP server instead of being read into memory.
+
+"""
+from codes import RETURN_CODES
+from message import CHUNK_SIZE, SpooledMessage, message_chunks
+from message import message_lines
+from subprocess import Popen, PIPE
+import logging
+import mailbox
+import os
+import smtplib
+import socket
+import threading
+import time
+
+__version__ = """$Id$"""
+
+log = logging.getLogger('rolesexpander')
+
+
+class SMTPSession(object):
+    """ One SMTP connection reused for many transactions. A transaction
+    after the first one starts with RSET, which also finds out if the
+    server dropped the idle connection; it is then opened again. Commands
+    are pipelined (RFC 2920) when the server supports it. """
+
+    def __init__(self, host='localhost', port=25, timeout=60,
+                 pipelining=True):
+        self.host = host
+        self.port = int(port)
+        self.timeout = float(timeout)
+        self.pipelining = pipelining
+        self._smtp = None
+        self._used = False
+
+    def connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo_or_helo_if_needed()
+        return smtp
+
+    def _session(self):
+        """ The open connection, ready for a new transaction """
+        if self._smtp is not None and self._used:
+            try:
+                code, message = self._smtp.rset()
+                if code == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, socket.error):
+                pass
+            log.debug("Reconnecting to %s:%s", self.host, self.port)
+            self.close()
+        if self._smtp is None:
+            self._smtp = self.connect()
+            self._used = False
+        return self._smtp
+
+    def _envelope(self, smtp, from_email, emails):
+        """ Send MAIL and RCPT, returns the refused recipients """
+        commands = ['mail FROM:%s' % smtplib.quoteaddr(from_email)]
+        commands.extend('rcpt TO:%s' % smtplib.quoteaddr(email)
+                        for email in emails)
+        if self.pipelining and smtp.has_extn('pipelining'):
+            smtp.send(''.join(command + '\r\n' for command in commands))
+            replies = [smtp.getreply() for command in commands]
+        else:
+            replies = []
+            for command in commands:
+                smtp.putcmd(command)
+                replies.append(smtp.getreply())
+
+        code, message = replies[0]
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, message, from_email)
+        refused = {}
+        for email, (code, message) in zip(emails, replies[1:]):
+            if code not in (250, 251):
+                refused[email] = (code, message)
+        if len(refused) == len(emails):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def _data(self, smtp, content):
+        """ Send DATA and the dot-stuffed message, a few lines at a time
+        (`smtplib.SMTP.data` needs it in one string) """
+        smtp.putcmd('data')
+        code, message = smtp.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, message)
+        buffer = []
+        size = 0
+        line = ''
+        for line in message_lines(content):
+            line = smtplib.quotedata(line)
+            buffer.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                smtp.send(''.join(buffer))
+                buffer = []
+                size = 0
+        if not line.endswith(smtplib.CRLF):
+            buffer.append(smtplib.CRLF)
+        buffer.append('.' + smtplib.CRLF)
+        smtp.send(''.join(buffer))
+
+    def sendmail(self, from_email, emails, content):
+        """ Send `content` to `emails` in one transaction. Returns the
+        refused recipients like `smtplib.SMTP.sendmail`, raises
+        `smtplib.SMTPException` or `socket.error` when nothing was sent. """
+        try:
+            smtp = self._session()
+            self._used = True
+            refused = self._envelope(smtp, from_email, emails)
+            self._data(smtp, content)
+            code, message = smtp.getreply()
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.close()
+            raise
+        if code != 250:
+            raise smtplib.SMTPDataError(code, message)
+        return refused
+
+    def close(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                smtp.close()
+
+
+class SMTPSessionPool(object):
+    """ `SMTPSession`s shared by the threads sending batches: a session is
+    used by one thread at a time and kept open for the next transaction.
+    """
+
+    session_factory = SMTPSession
+
+    def __init__(self, host='localhost', port=25, **options):
+        self.host = host
+        self.port = int(port)
+        self.options = options
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def sendmail(self, from_email, emails, content):
+        with self._lock:
+            if self._idle:
+                session = self._idle.pop()
+            else:
+                session = self.session_factory(self.host, self.port,
+                                               **self.options)
+        try:
+            return session.sendmail(from_email, emails, content)
+        finally:
+            with self._lock:
+                self._idle.append(session)
+
+    def close(self):
+        with self._lock:
+            sessions, self._idle = self._idle, []
+        for session in sessions:
+            session.close()
+
+
+class LMTPSession(SMTPSession):
+    """ `SMTPSession` over LMTP (RFC 2033): the server replies to DATA once
+    for every accepted recipient. `host` may be the path of a Unix
+    socket. """
+
+    def __init__(self, host='localhost', port=24, **options):
+        super(LMTPSession, self).__init__(host, port, **options)
+
+    def connect(self):
+        smtp = smtplib.LMTP(self.host, self.port)
+        if smtp.sock is not None:
+            smtp.sock.settimeout(self.timeout)
+        smtp.ehlo_or_helo_if_needed()
+        return smtp
+
+    def sendmail(self, from_email, emails, content):
+        try:
+            smtp = self._session()
+            self._used = True
+            refused = self._envelope(smtp, from_email, emails)
+            self._data(smtp, content)
+            for email in emails:
+                if email in refused:
+                    continue
+                code, message = smtp.getreply()
+                if code != 250:
+                    refused[email] = (code, message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.close()
+            raise
+        if len(refused) == len(emails):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+
+def argv_limit(margin=4096):
+    """ The room left for arguments by the system limit on the size of a
+    command line and its environment (ARG_MAX) """
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 131072  # The smallest limit POSIX systems have had
+    environment = sum(len(key) + len(value) + 2 + 8
+                      for key, value in os.environ.items())
+    return max(arg_max - environment - margin, margin)
+
+
+class Transport(object):
+    """ Sends messages somewhere. Subclasses implement `_send`, which
+    returns one of the `RETURN_CODES`. Every transport counts the
+    transactions, recipients, bytes, errors and the time spent sending;
+    it can be used by several threads. """
+
+    name = None
+    # How many bytes the recipients of one transaction may take on a
+    # command line, None when there is no such limit
+    max_batch_bytes = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ('messages', 'recipients', 'bytes', 'errors'), 0)
+        self.counters['seconds'] = 0.0
+
+    def send(self, from_email, emails, content):
+        start = time.time()
+        return_code = None
+        try:
+            return_code = self._send(from_email, emails, content)
+        finally:
+            with self._lock:
+                counters = self.counters
+                counters['seconds'] += time.time() - start
+                if return_code == RETURN_CODES['EX_OK']:
+                    counters['messages'] += 1
+                    counters['recipients'] += len(emails)
+                    counters['bytes'] += len(content)
+                else:
+                    counters['errors'] += 1
+        return return_code
+
+    def _send(self, from_email, emails, content):
+        raise NotImplementedError
+
+    def stats(self):
+        """ The counters, with the throughput """
+        with self._lock:
+            stats = dict(self.counters)
+        seconds = stats['seconds'] or 1e-9
+        stats['messages_per_second'] = stats['messages'] / seconds
+        stats['recipients_per_second'] = stats['recipients'] / seconds
+        return stats
+
+    def close(self):
+        pass
+
+
+class SMTPTransport(Transport):
+    """ Send over a pool of persistent SMTP sessions """
+
+    name = 'smtp'
+    session_factory = SMTPSession
+
+    def __init__(self, host='localhost', port=25, **options):
+        super(SMTPTransport, self).__init__()
+        self.sessions = SMTPSessionPool(host, port, **options)
+        self.sessions.session_factory = self.session_factory
+
+    def _send(self, from_email, emails, content):
+        try:
+            refused = self.sessions.sendmail(from_email, emails, content)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+            if not self._deferred(refused):
+                log.error("Failed to send emails using %s, all recipients "
+                          "refused: %r", self.name, refused)
+                return RETURN_CODES['EX_PROTOCOL']
+        except smtplib.SMTPResponseException as e:
+            log.error("Failed to send emails using %s to %r: %s %s",
+                      self.name, emails, e.smtp_code, e.smtp_error)
+            if 400 <= e.smtp_code < 500:
+                return RETURN_CODES['EX_TEMPFAIL']
+            return RETURN_CODES['EX_PROTOCOL']
+        except smtplib.SMTPException:
+            log.exception("SMTP Error")
+            log.error("Failed to send emails using %s to %r",
+                      self.name, emails)
+            return RETURN_CODES['EX_PROTOCOL']
+        except Exception as e:
+            log.exception("Smtplib error %s" % e)
+            return RETURN_CODES['EX_UNAVAILABLE']
+        if self._deferred(refused):
+            # Refused for now, e.g. over the server's recipient limit: the
+            # batch isn't reported as delivered and is tried again whole
+            log.error("Recipients deferred by %s: %r", self.name, refused)
+            return RETURN_CODES['EX_TEMPFAIL']
+        if refused:
+            log.error("Recipients refused: %r", refused)
+        log.debug("Sent emails to %r", emails)
+        return RETURN_CODES['EX_OK']
+
+    def _deferred(self, refused):
+        """ Whether any of the `refused` recipients got a 4xx reply """
+        return any(400 <= code < 500 for code, message in refused.values())
+
+    def close(self):
+        self.sessions.close()
+
+
+class LMTPTransport(SMTPTransport):
+    """ Send over a pool of persistent LMTP sessions """
+
+    name = 'lmtp'
+    session_factory = LMTPSession
+
+    def __init__(self, host='localhost', port=24, **options):
+        super(LMTPTransport, self).__init__(host, port, **options)
+
+
+class SendmailTransport(Transport):
+    """ Run the sendmail program, falling back to `fallback` (SMTP to
+    localhost) when it can't be started """
+
+    name = 'sendmail'
+
+    def __init__(self, sendmail_path='/usr/sbin/sendmail', fallback=None):
+        super(SendmailTransport, self).__init__()
+        self.sendmail_path = sendmail_path
+        self.fallback = fallback or SMTPTransport()
+        self.max_batch_bytes = argv_limit()
+
+    def _send(self, from_email, emails, content):
+        try:
+            # This should be secure check:
+            # http://docs.python.org/library/subprocess.html
+            # #using-the-subprocess-module
+            # It turns out that sendmail splits the addresses on space,
+            # eventhough there is one address per argument. See RFC5322 section
+            # 3.4 Try: /usr/sbin/sendmail 'test @envcoord.health.fgov.be' and
+            # it will complain about the address. We therefore clean them with
+            # smtplib.quoteaddr
+            quotedemails = map(smtplib.quoteaddr, emails)
+            ps = Popen([self.sendmail_path,
+                        '-f',
+                        smtplib.quoteaddr(from_email),
+                        '--'] + quotedemails,
+                       # Batches run concurrently: a child must not hold
+                       # the stdin pipes of its siblings open
+                       stdin=PIPE, close_fds=True)
+            for data in message_chunks(content):
+                ps.stdin.write(data)
+            ps.stdin.flush()
+            ps.stdin.close()
+            return_code = ps.wait()
+            if return_code in (RETURN_CODES['EX_OK'],
+                               RETURN_CODES['EX_TEMPFAIL']):
+                log.debug("Sent emails to %r", emails)
+                return RETURN_CODES['EX_OK']
+            else:
+                log.error("Failed to send emails using sendmail to %r. "
+                          "/usr/sbin/sendmail exited with code %d", emails,
+                          return_code)
+            return return_code
+        except (OSError, IOError):  # fallback to smtplib
+            # Since this is the same mailer we use localhost
+            log.exception("Cannot use sendmail program. Falling back to "
+                          "smtplib.")
+            log.warning(
+                "If the smtp connection fails some emails will be lost")
+            return self.fallback.send(from_email, emails, content)
+
+    def close(self):
+        self.fallback.close()
+
+
+class MaildirTransport(Transport):
+    """ Deliver every transaction to one message in a maildir, with the
+    envelope in `Return-Path` and `X-Envelope-To` headers """
+
+    name = 'maildir'
+
+    def __init__(self, path):
+        super(MaildirTransport, self).__init__()
+        self.maildir = mailbox.Maildir(path, factory=None, create=True)
+        for subdir in ('tmp', 'new', 'cur'):  # `path` may exist already
+            if not os.path.isdir(os.path.join(path, subdir)):
+                os.makedirs(os.path.join(path, subdir))
+        self._add_lock = threading.Lock()
+
+    def _send(self, from_email, emails, content):
+        message = SpooledMessage()
+        message.write('Return-Path: <%s>\nX-Envelope-To: %s\n' % (
+            from_email, ', '.join(emails)))
+        for data in message_chunks(content):
+            message.write(data)
+        try:
+            with self._add_lock:
+                self.maildir.add(message.open())
+        except (OSError, IOError) as e:
+            log.error("Cannot write to maildir %s: %s",
+                      self.maildir._path, e)
+            return RETURN_CODES['EX_CANTCREAT']
+        return RETURN_CODES['EX_OK']
+
+
+def transport_from_config(config):
+    """ The transport set by the `delivery` option of [expander] """
+    delivery = config.get('delivery', 'sendmail').strip().lower()
+    smtp = SMTPTransport(config.get('smtp_host', 'localhost').strip(),
+                         config.get('smtp_port', 25))
+    if delivery == 'sendmail':
+        return SendmailTransport(
+            config.get('sendmail_path', '/usr/sbin/sendmail'), smtp)
+    if delivery == 'smtp':
+        return smtp
+    if delivery == 'lmtp':
+        return LMTPTransport(config.get('lmtp_host', 'localhost').strip(),
+                             config.get('lmtp_port', 24))
+    if delivery == 'maildir':
+        return MaildirTransport(config['maildir_path'].strip())
+    raise ValueError("Unknown delivery %r" % delivery)
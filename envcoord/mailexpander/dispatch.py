@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+""" Send the recipient batches of a message concurrently. """
+from codes import RETURN_CODES
+import logging
+import sys
+import threading
+import time
+
+__version__ = """$Id$"""
+
+log = logging.getLogger('rolesexpander')
+
+
+class BatchDispatcher(object):
+    """ Runs `send(batch)` for the batches of a message on up to
+    `max_concurrency` threads, see `dispatch`.
+
+    The number of batches in flight adapts like TCP congestion control
+    (AIMD): it grows by one after a full round of batches that each took
+    less than `latency_target` seconds, and is halved when a batch is slow
+    or fails. It is kept between messages.
+
+    As when the batches are sent one after the other, no batch is started
+    after one failed, and the result is the error of the first failed batch
+    (in batch order). Exceptions raised by `send` are raised again.
+
+    """
+
+    def __init__(self, max_concurrency=1, latency_target=5):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.latency_target = float(latency_target)
+        self.limit = 1.0
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def _adjust(self, elapsed, return_code):
+        with self._lock:
+            if (return_code != RETURN_CODES['EX_OK'] or
+                    elapsed > self.latency_target):
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency),
+                                 self.limit + 1.0 / int(self.limit))
+
+    def _send(self, send, batch):
+        start = time.time()
+        try:
+            return_code = send(batch)
+        except Exception:
+            self._adjust(time.time() - start, None)
+            raise
+        self._adjust(time.time() - start, return_code)
+        return return_code
+
+    def dispatch(self, send, batches):
+        """ Send all `batches` with `send(batch)`, which returns one of the
+        `RETURN_CODES`. Returns the first error or EX_OK. """
+        if self.max_concurrency == 1:
+            for batch in batches:
+                return_code = self._send(send, batch)
+                if return_code != RETURN_CODES['EX_OK']:
+                    return return_code
+            return RETURN_CODES['EX_OK']
+
+        results = [None] * len(batches)
+        done = threading.Condition()
+        state = {'running': 0, 'failed': False}
+
+        def run(index, batch):
+            try:
+                results[index] = (self._send(send, batch), None)
+            except Exception:
+                results[index] = (None, sys.exc_info())
+            with done:
+                state['running'] -= 1
+                if results[index] != (RETURN_CODES['EX_OK'], None):
+                    state['failed'] = True
+                done.notify_all()
+
+        for index, batch in enumerate(batches):
+            with done:
+                while (state['running'] >= self.concurrency and
+                       not state['failed']):
+                    done.wait()
+                if state['failed']:
+                    log.info("Not sending the %d remaining batches",
+                             len(batches) - index)
+                    break
+                state['running'] += 1
+            thread = threading.Thread(target=run, args=(index, batch))
+            thread.daemon = True
+            thread.start()
+
+        with done:
+            while state['running']:
+                done.wait()
+
+        for result in results:
+            if result is None:
+                continue  # Not sent
+            return_code, exc_info = result
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if return_code != RETURN_CODES['EX_OK']:
+                return return_code
+        return RETURN_CODES['EX_OK']
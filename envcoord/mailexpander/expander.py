@@ -1,18 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from ConfigParser import ConfigParser
-from fnmatch import fnmatch
-from ldap_agent import LdapAgent
+from ConfigParser import ConfigParser, NoSectionError
+from acl import SenderACL
+from archive import archive_from_config, archive_store_from_config
+from archive import from_line
+from bounces import bounce_store_from_config, parse_dsn, send_digests
+from cache import cache_from_config
+from codes import IGNORE_LIST, RETURN_CODES
+from dedupe import delivered_set_from_config
+from delivery import transport_from_config
+from dispatch import BatchDispatcher
+from functools import partial
+from headers import read_headers
+from journal import journal_from_config
+from ldap_agent import LdapAgent, _config_flag
 from logging.handlers import SysLogHandler
-from subprocess import Popen, PIPE
-import email
+from message import SPOOL_MAX_SIZE, SpooledMessage, message_chunks
+from message import splice
+from plan import RecipientPlan, normalize_address, parse_batch_size
+from throttle import throttle_from_config
 import fcntl
 import getopt
 import ldap
 import logging
 import os
-import smtplib
+import signal
+import sqlite3
 import string
 import sys
 import time
@@ -40,27 +54,6 @@ except ImportError:
         return decorator
 
 
-RETURN_CODES = {
-    'EX_OK':           0,   # successful termination
-    'EX_USAGE':        64,  # command line usage error
-    'EX_DATAERR':      65,  # data format error
-    'EX_NOINPUT':      66,  # cannot open input
-    'EX_NOUSER':       67,  # addressee unknown
-    'EX_NOHOST':       68,  # host name unknown
-    'EX_UNAVAILABLE':  69,  # service unavailable
-    'EX_SOFTWARE':     70,  # internal software error
-    'EX_OSERR':        71,  # system error (e.g., can't fork)
-    'EX_OSFILE':       72,  # critical OS file missing
-    'EX_CANTCREAT':    73,  # can't create (user) output file
-    'EX_IOERR':        74,  # input/output error
-    'EX_TEMPFAIL':     75,  # temp failure; user is invited to retry
-    'EX_PROTOCOL':     76,  # remote error in protocol
-    'EX_NOPERM':       77,  # permission denied
-    'EX_CONFIG':       78,  # configuration error
-}
-
-IGNORE_LIST = ['zope@envcoord.health.fgov.be', 'root@envcoord.health.fgov.be']
-
 DUMMY_MAIL = """MIME-Version: 1.0
 Content-Type: text/plain; charset="utf-8"
 Content-Transfer-Encoding: quoted-printable
@@ -102,14 +95,51 @@ class Expander(object):
 
     def __init__(self, ldap_agent, **config):
         self.agent = ldap_agent
-        self.sendmail_path = config.get('sendmail_path', '/usr/sbin/sendmail')
+        # Everything is sent with the transport chosen by `delivery`
+        self.transport = transport_from_config(config)
+        # Recipients per transaction (`all` for a single one), globally
+        # and for some roles: `role_batch_sizes: big-role=500, other=all`
+        self.batch_size = parse_batch_size(config.get('batch_size', 50))
+        self.role_batch_sizes = {}
+        for item in config.get('role_batch_sizes', '').split(','):
+            if '=' in item:
+                role_id, size = item.split('=', 1)
+                self.role_batch_sizes[role_id.strip()] = \
+                    parse_batch_size(size)
+        self.group_by_domain = _config_flag(
+            config.get('group_by_domain', True))
+        # Send up to max_concurrency batches at the same time, fewer while
+        # a batch takes longer than latency_target seconds or fails
+        self.dispatcher = BatchDispatcher(
+            config.get('max_concurrency', 1),
+            config.get('latency_target', 5))
+        # Token buckets per destination domain, shared by all processes:
+        # `throttle_rates: gov.be=100/60` (recipients/seconds)
+        self.throttle = throttle_from_config(config)
+        # Who already got a message, so a retry only sends to the rest
+        self.journal = journal_from_config(config)
+        if (self.throttle is not None and self.throttle.mode == 'defer' and
+                self.journal is None):
+            log.warning("throttle_mode is defer without a journal_path: "
+                        "deferred messages are sent again to the batches "
+                        "that already got them")
+        # Who got a message from any role, to skip them in the others
+        self.delivered_set = delivered_set_from_config(config)
         self.archivefile = config.get('mailbox', None)
+        # Sharded per role and month in `archive_dir`, and indexed
+        self.archive = None
+        if config.get('archive_dir', '').strip():
+            self.archive = archive_store_from_config(config)
+        # Spool the archive copies, `roleexpander archive` appends them
+        self.archive_spool = archive_from_config(config)
         also_string = config.get('also_send_to', '')
         self.also_send_to = map(string.strip, also_string.split(','))
         self.noreply = config.get('no_reply',
                                   'no-reply@envcoord.health.fgov.be')
         self.no_owner_send_to = config.get('no_owner_send_to', '').strip()
         self.bounce_send_to = config.get('bounce_send_to', '').strip()
+        # DSNs are recorded and sent as one digest per role and interval
+        self.bounce_store = bounce_store_from_config(config)
         self.filter_str = config.get('filter_str', '').strip()
         self.roles_to_filter = []
         roles_to_filter = config.get(
@@ -118,6 +148,9 @@ class Expander(object):
                                                   None)
         if roles_to_filter:
             self.roles_to_filter = roles_to_filter.strip().split(',')
+        # Keep the compiled permitted senders of a role around (seconds)
+        self.acl_cache_ttl = float(config.get('acl_cache_ttl', 0))
+        self._acl_cache = {}
 
     @log_exceptions
     def expand(self, from_email, role_email, content, debug_mode=False):
@@ -125,17 +158,38 @@ class Expander(object):
         `from_email` is allowed to do so. Prepend the `role` name to the e-mail
         subject. Modify the headers according to these priciples:
         http://tools.ietf.org/html/rfc5321#page-31
-        Also queue max 50 messages per send so that the mailer can deliver them
-        asynchronously.
+        Also queue max `batch_size` (50) messages per send so that the mailer
+        can deliver them asynchronously.
 
         Arguments::
 
             from_email -- Sender e-mail (as received from sendmail)
             role_email -- A pseudo address (ldap-role@roles.eionet.europa.eu)
-            content -- E-mail headers and body
+            content -- E-mail headers and body, a string or a
+                       `SpooledMessage`; the copies sent are of the same
+                       kind
 
         """
+        # Entries fetched from LDAP are reused for the whole expansion
+        self.agent.reset_lookups()
+        try:
+            return self._expand(from_email, role_email, content, debug_mode)
+        except ldap.SERVER_DOWN:
+            # Members, owners and senders are fetched lazily, after the
+            # role was found: an outage then must not bounce the message
+            log.error("LDAP server is down")
+            return RETURN_CODES['EX_TEMPFAIL']
+        except ldap.LDAPError as e:
+            # The first bind happens here when the role came from the cache,
+            # and a member search may time out or exceed a limit
+            log.error("LDAP error while expanding to %s: %r", role_email, e)
+            return RETURN_CODES['EX_TEMPFAIL']
+        finally:
+            stats = self.agent.lookup_stats
+            log.info("LDAP lookups for %s: %s queries, %s saved",
+                     role_email, stats['queries'], stats['saved'])
 
+    def _expand(self, from_email, role_email, content, debug_mode):
         role = role_email.split('@')[0]
         log.info("New mail from %s to %s", from_email, role_email)
 
@@ -154,6 +208,33 @@ class Expander(object):
         if role.lower().startswith('owner-'):
             role = role.split('owner-')[1]
             send_to_owners = True
+
+        # MTA delivery-failure notices ("Undeliverable" / MAILER-DAEMON
+        # DSNs) bounce back to the owner-<role>@ envelope sender we stamp
+        # on every outbound copy, and arrive with a null envelope sender
+        # (Postfix passes an empty/unqualified `from_email`, exactly like
+        # the bare-role guard further down -- confirmed by the bounce
+        # headers: `smtp.mailfrom=;`, `auto-submitted: auto-replied`).
+        # These were flooding the role owners (one owner received every
+        # single bounce), so per client request funnel them into a single
+        # mailbox instead. Genuine mail to owner-<role>@ (a real human
+        # trying to reach the list owners) has a normal sender and falls
+        # through to the owners below, unchanged. They are routed before
+        # the role is loaded, so bounces never connect to LDAP.
+        if send_to_owners and from_email.count('@') != 1:
+            target = self.bounce_send_to or self.no_owner_send_to
+            log.info("Delivery-failure notice for role %s, routing to %s",
+                     role, target)
+            if debug_mode:
+                return RETURN_CODES['EX_OK']
+            if not target:
+                log.error("The configuration misses bounce_send_to / "
+                          "no_owner_send_to for delivery-failure routing")
+                return RETURN_CODES['EX_CONFIG']
+            if self.collect_bounce(role, content, target):
+                return RETURN_CODES['EX_OK']
+            return self.send_emails(self.noreply, [target], content)
+
         try:
             role_data = self.agent.get_role(role)
             assert 'members_data' in role_data, (
@@ -167,6 +248,12 @@ class Expander(object):
         except ldap.SERVER_DOWN:
             log.error("LDAP server is down")
             return RETURN_CODES['EX_TEMPFAIL']
+        except (ldap.INVALID_CREDENTIALS, ldap.CONNECT_ERROR,
+                ldap.TIMEOUT) as e:
+            # The agent binds on its first query, a failed bind must not
+            # bounce the message
+            log.error("Cannot bind to LDAP: %r", e)
+            return RETURN_CODES['EX_TEMPFAIL']
         except (ldap.NO_SUCH_OBJECT, ValueError):
             log.info("%r role not found in ldap", role)
             return RETURN_CODES['EX_NOUSER']
@@ -177,36 +264,15 @@ class Expander(object):
         top_role = role.split('-')[0]
 
         if send_to_owners is True:  # Send e-mail to owners
-            # MTA delivery-failure notices ("Undeliverable" / MAILER-DAEMON
-            # DSNs) bounce back to the owner-<role>@ envelope sender we stamp
-            # on every outbound copy, and arrive with a null envelope sender
-            # (Postfix passes an empty/unqualified `from_email`, exactly like
-            # the bare-role guard further down -- confirmed by the bounce
-            # headers: `smtp.mailfrom=;`, `auto-submitted: auto-replied`).
-            # These were flooding the role owners (one owner received every
-            # single bounce), so per client request funnel them into a single
-            # mailbox instead. Genuine mail to owner-<role>@ (a real human
-            # trying to reach the list owners) has a normal sender and falls
-            # through to the owners below, unchanged.
-            if from_email.count('@') != 1:
-                target = self.bounce_send_to or self.no_owner_send_to
-                log.info("Delivery-failure notice for role %s, routing to %s",
-                         role, target)
-                if debug_mode:
-                    return RETURN_CODES['EX_OK']
-                if not target:
-                    log.error("The configuration misses bounce_send_to / "
-                              "no_owner_send_to for delivery-failure routing")
-                    return RETURN_CODES['EX_CONFIG']
-                return self.send_emails(self.noreply, [target], content)
             owners = role_data['owners_data']
+            plan = self.recipient_plan(role)
             for owner_dn, owner_data in owners.items():
-                retval = self.send_emails(from_email, owner_data['mail'],
-                                          content)
-                if retval != RETURN_CODES['EX_OK']:
-                    log.error("Error %s while sending to %s",
-                              retval, owner_data['mail'])
-                    return retval
+                plan.add('owners', owner_data.get('mail', []))
+            self.log_plan(role_email, plan)
+            retval = self.send_batches(from_email, plan.batches('owners'),
+                                       content)
+            if retval != RETURN_CODES['EX_OK']:
+                return retval
             if not owners:
                 log.info("No owner found, sending to %s",
                          self.no_owner_send_to)
@@ -253,8 +319,9 @@ class Expander(object):
             return RETURN_CODES['EX_NOPERM']
 
         # Add the necessary headers such as Received and modify the subject
-        # with [role]
-        em = email.message_from_string(content)
+        # with [role]. Only the header block is parsed and rewritten, the
+        # body is sent as it came
+        em, body_offset = read_headers(content)
         # Prepend to subject:
         raw_subject = em.get('subject', '(no-subject)')
         # Decode RFC 2047 encoded subject to unicode to avoid creating
@@ -328,59 +395,99 @@ class Expander(object):
         # Used by Thunderbird and KMail
         #em['List-Post'] = '<mailto:%s>' % role_email
 
-        content = em.as_string()
-
-        # Split the emails in to batches
-        email_batches = [[]]
-        batch = 0
-        batch_size = 50  # Send in email batches
-
-        for dn, data in role_data['members_data'].iteritems():
-            # if there is a filter and the mail was not sent directly to
-            # a role matching the filter, remove all users from subroles
-            # mathching that filter
-            if (top_role in self.roles_to_filter and
-                    self.filter_str not in role):
-                filter_out = False
-                member_roles = self.agent.roles_with_member(dn)
-                for member_role in member_roles:
-                    # we remove only users who are members of a
-                    # subbranch of the current top_role that contains
-                    # the filtered string
-                    if (top_role in member_role and
-                            self.filter_str in member_role):
-                        log.info('filtered out %s' % dn)
-                        filter_out = True
-                        break
-                if filter_out:
-                    continue
-            if len(email_batches[batch]) >= batch_size:
-                batch += 1
-                email_batches.append([])  # Init new batch
+        content = splice(em.as_string(), content, body_offset)
+
+        # Every address once, in batches
+        plan = self.recipient_plan(role)
+        # Members already covered by also_send_to are skipped
+        plan.add('also_send_to', self.also_send_to)
+
+        members = role_data['members_data']
+        # if there is a filter and the mail was not sent directly to
+        # a role matching the filter, remove all users from subroles
+        # mathching that filter
+        filtered_out = set()
+        if (top_role in self.roles_to_filter and
+                self.filter_str not in role):
+            # we remove only users who are members of a
+            # subbranch of the current top_role that contains
+            # the filtered string
+            filtered_out = self.agent.subrole_members(
+                top_role, self.filter_str, members)
+
+        for dn, data in members.iteritems():
+            if self.agent._normalize_dn(dn) in filtered_out:
+                log.info('filtered out %s' % dn)
+                continue
             clean_addresses = filter(lambda i: i.find(
                 '@') > 0, data.get('mail', ['']))
-            email_batches[batch].extend(clean_addresses)
+            plan.add('members', clean_addresses)
+
+        # Postfix retries a message when a batch failed, send it only to
+        # the recipients that did not accept it yet
+        message_id = (em.get('message-id') or '').strip()
+        journal = None
+        archived = False
+        record_delivered = None
+        if self.journal is not None and message_id and not debug_mode:
+            started = self._store(self.journal.start, message_id,
+                                  role_email)
+            if started is not None:
+                journal = self.journal
+                delivered, archived = started
+                if delivered:
+                    log.info("Retry of %s: %d recipients already have it",
+                             message_id, plan.remove(delivered))
+                record_delivered = partial(self._store, journal.delivered,
+                                           message_id, role_email)
+
+        # Members that already got the message from another role (it was
+        # sent to a role and its subroles) are skipped. The recipients are
+        # claimed before sending, so concurrent expansions never both send;
+        # also_send_to gets the copy of every role.
+        claimed = []
+        if (self.delivered_set is not None and message_id and
+                not debug_mode):
+            suppressed = self._store(self.delivered_set.claim, message_id,
+                                     role_email, plan.addresses('members'))
+            if suppressed:
+                log.info("%s: %d members got it from another role",
+                         message_id, plan.remove(suppressed,
+                                                 'sent by other roles',
+                                                 ['members']))
+            if suppressed is not None:
+                claimed = plan.addresses('members')
+
+        self.log_plan(role_email, plan)
 
         if not debug_mode:
-            self.write_to_archive(from_email, content)
-
-            # If there are any addresses to always send to
-            if self.also_send_to != ['']:
-                retval = self.send_emails(
-                    'owner-' + role_email, self.also_send_to, content)
-                if retval != RETURN_CODES['EX_OK']:
-                    log.error("Error %s while sending to %s",
-                              retval, self.also_send_to)
-                    return retval
-
-            # Send e-mails
-            for emails in email_batches:
-                retval = self.send_emails(
-                    'owner-' + role_email, emails, content)
-                if retval != RETURN_CODES['EX_OK']:
-                    log.error("Error %s while sending to %s",
-                              retval, emails)
-                    return retval
+            if not archived:
+                self.write_to_archive(from_email, content, role_email)
+                if journal is not None:
+                    self._store(journal.archived, message_id, role_email)
+
+            accepted = []
+
+            def delivered(emails):
+                accepted.extend(emails)
+                if record_delivered is not None:
+                    record_delivered(emails)
+            # Pacing for the rate limits is bounded for the whole message
+            deadline = self.throttle and self.throttle.deadline()
+            try:
+                # also_send_to first, then the members
+                for group in plan.groups:
+                    retval = self.send_batches(
+                        'owner-' + role_email, plan.batches(group), content,
+                        delivered, deadline)
+                    if retval != RETURN_CODES['EX_OK']:
+                        return retval
+            finally:
+                # Members this role claimed but could not send to are left
+                # to the other roles
+                if claimed:
+                    self.release_claims(message_id, role_email, claimed,
+                                        accepted)
             if not self.skip_confirmation_email:
                 try:
                     retval = self.send_confirmation_email(
@@ -413,6 +520,9 @@ class Expander(object):
                         "role %s", role)
             return RETURN_CODES['EX_OK']
 
+        if not debug_mode and self.collect_bounce(role, content,
+                                                  self.bounce_send_to):
+            return RETURN_CODES['EX_OK']
         log.info("Sending bounce notification to %s", self.bounce_send_to)
         if not debug_mode:
             retval = self.send_emails(
@@ -424,8 +534,39 @@ class Expander(object):
 
         return RETURN_CODES['EX_OK']
 
+    def collect_bounce(self, role, content, target):
+        """ Record the failed recipients of a DSN for the digest of `role`
+        and send the digest to `target` when it is due. Returns False when
+        the notice must be forwarded as it is: no `bounce_digest_path`, not
+        a DSN, or the store failed. """
+        if self.bounce_store is None:
+            return False
+        failures = parse_dsn(content)
+        if failures is None:
+            log.info("The bounce for role %s is not a DSN, forwarding it",
+                     role)
+            return False
+        log.info("DSN for role %s: %d failed recipients", role,
+                 len(failures))
+        if failures and self._store(self.bounce_store.record, role,
+                                    failures) is None:
+            return False
+        # Recorded, a digest that can't be sent now goes with the next one
+        try:
+            send_digests(self.bounce_store, self.send_emails, self.noreply,
+                         target, role)
+        except sqlite3.Error as e:
+            log.error("Error in %s: %s", self.bounce_store.path, e)
+        return True
+
     def add_inherited_senders(self, role_id, role_data):
         """ Add as permitted senders everyone that inherits
+
+        Sender patterns of the parents are added to `permittedSender`. Users
+        allowed through the `owners` or `members` pattern of a parent are
+        added by DN to `inheritedSenders`, users in a parent's
+        `permittedPerson` to `inheritedPersons`, so they can be checked
+        without fetching every one of them.
         """
         # also add permitted from all the parents
         # this allows "inheriting" permissions from above roles
@@ -439,47 +580,26 @@ class Expander(object):
         role_dn = self.agent._role_dn(role_id)
         parent_roles = self.agent._ancestor_roles_dn(role_dn)[1:]
         senders = set(role_data['permittedSender'])
+        sender_dns = set()
+        person_dns = set()
 
-        for parent_role_dn in parent_roles:
-            role_info = self.agent._role_info(parent_role_dn)
+        for role_info in self.agent._roles_info(parent_roles):
 
-            if 'permittedSender' not in role_info:
-                continue
+            if 'permittedSender' in role_info:
+                for sender_pattern in role_info['permittedSender']:
+                    sender_pattern = sender_pattern.lower()
+                    if sender_pattern == 'owners':
+                        sender_dns.update(role_info.get('owner', []))
+                    elif sender_pattern == 'members':
+                        sender_dns.update(role_info.get('members', []))
+                    elif '@' in sender_pattern:
+                        senders.add(sender_pattern)
 
-            for sender_pattern in role_info['permittedSender']:
-                sender_pattern = sender_pattern.lower()
-                if sender_pattern == 'owners':
-                    if 'owner' in role_info:
-                        for owner_dn in role_info['owner']:
-                            try:
-                                owner = self.agent._query(owner_dn)
-                            except Exception as e:
-                                # Log that we couldn't get the email.
-                                log.exception(
-                                    "Invalid `owner` DN: %s; %s" % (owner_dn,
-                                                                    e))
-                                continue
-
-                            senders.update([x.lower() for x in owner['mail']])
-                elif sender_pattern == 'members':
-                    members = role_info.get('members', [])
-                    for user_dn in members:
-                        user_info = self.agent._query(user_dn)
-                        senders.update([x.lower() for x in user_info['mail']])
-                elif '@' in sender_pattern:
-                    senders.add(sender_pattern)
-
-            for person_dn in role_info.get('permittedPerson', []):
-                try:
-                    sender_email = self.agent._query(person_dn)['mail'][0]
-                except Exception as e:
-                    # Log that we couldn't get the email.
-                    log.exception("Invalid DN: %s; %s" % (person_dn, e))
-                    continue
-                else:
-                    senders.add(sender_email)
+                person_dns.update(role_info.get('permittedPerson', []))
 
         role_data['permittedSender'] = filter(None, set(senders))
+        role_data['inheritedSenders'] = filter(None, sender_dns)
+        role_data['inheritedPersons'] = filter(None, person_dns)
 
         return role_data
 
@@ -505,10 +625,12 @@ class Expander(object):
 
         permittedPerson -- DN of a user (match the user's email with
         `from_email`)
-        """
 
-        role_data = self.add_inherited_senders(role_id=role,
-                                               role_data=role_data)
+        Owners, members and permitted persons are not fetched one by one:
+        the sender is looked up in ldap by e-mail once and the DNs found are
+        compared with the ones allowed to send. The rules are compiled into
+        a `SenderACL`, kept for `acl_cache_ttl` seconds when configured.
+        """
 
         # Convert to lower in case of mixed-case e-mail addresses
         from_email = from_email.lower()
@@ -521,45 +643,22 @@ class Expander(object):
         name = ident.split('=')[-1]
         from_email = "@".join((name, host))
 
-        if 'permittedSender' in role_data:
-            if 'anyone' in role_data['permittedSender']:
-                return True
-            for sender_pattern in role_data['permittedSender']:
-                sender_pattern = sender_pattern.lower()
-                if sender_pattern == 'owners':
-                    if 'owner' in role_data:
-                        for owner_dn in role_data['owner']:
-                            try:
-                                owner = self.agent._query(owner_dn)
-                            except Exception as e:
-                                # Log that we couldn't get the email.
-                                log.exception(
-                                    "Invalid `owner` DN: %s; %s" % (owner_dn, e))
-                                continue
-                            if from_email in map(str.lower, owner['mail']):
-                                return True
-                elif sender_pattern == 'members':
-                    if 'members_data' in role_data:
-                        for user_dn, user_attrs in \
-                                role_data['members_data'].iteritems():
-                            if from_email in \
-                                    map(str.lower, user_attrs['mail']):
-                                return True
-                elif fnmatch(from_email, sender_pattern):
-                    return True
-
-        if 'permittedPerson' in role_data:
-            for permitted_dn in role_data['permittedPerson']:
-                try:
-                    persons_emails = self.agent._query(permitted_dn)['mail']
-                    if from_email in map(str.lower, persons_emails):
-                        return True
-                except Exception as e:
-                    # Log that we couldn't get the email.
-                    log.exception("Invalid DN: %s; %s" % (permitted_dn, e))
-                    continue
+        return self.sender_acl(role, role_data).allows(from_email, self.agent)
 
-        return False
+    def sender_acl(self, role, role_data):
+        """ The `SenderACL` of `role`, from the ACL cache if possible """
+        if self.acl_cache_ttl > 0:
+            expires, acl = self._acl_cache.get(role, (0, None))
+            if expires > time.time():
+                return acl
+
+        role_data = self.add_inherited_senders(role_id=role,
+                                               role_data=role_data)
+        acl = SenderACL.from_role(role_data, self.agent)
+
+        if self.acl_cache_ttl > 0:
+            self._acl_cache[role] = (time.time() + self.acl_cache_ttl, acl)
+        return acl
 
     def is_deactivated(self, role_data):
         """ Check if a role is deactivated based on the LDAP 'l' attribute.
@@ -623,95 +722,110 @@ class Expander(object):
         message['To'] = to_email
         message.attach(html_part)
 
-        smtp = smtplib.SMTP('localhost')
+        retval = self.transport.send(self.noreply, [to_email],
+                                     message.as_string())
+        if retval == RETURN_CODES['EX_OK']:
+            log.debug('Confirmation email sent to %s', to_email)
+        return retval
+
+    def _store(self, method, *args):
+        """ Call a method of the journal, the delivered set or the bounce
+        store. A broken store must not stop the delivery, it only costs
+        duplicates. """
         try:
-            try:
-                smtp.sendmail(self.noreply, to_email, message.as_string())
-                log.debug('Confirmation email sent to %s', to_email)
-            except smtplib.SMTPException:
-                log.exception("SMTP Error")
-                log.error("Failed to send confirmation email "
-                          "using smtplib to %s", to_email)
-                return RETURN_CODES['EX_PROTOCOL']
-            except Exception as e:
-                log.exception("Smtplib error %s", e)
-                return RETURN_CODES['EX_UNAVAILABLE']
+            return method(*args)
+        except sqlite3.Error as e:
+            log.error("Error in %s: %s", method.im_self.path, e)
+            return None
+
+    def release_claims(self, message_id, role_email, claimed, accepted):
+        """ Release the claims of `role_email` on the `claimed` recipients
+        that are not in `accepted` """
+        accepted = set(normalize_address(email) for email in accepted)
+        failed = [email for email in claimed
+                  if normalize_address(email) not in accepted]
+        if failed and self._store(self.delivered_set.release, message_id,
+                                  role_email, failed):
+            log.info("%s: released %d members for the other roles",
+                     message_id, len(failed))
+
+    def recipient_plan(self, role):
+        """ An empty `RecipientPlan` with the batch settings of `role` and
+        the limits of the transport """
+        return RecipientPlan(self.role_batch_sizes.get(role, self.batch_size),
+                             self.transport.max_batch_bytes,
+                             self.group_by_domain)
+
+    def log_plan(self, role_email, plan):
+        """ Show the recipient plan in debug mode (-t) """
+        lines = plan.describe()
+        log.info("Recipient plan for %s: %s", role_email, lines[0])
+        for line in lines[1:]:
+            log.debug(line)
+
+    def send_batches(self, from_email, email_batches, content,
+                     delivered=None, deadline=None):
+        """ Send `content` to every batch of addresses, concurrently when
+        `max_concurrency` allows it. Returns the error of the first batch
+        that failed. Batches over the rate limit of their domain are
+        paced until `deadline` (shared by all the batches of a message),
+        or deferred (EX_TEMPFAIL). When all batches ran, `delivered` is
+        called with the recipients of the accepted ones.
+        """
+        accepted = []
+        if self.throttle and deadline is None:
+            deadline = self.throttle.deadline()
+
+        def send(emails):
+            if self.throttle and not self.throttle.acquire(emails, deadline):
+                return RETURN_CODES['EX_TEMPFAIL']
+            retval = self.send_emails(from_email, emails, content)
+            if retval != RETURN_CODES['EX_OK']:
+                log.error("Error %s while sending to %s", retval, emails)
+            else:
+                accepted.extend(emails)
+            return retval
+        try:
+            return self.dispatcher.dispatch(send, email_batches)
         finally:
-            try:
-                smtp.quit()
-            except Exception:
-                pass
-
-        return RETURN_CODES['EX_OK']
+            if delivered is not None and accepted:
+                delivered(accepted)
 
     def send_emails(self, from_email, emails, content):
-        """ Use /usr/bin/sendmail or fallback to smtplib.
+        """ Send `content` to `emails` with the configured transport
+        (sendmail, smtp, lmtp or maildir).
 
         """
         if len(emails) == 0:  # Nobody to send to - it happens
             return RETURN_CODES['EX_OK']
-        try:
-            # This should be secure check:
-            # http://docs.python.org/library/subprocess.html
-            # #using-the-subprocess-module
-            # It turns out that sendmail splits the addresses on space,
-            # eventhough there is one address per argument. See RFC5322 section
-            # 3.4 Try: /usr/sbin/sendmail 'test @envcoord.health.fgov.be' and
-            # it will complain about the address. We therefore clean them with
-            # smtplib.quoteaddr
-            quotedemails = map(smtplib.quoteaddr, emails)
-            ps = Popen([self.sendmail_path,
-                        '-f',
-                        smtplib.quoteaddr(from_email),
-                        '--'] + quotedemails,
-                       stdin=PIPE)
-            ps.stdin.write(content)
-            ps.stdin.flush()
-            ps.stdin.close()
-            return_code = ps.wait()
-            if return_code in (RETURN_CODES['EX_OK'],
-                               RETURN_CODES['EX_TEMPFAIL']):
-                log.debug("Sent emails to %r", emails)
-                return RETURN_CODES['EX_OK']
-            else:
-                log.error("Failed to send emails using sendmail to %r. "
-                          "/usr/sbin/sendmail exited with code %d", emails,
-                          return_code)
-            return return_code
-        except (OSError, IOError):  # fallback to smtplib
-            # Since this is the same mailer we use localhost
-            # Smtplib quotes the addresses internally
-            log.exception("Cannot use sendmail program. Falling back to "
-                          "smtplib.")
-            log.warning(
-                "If the smtp connection fails some emails will be lost")
-            smtp = smtplib.SMTP('localhost')
-            try:
-                try:
-                    smtp.sendmail(from_email, emails, content)
-                    log.debug("Sent emails to %r", emails)
-                except smtplib.SMTPException:
-                    log.exception("SMTP Error")
-                    log.error(
-                        "Failed to send emails using smtplib to %r", emails)
-                    return RETURN_CODES['EX_PROTOCOL']
-                except Exception as e:
-                    log.exception("Smtplib error %s" % e)
-                    return RETURN_CODES['EX_UNAVAILABLE']
-            finally:
-                try:
-                    smtp.quit()
-                except Exception:
-                    pass
-            return RETURN_CODES['EX_OK']
+        return self.transport.send(from_email, emails, content)
 
-    def write_to_archive(self, from_email, content):
+    def write_to_archive(self, from_email, content, role=None):
         """ Write the email to a MBOX file. (mailbox only does read-only in Python 2.4)
         The lockf call can return IOError, which we abort to writing on
         It is more important that we send the email than we save the message
+
+        With an `archive_spool` the message is only spooled, the archiver
+        appends it later. With an `archive_dir` it is appended to the shard
+        of `role` for this month.
         """
-        if self.archivefile is None:
+        if self.archivefile is None and self.archive is None:
             return  # No mailbox to write to
+        if self.archive_spool is not None:
+            try:
+                self.archive_spool.put(from_email, content, role)
+                return
+            except (IOError, OSError) as e:
+                log.error("Unable to spool the archive copy to %s: %s",
+                          self.archive_spool.path, e)
+        if self.archive is not None:
+            try:
+                self.archive.append([(from_email, role, time.time(),
+                                      content)])
+            except (IOError, OSError, sqlite3.Error) as e:
+                log.error("Unable to write to archive %s: %s",
+                          self.archive.path, e)
+            return
         try:
             mboxfd = open(self.archivefile, 'ab')
         except IOError as e:
@@ -725,7 +839,8 @@ class Expander(object):
             # except IOError, e:
             #     if e.errno in (errno.EAGAIN, errno.EACCES): ...
             mboxfd.write('From ' + from_email + '  ' + time.asctime() + '\n')
-            mboxfd.write(content)
+            for data in message_chunks(content):
+                mboxfd.write(data)
             mboxfd.write('\n')
             fcntl.lockf(mboxfd, fcntl.LOCK_UN)
         except Exception as e:
@@ -743,9 +858,405 @@ def usage():
     sys.exit(RETURN_CODES['EX_USAGE'])
 
 
+def setup_logging(logfile, debug_mode=False):
+    """ Log to `logfile` (a path or `syslog`); only log to the console in
+    debug mode """
+    if debug_mode:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.removeHandler(stream_handler)
+
+    if logfile is not None:
+        if logfile == 'syslog':
+            log_handler = SysLogHandler('/dev/log',
+                                        facility=SysLogHandler.LOG_LOCAL6)
+            formatter = logging.Formatter(
+                "%(name)s: %(levelname)s - %(message)s")
+            log_handler.setFormatter(formatter)
+        else:
+            log_handler = logging.FileHandler(logfile, 'a')
+            formatter = logging.Formatter(
+                "%(asctime)s - %(levelname)s - %(message)s")
+            log_handler.setFormatter(formatter)
+        if not debug_mode:
+            log.setLevel(logging.INFO)
+        log.addHandler(log_handler)
+
+
+def read_config(config_file):
+    config = ConfigParser()
+    config.read([config_file])
+    return config
+
+
+def archive_command(argv):
+    """ Append the spooled archive copies to the archive, once or every
+    `-i` seconds until stopped, compress the shards of past months or
+    print the archived copies of a message (of role `-r`).
+
+    roleexpander archive -c config-file [-i interval] [flush]
+    roleexpander archive -c config-file rotate
+    roleexpander archive -c config-file [-r role] find message-id
+
+    """
+    try:
+        opts, args = getopt.getopt(argv, "c:i:r:")
+        opts = dict(opts)
+        config = read_config(opts['-c'])
+        expander_config = dict(config.items('expander'))
+    except (getopt.GetoptError, KeyError, NoSectionError):
+        print("%s archive -c [config-file] [-i interval] [-r role] "
+              "[flush|rotate|find message-id]" % sys.argv[0])
+        return RETURN_CODES['EX_USAGE']
+    action = args and args[0] or 'flush'
+    setup_logging(expander_config.get('log'))
+
+    if action in ('find', 'rotate'):
+        if not expander_config.get('archive_dir', '').strip():
+            log.error("No archive_dir configured in the [expander] section")
+            return RETURN_CODES['EX_CONFIG']
+        archive = archive_store_from_config(expander_config)
+        if action == 'rotate':
+            print("Compressed %d shards" % archive.rotate())
+            return RETURN_CODES['EX_OK']
+        if len(args) != 2:
+            print("%s archive -c [config-file] [-r role] find message-id"
+                  % sys.argv[0])
+            return RETURN_CODES['EX_USAGE']
+        entries = archive.find(args[1], opts.get('-r'))
+        if not entries:
+            log.error("%s is not in the archive", args[1])
+            return RETURN_CODES['EX_NOINPUT']
+        for entry in entries:
+            sys.stdout.write(from_line(entry['sender'], entry['date']))
+            for data in message_chunks(archive.read(entry)):
+                sys.stdout.write(data)
+            sys.stdout.write('\n')
+        return RETURN_CODES['EX_OK']
+
+    archive = archive_from_config(expander_config)
+    if archive is None:
+        log.error("No archive_spool and mailbox or archive_dir configured "
+                  "in the [expander] section")
+        return RETURN_CODES['EX_CONFIG']
+
+    if action != 'flush':
+        log.error("Unknown archive action %r", action)
+        return RETURN_CODES['EX_USAGE']
+    if '-i' not in opts:
+        print("Archived %d messages" % archive.flush())
+        return RETURN_CODES['EX_OK']
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+    try:
+        archive.run(float(opts['-i']), lambda: bool(stopping))
+    except KeyboardInterrupt:
+        pass
+    # Whatever was spooled until now
+    archive.flush()
+    return RETURN_CODES['EX_OK']
+
+
+def bounces_command(argv):
+    """ Send the bounce digests that are due, every `-i` seconds until
+    stopped, or all of them now (`flush`); inspect or purge the store.
+
+    roleexpander bounces -c config-file [-i interval] [flush|stats|purge]
+
+    """
+    try:
+        opts, args = getopt.getopt(argv, "c:i:")
+        opts = dict(opts)
+        expander_config = dict(read_config(opts['-c']).items('expander'))
+    except (getopt.GetoptError, KeyError, NoSectionError):
+        print("%s bounces -c [config-file] [-i interval] "
+              "[flush|stats|purge]" % sys.argv[0])
+        return RETURN_CODES['EX_USAGE']
+    action = args and args[0] or 'flush'
+    setup_logging(expander_config.get('log'))
+
+    store = bounce_store_from_config(expander_config)
+    if store is None:
+        log.error("No bounce_digest_path configured in the [expander] "
+                  "section")
+        return RETURN_CODES['EX_CONFIG']
+
+    if action == 'stats':
+        for name, value in sorted(store.stats().items()):
+            print("%s: %s" % (name, value))
+        return RETURN_CODES['EX_OK']
+    if action == 'purge':
+        print("Removed %d bounces" % store.purge())
+        return RETURN_CODES['EX_OK']
+    if action != 'flush':
+        log.error("Unknown bounces action %r", action)
+        return RETURN_CODES['EX_USAGE']
+
+    target = (expander_config.get('bounce_send_to', '').strip() or
+              expander_config.get('no_owner_send_to', '').strip())
+    if not target:
+        log.error("The configuration misses bounce_send_to / "
+                  "no_owner_send_to for the bounce digests")
+        return RETURN_CODES['EX_CONFIG']
+    noreply = expander_config.get('no_reply',
+                                  'no-reply@envcoord.health.fgov.be')
+    transport = transport_from_config(expander_config)
+    try:
+        if '-i' not in opts:
+            print("Sent %d digests" % send_digests(
+                store, transport.send, noreply, target, interval=0))
+            return RETURN_CODES['EX_OK']
+        stopping = []
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: stopping.append(1))
+        try:
+            while not stopping:
+                try:
+                    send_digests(store, transport.send, noreply, target)
+                except sqlite3.Error as e:
+                    log.error("Error in %s: %s", store.path, e)
+                time.sleep(float(opts['-i']))
+        except KeyboardInterrupt:
+            pass
+        return RETURN_CODES['EX_OK']
+    finally:
+        transport.close()
+
+
+def store_command(argv, command, section, store_from_config, option,
+                  what, actions=None):
+    """ Inspect or clean up the store of a `roleexpander` command: `stats`
+    prints its counters, `expire` and `purge` remove the expired or all of
+    `what` (entries, claims...). `actions` maps more actions to functions
+    of the store. """
+    actions = actions or {}
+    names = ['stats'] + sorted(actions) + ['expire', 'purge']
+    try:
+        opts, args = getopt.getopt(argv, "c:")
+        config_file = dict(opts)['-c']
+    except (getopt.GetoptError, KeyError):
+        print("%s %s -c [config-file] [%s]"
+              % (sys.argv[0], command, '|'.join(names)))
+        return RETURN_CODES['EX_USAGE']
+    action = args and args[0] or 'stats'
+
+    store = store_from_config(dict(read_config(config_file).items(section)))
+    if store is None:
+        log.error("No %s configured in the [%s] section", option, section)
+        return RETURN_CODES['EX_CONFIG']
+
+    if action == 'stats':
+        for name, value in sorted(store.stats().items()):
+            print("%s: %s" % (name, value))
+    elif action == 'expire':
+        print("Removed %d expired %s" % (store.purge(expired_only=True),
+                                         what))
+    elif action == 'purge':
+        print("Removed %d %s" % (store.purge(expired_only=False), what))
+    elif action in actions:
+        actions[action](store)
+    else:
+        log.error("Unknown %s action %r", command, action)
+        return RETURN_CODES['EX_USAGE']
+    return RETURN_CODES['EX_OK']
+
+
+def _print_keys(cache):
+    for key in cache.keys():
+        print(key)
+
+
+def cache_command(argv):
+    """ Inspect or purge the LDAP cache configured in the [ldap] section.
+
+    roleexpander cache -c config-file [stats|keys|expire|purge]
+
+    """
+    return store_command(argv, 'cache', 'ldap', cache_from_config,
+                         'cache_path', 'entries', {'keys': _print_keys})
+
+
+def dedupe_command(argv):
+    """ Show how many deliveries were suppressed between roles, or
+    expire/purge the claims.
+
+    roleexpander dedupe -c config-file [stats|expire|purge]
+
+    """
+    return store_command(argv, 'dedupe', 'expander',
+                         delivered_set_from_config, 'dedupe_path', 'claims')
+
+
+def journal_command(argv):
+    """ Inspect or purge the delivery journal of the [expander] section.
+
+    roleexpander journal -c config-file [stats|expire|purge]
+
+    """
+    return store_command(argv, 'journal', 'expander', journal_from_config,
+                         'journal_path', 'messages')
+
+
+def throttle_command(argv):
+    """ Show how often the domain rate limits kicked in, or reset them.
+
+    roleexpander throttle -c config-file [stats|reset]
+
+    """
+    try:
+        opts, args = getopt.getopt(argv, "c:")
+        config_file = dict(opts)['-c']
+    except (getopt.GetoptError, KeyError):
+        print("%s throttle -c [config-file] [stats|reset]" % sys.argv[0])
+        return RETURN_CODES['EX_USAGE']
+    action = args and args[0] or 'stats'
+
+    throttle = throttle_from_config(
+        dict(read_config(config_file).items('expander')))
+    if throttle is None:
+        log.error("No throttle_rates configured in the [expander] section")
+        return RETURN_CODES['EX_CONFIG']
+
+    if action == 'stats':
+        for domain, counters in sorted(throttle.stats().items()):
+            print("%s: %s" % (domain, ', '.join(
+                '%s %g' % item for item in sorted(counters.items()))))
+    elif action == 'reset':
+        throttle.reset()
+    else:
+        log.error("Unknown throttle action %r", action)
+        return RETURN_CODES['EX_USAGE']
+    return RETURN_CODES['EX_OK']
+
+
+def serve_command(argv):
+    """ Run as an LMTP server, Postfix delivers to it with the `lmtp`
+    transport. The [lmtp] section sets where to listen and how many
+    messages are expanded at the same time.
+
+    roleexpander serve -c config-file [-t]
+
+    """
+    from lmtpd import ExpanderPool, make_server
+    try:
+        opts, args = getopt.getopt(argv, "c:t")
+        opts = dict(opts)
+        config = read_config(opts['-c'])
+    except (getopt.GetoptError, KeyError):
+        print("%s serve -c [config-file] [-t]" % sys.argv[0])
+        return RETURN_CODES['EX_USAGE']
+
+    expander_config = dict(config.items('expander'))
+    ldap_config = dict(config.items('ldap'))
+    lmtp_config = {}
+    if config.has_section('lmtp'):
+        lmtp_config = dict(config.items('lmtp'))
+    setup_logging(expander_config.get('log'), '-t' in opts)
+
+    def factory():
+        return Expander(LdapAgent(**ldap_config), **expander_config)
+
+    pool = ExpanderPool(factory, lmtp_config.get('workers', 4))
+    listen = lmtp_config.get('listen', '127.0.0.1:2424').strip()
+    server = make_server(listen, pool,
+                         int(lmtp_config.get('socket_mode', '0666'), 8),
+                         expander_config.get('message_max_memory',
+                                             SPOOL_MAX_SIZE))
+    # SIGTERM stops the server like ^C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("Serving LMTP on %s", listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return RETURN_CODES['EX_OK']
+
+
+def _spool_worker(spool_config, expander_config, ldap_config):
+    """ Body of a `roleexpander worker` process """
+    from spool import spool_from_config, work
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles ^C
+    expander = Expander(LdapAgent(**ldap_config), **expander_config)
+    work(spool_from_config(spool_config), expander,
+         float(spool_config.get('poll_interval', 5)),
+         should_stop=lambda: bool(stopping))
+
+
+def worker_command(argv):
+    """ Expand the messages spooled by the pipe entry point (see the [spool]
+    section) with a pool of worker processes.
+
+    roleexpander worker -c config-file [-n processes] [-t]
+
+    """
+    from multiprocessing import Process, cpu_count
+    from spool import spool_from_config
+    try:
+        opts, args = getopt.getopt(argv, "c:n:t")
+        opts = dict(opts)
+        config = read_config(opts['-c'])
+        spool_config = dict(config.items('spool'))
+    except (getopt.GetoptError, KeyError, NoSectionError):
+        print("%s worker -c [config-file] [-n processes] [-t]"
+              % sys.argv[0])
+        return RETURN_CODES['EX_USAGE']
+
+    expander_config = dict(config.items('expander'))
+    ldap_config = dict(config.items('ldap'))
+    setup_logging(expander_config.get('log'), '-t' in opts)
+    processes = int(opts.get('-n', spool_config.get('workers', 0)) or
+                    cpu_count())
+
+    recovered = spool_from_config(spool_config).recover()
+    if recovered:
+        log.info("Put back %d messages claimed by previous workers",
+                 recovered)
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+    workers = []
+    log.info("Starting %d spool workers", processes)
+    try:
+        while not stopping:
+            workers = [worker for worker in workers if worker.is_alive()]
+            while len(workers) < processes:
+                worker = Process(target=_spool_worker, args=(
+                    spool_config, expander_config, ldap_config))
+                worker.start()
+                workers.append(worker)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+    return RETURN_CODES['EX_OK']
+
+
+COMMANDS = {
+    'archive': archive_command,
+    'bounces': bounces_command,
+    'cache': cache_command,
+    'dedupe': dedupe_command,
+    'journal': journal_command,
+    'serve': serve_command,
+    'throttle': throttle_command,
+    'worker': worker_command,
+}
+
+
 def main():
     # Don't return log to output when in mailer
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     try:  # Handle cmd arguments
         opts, args = getopt.getopt(sys.argv[1:], "c:r:f:l:o:t")
     except getopt.GetoptError:
@@ -756,6 +1267,7 @@ def main():
     # sendmail_path = ''
     debug_mode = False
     expander_config = {}
+    spool_config = {}
     try:
         opts = dict(opts)
         from_email = opts['-f']
@@ -763,11 +1275,12 @@ def main():
         if role_email in IGNORE_LIST:
             return RETURN_CODES['EX_NOUSER']
         if '-c' in opts:
-            config = ConfigParser()
-            config.read([opts['-c']])
+            config = read_config(opts['-c'])
             logfile = opts.get('-o', config.get('expander', 'log'))
             expander_config = dict(config.items('expander'))
             ldap_config = dict(config.items('ldap'))
+            if config.has_section('spool'):
+                spool_config = dict(config.items('spool'))
         else:
             ldap_config['ldap_server'] = opts['-l']
             logfile = opts.get('-o')
@@ -778,49 +1291,49 @@ def main():
     except KeyError:
         usage()
 
-    if debug_mode:
-        log.setLevel(logging.DEBUG)
-    else:
-        log.removeHandler(stream_handler)
-
-    if logfile is not None:
-        if logfile == 'syslog':
-            log_handler = SysLogHandler('/dev/log',
-                                        facility=SysLogHandler.LOG_LOCAL6)
-            formatter = logging.Formatter(
-                "%(name)s: %(levelname)s - %(message)s")
-            log_handler.setFormatter(formatter)
-        else:
-            log_handler = logging.FileHandler(logfile, 'a')
-            formatter = logging.Formatter(
-                "%(asctime)s - %(levelname)s - %(message)s")
-            log_handler.setFormatter(formatter)
-        if not debug_mode:
-            log.setLevel(logging.INFO)
-        log.addHandler(log_handler)
+    setup_logging(logfile, debug_mode)
 
     log.debug("=========== starting rolesmailer ============")
     try:
         # Message body + headers come from raw_input. Make sure they stay
-        # untouched
+        # untouched. They are kept in memory up to `message_max_memory` bytes,
+        # in a temporary file above that
         content = ""
         if not debug_mode:
-            while True:
-                buffer = sys.stdin.read()
-                if not buffer:
-                    break
-                content += buffer
+            content = SpooledMessage.from_file(
+                sys.stdin,
+                expander_config.get('message_max_memory', SPOOL_MAX_SIZE))
 
-        # Open connection with the ldap
+        # Leave the expansion to the `roleexpander worker` processes
+        if spool_config and not debug_mode:
+            from spool import spool_from_config
+            try:
+                name = spool_from_config(spool_config).put(
+                    from_email, role_email, content)
+            except (IOError, OSError) as e:
+                log.error("Cannot spool the message to %s; %s",
+                          role_email, e)
+                return RETURN_CODES['EX_TEMPFAIL']
+            log.info("Spooled %s from %s to %s", name, from_email,
+                     role_email)
+            return RETURN_CODES['EX_OK']
+
+        # The agent connects and binds on its first query
         try:
             agent = LdapAgent(**ldap_config)
         except Exception as e:
-            log.error("Cannot connect to LDAP %s; %s" % (
+            log.error("Cannot set up LDAP %s; %s" % (
                 ldap_config['ldap_server'], e))
             return RETURN_CODES['EX_TEMPFAIL']
 
         expander = Expander(agent, **expander_config)
-        return expander.expand(from_email, role_email, content, debug_mode)
+        try:
+            return expander.expand(from_email, role_email, content,
+                                   debug_mode)
+        finally:
+            expander.transport.close()
+            log.debug("Transport %s: %r", expander.transport.name,
+                      expander.transport.stats())
     except Exception as e:
         log.exception(e)
         return RETURN_CODES['EX_SOFTWARE']
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+""" Rewriting the header block of a message without touching its body.
+
+The expander only changes a few headers of the messages it sends. Parsing
+the whole MIME tree and generating it again costs time on large posts and
+may re-encode the body, so `read_headers` reads the header block alone
+(split like the `email` package does) and the body is spliced back from
+the original message, byte for byte (see `message.splice`).
+
+Headers that are not changed are written back exactly as they came, with
+their folding; new values get the line endings of the message.
+
+"""
+from message import message_lines
+import re
+
+__version__ = """$Id$"""
+
+# A header line, or the continuation of one (`email.feedparser.headerRE`)
+HEADER_RE = re.compile(r'^(From |[\041-\071\073-\176]+:|[\t ])')
+NEWLINE_RE = re.compile(r'\r\n|\r|\n')
+
+
+class HeaderBlock(object):
+    """ The headers of a message, in order, with the mapping methods of
+    `email.message.Message` the expander uses. Values are returned like
+    `Message.get` does: unfolded lines are kept, the line end is not. """
+
+    def __init__(self, eol='\n'):
+        self.eol = eol
+        self.separator = eol
+        self._fields = []  # [name, raw lines]
+
+    def _append_line(self, line):
+        if line[0] in ' \t':
+            if self._fields:
+                self._fields[-1][1].append(line)
+            return
+        # A misplaced From_ line has no name, it is kept as it is
+        colon = line.find(':')
+        self._fields.append([colon > 0 and line[:colon] or '', [line]])
+
+    def _value(self, lines):
+        first = lines[0]
+        return (first[first.find(':') + 1:].lstrip() +
+                ''.join(lines[1:])).rstrip('\r\n')
+
+    def _raw(self, name, value):
+        value = NEWLINE_RE.sub(self.eol, value)
+        return ['%s: %s%s' % (name, value, self.eol)]
+
+    def get(self, name, failobj=None):
+        name = name.lower()
+        for field, lines in self._fields:
+            if field.lower() == name:
+                return self._value(lines)
+        return failobj
+
+    def get_all(self, name, failobj=None):
+        name = name.lower()
+        values = [self._value(lines) for field, lines in self._fields
+                  if field.lower() == name]
+        return values or failobj
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        """ Add a header at the end, like `Message.__setitem__` """
+        self._fields.append([name, self._raw(name, value)])
+
+    add_header = __setitem__
+
+    def __delitem__(self, name):
+        """ Remove every `name` header, missing ones are ignored """
+        name = name.lower()
+        self._fields = [field for field in self._fields
+                        if field[0].lower() != name]
+
+    def replace_header(self, name, value):
+        """ Replace the first `name` header in place, raises KeyError """
+        lower = name.lower()
+        for field in self._fields:
+            if field[0].lower() == lower:
+                field[1] = self._raw(field[0], value)
+                return
+        raise KeyError(name)
+
+    def keys(self):
+        return [field for field, lines in self._fields if field]
+
+    def items(self):
+        return [(field, self._value(lines)) for field, lines in self._fields
+                if field]
+
+    def as_string(self):
+        """ The header block and the line separating it from the body """
+        return ''.join(line for field, lines in self._fields
+                       for line in lines) + self.separator
+
+
+def read_headers(content):
+    """ Parse the header block of `content` (a string or `SpooledMessage`).
+    Returns the `HeaderBlock` and the offset of the body. A unix From_ line
+    at the start is dropped, like `Message.as_string` does. """
+    headers = None
+    offset = 0
+    for number, line in enumerate(message_lines(content)):
+        if headers is None:
+            eol = line[len(line.rstrip('\r\n')):] or '\n'
+            headers = HeaderBlock(eol)
+        if not HEADER_RE.match(line):
+            if line in ('\n', '\r\n', '\r'):
+                offset += len(line)
+                headers.separator = line
+            break
+        offset += len(line)
+        if number == 0 and line.startswith('From '):
+            continue
+        headers._append_line(line)
+    return headers or HeaderBlock(), offset
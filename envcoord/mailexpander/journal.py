@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+""" Delivery journal: which recipients already got a message.
+
+When a batch fails the expander returns a temporary error and Postfix
+tries the whole message again later. The journal remembers, by Message-Id
+and role, the recipients whose batches were accepted and whether the
+message was archived, so the retry only sends to the rest. Entries expire
+after `ttl` seconds (by default the 5 days Postfix keeps retrying).
+
+"""
+from plan import normalize_address
+from store import COUNTERS_SCHEMA, SqliteStore
+import time
+
+__version__ = """$Id$"""
+
+
+class DeliveryJournal(SqliteStore):
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS messages ('
+        ' message_id TEXT, role TEXT, created REAL, archived INTEGER,'
+        ' PRIMARY KEY (message_id, role))',
+        'CREATE INDEX IF NOT EXISTS messages_created ON messages (created)',
+        'CREATE TABLE IF NOT EXISTS recipients ('
+        ' message_id TEXT, role TEXT, recipient TEXT,'
+        ' PRIMARY KEY (message_id, role, recipient))',
+        COUNTERS_SCHEMA,
+    )
+
+    def __init__(self, path, ttl=5 * 24 * 3600, timeout=30):
+        super(DeliveryJournal, self).__init__(path, timeout)
+        self.ttl = float(ttl)
+
+    def _expire(self, conn):
+        expired = ('SELECT message_id, role FROM messages WHERE created < ?',
+                   (time.time() - self.ttl,))
+        rows = conn.execute(*expired).fetchall()
+        for row in rows:
+            conn.execute('DELETE FROM recipients WHERE message_id = ? AND '
+                         'role = ?', row)
+            conn.execute('DELETE FROM messages WHERE message_id = ? AND '
+                         'role = ?', row)
+        return len(rows)
+
+    def start(self, message_id, role):
+        """ Open the entry of a message (expiring old ones). Returns the
+        recipients it was already delivered to and if it was archived. """
+        with self.transaction() as conn:
+            self._expire(conn)
+            row = conn.execute('SELECT archived FROM messages WHERE '
+                               'message_id = ? AND role = ?',
+                               (message_id, role)).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO messages VALUES (?, ?, ?, 0)',
+                             (message_id, role, time.time()))
+                return set(), False
+            delivered = set(recipient for (recipient,) in conn.execute(
+                'SELECT recipient FROM recipients WHERE message_id = ? AND '
+                'role = ?', (message_id, role)))
+            self._count(conn, 'retries')
+            self._count(conn, 'skipped', len(delivered))
+        return delivered, bool(row[0])
+
+    def delivered(self, message_id, role, recipients):
+        """ Record that `recipients` accepted the message """
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO recipients VALUES (?, ?, ?)',
+                [(message_id, role, normalize_address(recipient))
+                 for recipient in recipients])
+
+    def archived(self, message_id, role):
+        with self.transaction() as conn:
+            conn.execute('UPDATE messages SET archived = 1 WHERE '
+                         'message_id = ? AND role = ?', (message_id, role))
+
+    def purge(self, expired_only=True):
+        """ Remove the expired (or all) entries, returns how many """
+        with self.transaction() as conn:
+            if expired_only:
+                return self._expire(conn)
+            removed = conn.execute('DELETE FROM messages').rowcount
+            conn.execute('DELETE FROM recipients')
+            self._reset_counters(conn)
+            return removed
+
+    def stats(self):
+        """ The number of messages and recipients journaled, how many
+        retries found earlier deliveries and how many recipients they
+        skipped """
+        conn = self.conn
+        stats = {'retries': 0, 'skipped': 0}
+        stats['messages'] = conn.execute(
+            'SELECT COUNT(*) FROM messages').fetchone()[0]
+        stats['recipients'] = conn.execute(
+            'SELECT COUNT(*) FROM recipients').fetchone()[0]
+        stats.update(self.counters())
+        return stats
+
+
+def journal_from_config(config):
+    """ Build the journal from the `journal_*` options of [expander].
+    Returns None when no `journal_path` is configured. """
+    path = config.get('journal_path', '').strip()
+    if not path:
+        return None
+    return DeliveryJournal(path, ttl=config.get('journal_ttl', 5 * 24 * 3600))
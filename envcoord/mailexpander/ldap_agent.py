@@ -1,11 +1,125 @@
 # -*- coding: utf-8 -*-
+from cache import cache_from_config
+from collections import deque
 from string import ascii_lowercase
 import ldap
 import ldap.filter
+import logging
 import re
+import sqlite3
 
 __version__ = """$Id$"""
 
+log = logging.getLogger('rolesexpander')
+
+
+def _config_flag(value):
+    """ Interpret a boolean option that may come as a string from the
+    ini file (`yes`, `true`, `on`, `1`) or as a plain python value.
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
+
+
+def _config_attrs(value):
+    """ Turn a comma separated list of ldap attributes from the ini file
+    into an attribute list for `search_s`. `None` (the default) fetches
+    whole entries.
+    """
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        value = value.split(',')
+    value = [attr.strip() for attr in value if attr.strip()]
+    return value or None
+
+
+class LazyRole(dict):
+    """ The attributes of a role, where some keys (`members_data`,
+    `owners_data`) are computed by a resolver the first time they are read.
+    Checking for such a key with `in` doesn't resolve it.
+
+    Note that `dict(role)` only copies the keys resolved so far, use
+    `role.copy()` to get everything.
+
+    """
+
+    def __init__(self, attrs, resolvers):
+        dict.__init__(self, attrs)
+        self._resolvers = dict(resolvers)
+
+    def _resolve(self, key):
+        resolver = self._resolvers.pop(key, None)
+        if resolver is not None:
+            dict.__setitem__(self, key, resolver())
+
+    def _resolve_all(self):
+        for key in list(self._resolvers):
+            self._resolve(key)
+
+    def is_resolved(self, key):
+        return key not in self._resolvers
+
+    def __getitem__(self, key):
+        self._resolve(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._resolvers.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._resolvers.pop(key, None) is None:
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._resolvers or dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        self._resolve(key)
+        return dict.get(self, key, default)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._resolvers)
+
+    def keys(self):
+        return dict.keys(self) + list(self._resolvers)
+
+    def items(self):
+        self._resolve_all()
+        return dict.items(self)
+
+    def values(self):
+        self._resolve_all()
+        return dict.values(self)
+
+    def iteritems(self):
+        self._resolve_all()
+        return dict.iteritems(self)
+
+    def copy(self):
+        self._resolve_all()
+        return dict(self)
+
+    def __eq__(self, other):
+        self._resolve_all()
+        if isinstance(other, LazyRole):
+            other._resolve_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._resolve_all()
+        return dict.__repr__(self)
+
 
 class LdapAgent(object):
     def __init__(self, **config):
@@ -13,10 +127,11 @@ class LdapAgent(object):
         if not (self.ldap_server.startswith('ldap://') or
                 self.ldap_server.startswith('ldaps://')):
             self.ldap_server = 'ldaps://' + self.ldap_server
-        self.conn = self.connect()
-        self.conn.protocol_version = ldap.VERSION3
-        self.conn.simple_bind_s(config['user_dn'].strip(),
-                                config['user_pw'].strip())
+        # The connection is opened and bound on the first query, so paths
+        # that don't need the directory (bounces, cache hits) never touch it
+        self._conn = None
+        self._bind_dn = config['user_dn'].strip()
+        self._bind_pw = config['user_pw'].strip()
         self._encoding = config.get('encoding', 'utf-8')
         self._user_dn_suffix = config.get(
             'users_dn',
@@ -24,12 +139,56 @@ class LdapAgent(object):
         self._role_dn_suffix = config.get(
             'roles_dn',
             'ou=DATA,ou=america,o=IRCroles,dc=CIRCA,dc=local')
+        # Resolve role members with a few chunked (uid=...) searches
+        # instead of one base search per uniqueMember
+        self._bulk_lookup = _config_flag(config.get('bulk_lookup', False))
+        self._bulk_chunk_size = int(config.get('bulk_chunk_size', 100))
+        # How many searches may be outstanding on the connection at once
+        self._pipeline_window = int(config.get('pipeline_window', 1))
+        # How members of filtered subroles are found: `uniquemember` searches
+        # the subroles, `memberof` reads the memberOf attribute of the
+        # members (needs the memberOf overlay)
+        self._filter_mode = config.get('filter_mode', 'uniquemember')
+        self._filter_mode = self._filter_mode.strip().lower()
+        # Only fetch the attributes we actually use, e.g. `mail` for users
+        self._member_attrs = _config_attrs(config.get('member_attrs'))
+        if self._filter_mode == 'memberof':
+            # memberOf is operational, it must be asked for explicitly
+            self._member_attrs = (self._member_attrs or ['*']) + ['memberOf']
+        self._owner_attrs = _config_attrs(config.get('owner_attrs'))
+        self._role_attrs = _config_attrs(config.get('role_attrs'))
+        # Optional on-disk cache shared between expander invocations
+        self._cache = cache_from_config(config)
+        # Entries already fetched while handling the current message
+        self.reset_lookups()
 
     def connect(self):
         conn = ldap.initialize(self.ldap_server)
         conn.protocol_version = ldap.VERSION3
         return conn
 
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = self.connect()
+            conn.protocol_version = ldap.VERSION3
+            conn.simple_bind_s(self._bind_dn, self._bind_pw)
+            self._conn = conn
+        return self._conn
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    def disconnect(self):
+        """ Drop the connection, the next query opens a new one """
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.unbind_s()
+            except Exception:
+                pass  # The connection is probably gone already
+
     def _ancestor_roles_dn(self, role_dn):
         """
         Given a subrole dn, returns a list of all ancestors. First is
@@ -61,9 +220,214 @@ class LdapAgent(object):
 
         return ancestors
 
-    def _query(self, dn):
+    def reset_lookups(self):
+        """ Forget the entries fetched so far and reset the lookup
+        counters. Called at the start of every expansion. """
+        self._entries = {}
+        self.lookup_stats = {'queries': 0, 'saved': 0}
+
+    def _remember(self, dn, attrlist, attrs):
+        self._entries[dn.lower()] = (attrlist, attrs)
+
+    def _recall(self, dn, attrlist):
+        """ Returns the already fetched entry for `dn` if it holds all
+        the attributes in `attrlist`, otherwise None """
+        known = self._entries.get(dn.lower())
+        if known is None:
+            return None
+        known_attrlist, attrs = known
+        if known_attrlist is not None and (
+                attrlist is None or not set(attrlist) <= set(known_attrlist)):
+            return None
+        self.lookup_stats['saved'] += 1
+        return attrs
+
+    def _search(self, base, scope, filterstr=None, attrlist=None):
+        """ `search_s` that only passes the filter and attribute list
+        along when they are set """
+        self.lookup_stats['queries'] += 1
+        kwargs = {}
+        if filterstr is not None:
+            kwargs['filterstr'] = filterstr
+        if attrlist is not None:
+            kwargs['attrlist'] = attrlist
+        return self.conn.search_s(base, scope, **kwargs)
+
+    def _cache_get(self, key):
+        """ The cached value of `key`, or None. A broken cache (locked,
+        corrupt or not writable) is logged and skipped, LDAP answers. """
+        if self._cache is None:
+            return None
+        try:
+            return self._cache.get(key)
+        except (sqlite3.Error, EnvironmentError) as e:
+            log.error("Error in the LDAP cache %s: %s", self._cache.path, e)
+            return None
+
+    def _cache_set(self, key, value):
+        if self._cache is None:
+            return
+        try:
+            self._cache.set(key, value)
+        except (sqlite3.Error, EnvironmentError) as e:
+            log.error("Error in the LDAP cache %s: %s", self._cache.path, e)
+
+    def _cached(self, key, fetch):
+        """ Return the cached value for `key`, calling `fetch` and storing
+        its result on a miss. Nothing is stored when `fetch` raises: a role
+        whose members could not all be looked up must not be cached as a
+        smaller one, the next message tries LDAP again. """
+        value = self._cache_get(key)
+        if value is None:
+            value = fetch()
+            self._cache_set(key, value)
+        return value
+
+    def _query(self, dn, attrlist=None):
+        """ Fetch a user entry. Without `attrlist` the configured
+        `member_attrs` are fetched. """
+        if attrlist is None:
+            attrlist = self._member_attrs
+        attrs = self._recall(dn, attrlist)
+        if attrs is None:
+            attrs = self._cached('_query:%s:%s' % (dn, attrlist),
+                                 lambda: self._fetch_entry(dn, attrlist))
+            self._remember(dn, attrlist, attrs)
+        return attrs
+
+    def _fetch_entry(self, dn, attrlist):
         # This query naively thinks that all searches return something
-        return self.conn.search_s(dn, ldap.SCOPE_BASE)[0][1]
+        return self._search(dn, ldap.SCOPE_BASE, attrlist=attrlist)[0][1]
+
+    def _search_many(self, requests):
+        """ Run several searches, each given as a (base, scope, filterstr,
+        attrlist) tuple. With a `pipeline_window` above 1 the searches are
+        sent with the asynchronous API, keeping up to that many requests
+        outstanding on the connection. Returns the results in the same order;
+        a search whose base doesn't exist gives the `NO_SUCH_OBJECT`
+        exception instead of a result. Any other error is raised: a timeout
+        or a failed bind must not pass for a missing entry.
+
+        """
+        results = []
+        if self._pipeline_window <= 1:
+            for base, scope, filterstr, attrlist in requests:
+                try:
+                    results.append(self._search(base, scope, filterstr,
+                                                attrlist))
+                except ldap.NO_SUCH_OBJECT as e:
+                    results.append(e)
+            return results
+
+        results = [None] * len(requests)
+        outstanding = deque()
+        position = 0
+        while position < len(requests) or outstanding:
+            while (position < len(requests) and
+                    len(outstanding) < self._pipeline_window):
+                base, scope, filterstr, attrlist = requests[position]
+                self.lookup_stats['queries'] += 1
+                msgid = self.conn.search_ext(
+                    base, scope, filterstr or '(objectClass=*)', attrlist)
+                outstanding.append((msgid, position))
+                position += 1
+            # The server works on all outstanding requests meanwhile, so
+            # collecting them in order doesn't serialize the round trips
+            msgid, index = outstanding.popleft()
+            try:
+                results[index] = self.conn.result3(msgid, all=1)[1]
+            except ldap.NO_SUCH_OBJECT as e:
+                results[index] = e
+        return results
+
+    def _fetch_entries(self, dns, attrlist):
+        """ Base search every DN in `dns`, returns a dictionary DN ->
+        attributes without the DNs that don't exist. Other errors are
+        raised. """
+        results = self._search_many(
+            [(dn, ldap.SCOPE_BASE, None, attrlist) for dn in dns])
+        found = {}
+        for dn, result in zip(dns, results):
+            if isinstance(result, Exception) or not result:
+                continue  # Ignore members that don't exist in ldap anymore
+            found[dn] = result[0][1]
+        return found
+
+    def _fetch_by_uid(self, dns, attrlist):
+        """ Fetch user entries in chunks with a single `(|(uid=a)(uid=b)...)`
+        filter per chunk. DNs outside `users_dn`, and those of a chunk whose
+        search found no base, fall back to a base search each.
+        """
+        found = {}
+        by_uid = {}
+        uids = []
+        others = []
+        for dn in dns:
+            try:
+                user_id = self._user_id(dn)
+            except AssertionError:
+                others.append(dn)
+                continue
+            if user_id.lower() not in by_uid:
+                uids.append(user_id.lower())
+            by_uid.setdefault(user_id.lower(), []).append(dn)
+
+        chunks = []
+        requests = []
+        for start in range(0, len(uids), self._bulk_chunk_size):
+            chunk = uids[start:start + self._bulk_chunk_size]
+            filterstr = '(|%s)' % ''.join(
+                [ldap.filter.filter_format('(uid=%s)', (uid,))
+                 for uid in chunk])
+            chunks.append(chunk)
+            requests.append((self._user_dn_suffix, ldap.SCOPE_ONELEVEL,
+                             filterstr, attrlist))
+        for chunk, result in zip(chunks, self._search_many(requests)):
+            if isinstance(result, Exception):
+                # Don't drop a whole chunk of members, look them up one by one
+                for uid in chunk:
+                    others.extend(by_uid[uid])
+                continue
+            for dn, attr in result:
+                rdn = dn.split(',', 1)[0]
+                user_id = rdn.split('=', 1)[-1].strip().lower()
+                for member_dn in by_uid.get(user_id, []):
+                    found[member_dn] = attr
+
+        found.update(self._fetch_entries(others, attrlist))
+        return found
+
+    def _query_many(self, dns, attrlist=None):
+        """ Resolve several user DNs using as few round trips as possible.
+        Entries already fetched for this message are reused, the rest are
+        fetched in chunks by uid (`bulk_lookup`) or with pipelined base
+        searches. Returns a dictionary DN -> attributes, DNs that don't
+        exist in ldap anymore are left out.
+
+        """
+        if attrlist is None:
+            attrlist = self._member_attrs
+        found = {}
+        missing = []
+        seen = set([''])  # Ignore empty DN attributes
+        for dn in dns:
+            if dn in seen:
+                continue
+            seen.add(dn)
+            attrs = self._recall(dn, attrlist)
+            if attrs is None:
+                missing.append(dn)
+            else:
+                found[dn] = attrs
+
+        if self._bulk_lookup:
+            fetched = self._fetch_by_uid(missing, attrlist)
+        else:
+            fetched = self._fetch_entries(missing, attrlist)
+        for dn, attrs in fetched.items():
+            self._remember(dn, attrlist, attrs)
+            found[dn] = attrs
+        return found
 
     def _role_dn(self, role_id):
         if role_id is None:
@@ -83,12 +447,66 @@ class LdapAgent(object):
         assert ',' not in user_id
         return user_id
 
+    def _is_user_dn(self, dn):
+        try:
+            self._user_id(dn)
+        except AssertionError:
+            return False
+        return True
+
+    def _normalize_dn(self, dn):
+        """ Lower case and strip the blanks around the RDNs so DNs coming
+        from different attributes can be compared """
+        return ','.join([bit.strip() for bit in dn.lower().split(',')])
+
     def _user_dn(self, user_id):
         assert ',' not in user_id
         return 'uid=' + user_id + ',' + self._user_dn_suffix
 
     def _role_info(self, query_dn):
-        result = self.conn.search_s(query_dn, ldap.SCOPE_BASE)
+        attrs = self._recall(query_dn, self._role_attrs)
+        if attrs is None:
+            attrs = self._cached('_role_info:' + query_dn,
+                                 lambda: self._fetch_role_info(query_dn))
+            self._remember(query_dn, self._role_attrs, attrs)
+        return attrs
+
+    def _roles_info(self, query_dns):
+        """ `_role_info` for several roles at once, e.g. all the ancestors
+        of a role. Returns the attributes in the same order as `query_dns`.
+        """
+        infos = {}
+        missing = []
+        for query_dn in query_dns:
+            attrs = self._recall(query_dn, self._role_attrs)
+            if attrs is None:
+                attrs = self._cache_get('_role_info:' + query_dn)
+            if attrs is None:
+                missing.append(query_dn)
+            else:
+                self._remember(query_dn, self._role_attrs, attrs)
+                infos[query_dn] = attrs
+
+        results = self._search_many(
+            [(query_dn, ldap.SCOPE_BASE, None, self._role_attrs)
+             for query_dn in missing])
+        for query_dn, result in zip(missing, results):
+            if isinstance(result, Exception):
+                raise result
+            attrs = self._single_entry(query_dn, result)
+            self._cache_set('_role_info:' + query_dn, attrs)
+            self._remember(query_dn, self._role_attrs, attrs)
+            infos[query_dn] = attrs
+
+        return [infos[query_dn] for query_dn in query_dns]
+
+    def _fetch_role_info(self, query_dn):
+        result = self._search(query_dn, ldap.SCOPE_BASE,
+                              attrlist=self._role_attrs)
+        return self._single_entry(query_dn, result)
+
+    def _single_entry(self, query_dn, result):
+        """ The attributes of the only entry of a base search result """
         try:
             assert len(result) == 1
             dn, attr = result[0]
@@ -102,34 +520,37 @@ class LdapAgent(object):
         """ Returns a dictionary describing the role `role_id`.
         Also return all the members and their emails
 
-        """
+        Only the role entry is fetched right away, `members_data` and
+        `owners_data` are resolved the first time they are used.
 
+        """
+        attr = self._cached('get_role:%s' % role_id,
+                            lambda: self._fetch_role(role_id))
+
+        def get_data(key, target_attr, attrlist):
+            def resolve():
+                data = self._cached(
+                    '%s:%s' % (target_attr, role_id),
+                    lambda: self._query_many(attr.get(key, []), attrlist))
+                # Owners and members get looked up again while checking
+                # the permitted senders, answer those from what we have
+                for dn, user_attrs in data.items():
+                    self._remember(dn, attrlist, user_attrs)
+                return data
+            return resolve
+
+        return LazyRole(attr, {
+            'members_data': get_data('uniqueMember', 'members_data',
+                                     self._member_attrs),
+            'owners_data': get_data('owner', 'owners_data',
+                                    self._owner_attrs or self._member_attrs),
+        })
+
+    def _fetch_role(self, role_id):
         query_dn = self._role_dn(role_id)
-        result = self.conn.search_s(query_dn, ldap.SCOPE_BASE)
-
-        try:
-            assert len(result) == 1
-            dn, attr = result[0]
-            assert dn.lower() == query_dn.lower()
-        except AssertionError:
-            raise ValueError
-
-        def get_data(data, key, target_attr):
-            return_attr = {}
-            if key in data:
-                for dn in data[key]:
-                    if dn == '':
-                        continue  # Ignore empty DN attributes
-                    try:
-                        return_attr[dn] = self._query(dn)
-                    except Exception:
-                        pass  # Ignore members that don't exist in ldap anymore
-            return {target_attr: return_attr}
-
-        attr.update(get_data(attr, 'uniqueMember', 'members_data'))
-        attr.update(get_data(attr, 'owner', 'owners_data'))
-
-        return attr
+        result = self._search(query_dn, ldap.SCOPE_BASE,
+                              attrlist=self._role_attrs)
+        return self._single_entry(query_dn, result)
 
     def filter_roles(
             self, pattern, prefix_dn=None,
@@ -143,8 +564,8 @@ class LdapAgent(object):
         query_dn = self._role_dn_suffix
         if prefix_dn:
             query_dn = prefix_dn + ',' + query_dn
-        result = self.conn.search_s(query_dn, ldap.SCOPE_SUBTREE,
-                                    filterstr=filterstr, attrlist=attrlist)
+        result = self._search(query_dn, ldap.SCOPE_SUBTREE,
+                              filterstr=filterstr, attrlist=attrlist)
 
         pattern = pattern.lower()
         for ch in pattern:
@@ -179,11 +600,30 @@ class LdapAgent(object):
         pattern = '(&(objectClass=person){0}(mail=%s))'.format(disabled_filter)
         query_filter = ldap.filter.filter_format(pattern, (query,))
 
-        result = self.conn.search_s(self._user_dn_suffix, ldap.SCOPE_ONELEVEL,
-                                    filterstr=query_filter)
+        result = self._search(self._user_dn_suffix, ldap.SCOPE_ONELEVEL,
+                              filterstr=query_filter)
         if result:
             return result[0][1]['uid'][0]
 
+    def users_with_email(self, email):
+        """ Returns the users under `users_dn` having `email` as one of
+        their e-mail addresses, as a dictionary of normalized DN -> lower
+        cased e-mail addresses (in the order stored in ldap).
+
+        """
+        email = email.lower()
+        if isinstance(email, unicode):
+            email = email.encode(self._encoding)
+        filterstr = ldap.filter.filter_format('(mail=%s)', (email,))
+        result = self._search(self._user_dn_suffix, ldap.SCOPE_ONELEVEL,
+                              filterstr=filterstr, attrlist=['mail'])
+        users = {}
+        for dn, attr in result:
+            mails = [mail.lower() for mail in attr.get('mail', [])]
+            if email in mails:
+                users[self._normalize_dn(dn)] = mails
+        return users
+
     def _role_id(self, role_dn):
         if role_dn == self._role_dn_suffix:
             return None
@@ -205,6 +645,44 @@ class LdapAgent(object):
 
         return current_bit
 
+    def subrole_members(self, role_id, filter_str, members_data=None):
+        """ Returns the (normalized) DNs of the members of the subroles of
+        `role_id` whose id contains `filter_str`.
+
+        In the default `uniquemember` mode this is a single subtree search
+        below the role. In `memberof` mode the memberOf values of the
+        already fetched `members_data` are used instead, without searching.
+
+        """
+        role_dn = self._role_dn(role_id)
+        suffix = ',' + self._normalize_dn(role_dn)
+
+        def matches(subrole_dn):
+            if not self._normalize_dn(subrole_dn).endswith(suffix):
+                return False
+            subrole_id = subrole_dn.split(',', 1)[0].split('=', 1)[-1]
+            return filter_str in subrole_id.strip()
+
+        members = set()
+        if self._filter_mode == 'memberof':
+            for dn, attr in (members_data or {}).items():
+                for subrole_dn in attr.get('memberOf', []):
+                    if matches(subrole_dn):
+                        members.add(self._normalize_dn(dn))
+                        break
+            return members
+
+        filterstr = '(&(objectClass=groupOfUniqueNames)(ou=*%s*))' % (
+            ldap.filter.escape_filter_chars(filter_str))
+        result = self._search(role_dn, ldap.SCOPE_SUBTREE,
+                              filterstr=filterstr, attrlist=['uniqueMember'])
+        for dn, attr in result:
+            if matches(dn):
+                members.update([self._normalize_dn(member_dn)
+                                for member_dn in attr.get('uniqueMember', [])
+                                if member_dn])
+        return members
+
     def roles_with_member(self, member_dn):
         """
         Returns roles of a user
@@ -213,7 +691,7 @@ class LdapAgent(object):
         role_dn = self._role_dn_suffix
         filter_tmpl = '(&(objectClass=groupOfUniqueNames)(uniqueMember=%s))'
         filterstr = ldap.filter.filter_format(filter_tmpl, (member_dn,))
-        result = self.conn.search_s(role_dn, ldap.SCOPE_SUBTREE,
-                                    filterstr=filterstr, attrlist=())
+        result = self._search(role_dn, ldap.SCOPE_SUBTREE,
+                              filterstr=filterstr, attrlist=())
         for dn, attr in result:
             yield dn
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+""" LMTP front end of the expander.
+
+Postfix can deliver to a long running `roleexpander serve` process with its
+`lmtp` transport instead of starting one pipe process per message, so the
+interpreter, the configuration and the LDAP connections stay warm between
+messages. Every recipient of a transaction is expanded separately and gets
+its own reply after DATA, as LMTP requires (RFC 2033).
+
+"""
+from Queue import Queue, Empty
+from codes import IGNORE_LIST, RETURN_CODES
+from contextlib import contextmanager
+from message import SPOOL_MAX_SIZE, SpooledMessage
+import SocketServer
+import logging
+import os
+import re
+import socket
+import threading
+
+__version__ = """$Id$"""
+
+log = logging.getLogger('rolesexpander')
+
+# Replies for the expander exit codes, the same status Postfix gives them
+# when the expander runs from the `pipe` transport (see sys_exits.c)
+REPLIES = {
+    RETURN_CODES['EX_OK']:          '250 2.0.0 Ok',
+    RETURN_CODES['EX_USAGE']:       '550 5.3.0 Command line usage error',
+    RETURN_CODES['EX_DATAERR']:     '550 5.6.0 Data format error',
+    RETURN_CODES['EX_NOINPUT']:     '550 5.3.0 Cannot open input',
+    RETURN_CODES['EX_NOUSER']:      '550 5.1.1 User unknown',
+    RETURN_CODES['EX_NOHOST']:      '550 5.1.2 Host name unknown',
+    RETURN_CODES['EX_UNAVAILABLE']: '550 5.3.0 Service unavailable',
+    RETURN_CODES['EX_SOFTWARE']:    '550 5.3.0 Internal software error',
+    RETURN_CODES['EX_OSERR']:       '451 4.3.0 System resource problem',
+    RETURN_CODES['EX_OSFILE']:      '550 5.3.0 Critical OS file missing',
+    RETURN_CODES['EX_CANTCREAT']:   "550 5.2.0 Can't create output",
+    RETURN_CODES['EX_IOERR']:       '550 5.3.0 Input/output error',
+    RETURN_CODES['EX_TEMPFAIL']:    '451 4.3.0 Temporary failure',
+    RETURN_CODES['EX_PROTOCOL']:    '550 5.5.0 Remote protocol error',
+    RETURN_CODES['EX_NOPERM']:      '550 5.7.0 Permission denied',
+    RETURN_CODES['EX_CONFIG']:      '550 5.3.5 Local configuration error',
+}
+UNKNOWN_REPLY = '451 4.3.0 Unknown delivery status'
+
+ADDRESS = re.compile(r'^(?:FROM|TO):\s*<?([^<>\s]*)>?', re.IGNORECASE)
+
+
+def reply_for(return_code):
+    """ The LMTP reply for an expander exit code """
+    return REPLIES.get(return_code, UNKNOWN_REPLY)
+
+
+class ExpanderPool(object):
+    """ Up to `size` expanders, created with `factory` when first needed
+    and reused, so each keeps its LDAP connection open. A delivery waits
+    when all of them are busy. """
+
+    def __init__(self, factory, size=4):
+        self.factory = factory
+        self.size = int(size)
+        self._idle = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def expander(self):
+        try:
+            expander = self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    expander = self.factory()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                expander = self._idle.get()
+        try:
+            yield expander
+        finally:
+            self._idle.put(expander)
+
+    def deliver(self, from_email, role_email, content):
+        """ Expand `content` to `role_email`, returns the exit code """
+        if role_email in IGNORE_LIST:
+            return RETURN_CODES['EX_NOUSER']
+        try:
+            with self.expander() as expander:
+                return_code = expander.expand(from_email, role_email,
+                                              content)
+                if return_code == RETURN_CODES['EX_TEMPFAIL']:
+                    # The connection may be broken, start over next time
+                    expander.agent.disconnect()
+                return return_code
+        except Exception:
+            log.exception("Cannot deliver to %s", role_email)
+            return RETURN_CODES['EX_TEMPFAIL']
+
+
+class LMTPHandler(SocketServer.StreamRequestHandler):
+    """ One LMTP session """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.greeted = False
+        self.reset()
+
+    def reset(self):
+        self.sender = None
+        self.recipients = []
+
+    def push(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.push('220 %s LMTP roleexpander ready' % self.server.hostname)
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            verb, _, arg = line.rstrip('\r\n').partition(' ')
+            method = getattr(self, 'lmtp_' + verb.upper(), None)
+            if method is None:
+                self.push('500 5.5.2 Error: command not recognized')
+            elif method(arg.strip()) is False:
+                break
+
+    def lmtp_LHLO(self, arg):
+        if not arg:
+            self.push('501 5.5.4 Syntax: LHLO hostname')
+            return
+        self.greeted = True
+        self.reset()
+        self.push('250-%s' % self.server.hostname)
+        self.push('250-PIPELINING')
+        self.push('250-ENHANCEDSTATUSCODES')
+        self.push('250 8BITMIME')
+
+    def lmtp_HELO(self, arg):
+        self.push('500 5.5.1 Error: use LHLO')
+
+    lmtp_EHLO = lmtp_HELO
+
+    def lmtp_MAIL(self, arg):
+        match = ADDRESS.match(arg)
+        if not self.greeted:
+            self.push('503 5.5.1 Error: send LHLO first')
+        elif self.sender is not None:
+            self.push('503 5.5.1 Error: nested MAIL command')
+        elif match is None or not arg.upper().startswith('FROM:'):
+            self.push('501 5.5.4 Syntax: MAIL FROM:<address>')
+        else:
+            self.sender = match.group(1)
+            self.push('250 2.1.0 Ok')
+
+    def lmtp_RCPT(self, arg):
+        match = ADDRESS.match(arg)
+        if self.sender is None:
+            self.push('503 5.5.1 Error: need MAIL command')
+        elif (match is None or not match.group(1) or
+                not arg.upper().startswith('TO:')):
+            self.push('501 5.5.4 Syntax: RCPT TO:<address>')
+        else:
+            self.recipients.append(match.group(1))
+            self.push('250 2.1.5 Ok')
+
+    def lmtp_DATA(self, arg):
+        if not self.recipients:
+            self.push('503 5.5.1 Error: need RCPT command')
+            return
+        self.push('354 End data with <CR><LF>.<CR><LF>')
+        content = SpooledMessage(self.server.max_memory)
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                content.close()
+                return False  # Client went away, nothing was delivered
+            if line.rstrip('\r\n') == '.':
+                break
+            if line.startswith('.'):
+                line = line[1:]
+            # The pipe transport hands the message over with bare newlines
+            if line.endswith('\r\n'):
+                line = line[:-2] + '\n'
+            content.write(line)
+
+        try:
+            for role_email in self.recipients:
+                return_code = self.server.pool.deliver(self.sender,
+                                                       role_email, content)
+                self.push(reply_for(return_code))
+        finally:
+            content.close()
+        self.reset()
+
+    def lmtp_RSET(self, arg):
+        self.reset()
+        self.push('250 2.0.0 Ok')
+
+    def lmtp_NOOP(self, arg):
+        self.push('250 2.0.0 Ok')
+
+    def lmtp_VRFY(self, arg):
+        self.push('252 2.5.2 Cannot VRFY user')
+
+    def lmtp_QUIT(self, arg):
+        self.push('221 2.0.0 Bye')
+        return False
+
+
+class LMTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    # Messages up to this size are kept in memory, larger ones on disk
+    max_memory = SPOOL_MAX_SIZE
+    allow_reuse_address = True
+
+    def __init__(self, address, pool):
+        self.pool = pool
+        self.hostname = socket.getfqdn()
+        SocketServer.TCPServer.__init__(self, address, LMTPHandler)
+
+
+class UnixLMTPServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+    max_memory = SPOOL_MAX_SIZE
+
+    def __init__(self, path, pool, mode=0666):
+        self.pool = pool
+        self.hostname = socket.getfqdn()
+        if os.path.exists(path):
+            os.unlink(path)  # Left over by a previous run
+        SocketServer.UnixStreamServer.__init__(self, path, LMTPHandler)
+        os.chmod(path, mode)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def make_server(listen, pool, socket_mode=0666, max_memory=SPOOL_MAX_SIZE):
+    """ Listen on a Unix socket (an absolute path) or on `host:port` """
+    if listen.startswith('/'):
+        server = UnixLMTPServer(listen, pool, socket_mode)
+    else:
+        host, _, port = listen.rpartition(':')
+        server = LMTPServer((host or 'localhost', int(port)), pool)
+    server.max_memory = int(max_memory)
+    return server
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+""" Messages kept out of memory.
+
+The pipe entry point reads the message from stdin into a `SpooledMessage`:
+a `SpooledTemporaryFile` that stays in memory up to `max_size` bytes and
+moves to disk above it. The transports, the archive and the spool stream it
+in chunks, so a large attachment is never held in one string (or in the
+several copies that concatenating, parsing and re-serializing made).
+
+A `SplicedMessage` puts new headers in front of the body of another
+message without copying it (see `headers.read_headers`).
+
+Everything that takes a message accepts a string as well; the helpers
+below hide the difference.
+
+"""
+from tempfile import SpooledTemporaryFile
+import os
+import threading
+
+__version__ = """$Id$"""
+
+# Messages up to this size stay in memory
+SPOOL_MAX_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class _Message(object):
+    """ Read by any number of readers (the threads sending the batches of
+    a message), each at its own position. Subclasses implement `_read_at`
+    and `__len__`. """
+
+    def _read_at(self, position, size=-1, line=False):
+        raise NotImplementedError
+
+    def open(self):
+        """ A file-like reader starting at the beginning of the message """
+        return _Reader(self)
+
+    def chunks(self, size=CHUNK_SIZE):
+        reader = self.open()
+        while True:
+            data = reader.read(size)
+            if not data:
+                break
+            yield data
+
+    def lines(self):
+        reader = self.open()
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            yield line
+
+    def getvalue(self):
+        """ The whole message as a string """
+        return self.open().read()
+
+
+class SpooledMessage(_Message):
+    """ A message written once, then read as often as needed """
+
+    def __init__(self, max_size=SPOOL_MAX_SIZE):
+        self.max_size = int(max_size)
+        self._file = SpooledTemporaryFile(max_size=self.max_size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, stream, max_size=SPOOL_MAX_SIZE):
+        """ Copy `stream` (e.g. stdin) chunk by chunk """
+        message = cls(max_size)
+        while True:
+            data = stream.read(CHUNK_SIZE)
+            if not data:
+                break
+            message.write(data)
+        return message
+
+    def write(self, data):
+        with self._lock:
+            self._file.seek(0, 2)
+            self._file.write(data)
+            self._size += len(data)
+
+    def _read_at(self, position, size=-1, line=False):
+        with self._lock:
+            self._file.seek(position)
+            if line:
+                return self._file.readline(size)
+            return self._file.read(size)
+
+    @property
+    def in_memory(self):
+        return not self._file._rolled
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        self._file.close()
+
+
+class SplicedMessage(_Message):
+    """ `head` followed by `message` from `offset` on """
+
+    def __init__(self, head, message, offset):
+        self.head = head
+        self.message = message
+        self.offset = offset
+        self.max_size = message.max_size
+
+    def _read_at(self, position, size=-1, line=False):
+        head = self.head
+        if position >= len(head):
+            return self.message._read_at(
+                self.offset + position - len(head), size, line)
+        if line:
+            end = head.find('\n', position) + 1 or len(head)
+            if size >= 0:
+                end = min(end, position + size)
+            return head[position:end]
+        if size < 0:
+            return head[position:] + self.message._read_at(self.offset)
+        return head[position:position + size]
+
+    def __len__(self):
+        return len(self.head) + len(self.message) - self.offset
+
+    def close(self):
+        self.message.close()
+
+
+class FileMessage(_Message):
+    """ A message stored in a file, from `offset` on (and `length` bytes
+    long, by default up to the end of the file) """
+
+    def __init__(self, path, offset=0, length=None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _read_at(self, position, size=-1, line=False):
+        if self.length is not None:
+            remaining = self.length - position
+            if remaining <= 0:
+                return ''
+            if size < 0 or size > remaining:
+                size = remaining
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'rb')
+            self._file.seek(self.offset + position)
+            if line:
+                return self._file.readline(size)
+            return self._file.read(size)
+
+    def __len__(self):
+        if self.length is not None:
+            return self.length
+        return os.path.getsize(self.path) - self.offset
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _Reader(object):
+    """ Reads a message from its own position """
+
+    def __init__(self, message):
+        self.message = message
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.message._read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.message._read_at(self.position, size, line=True)
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+def message_chunks(content, size=CHUNK_SIZE):
+    """ The chunks of a message, string or `SpooledMessage` """
+    if isinstance(content, basestring):
+        if content:
+            yield content
+    else:
+        for data in content.chunks(size):
+            yield data
+
+
+def message_lines(content):
+    """ The lines of a message, each with its line end (`\\n`) """
+    if isinstance(content, basestring):
+        return _string_lines(content)
+    return content.lines()
+
+
+def _string_lines(content):
+    start = 0
+    while start < len(content):
+        end = content.find('\n', start) + 1 or len(content)
+        yield content[start:end]
+        start = end
+
+
+def splice(head, content, offset):
+    """ `head` followed by the body of `content` from `offset`, of the
+    same kind as `content` """
+    if isinstance(content, basestring):
+        return head + content[offset:]
+    return SplicedMessage(head, content, offset)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+""" The recipients of an expanded message and the transactions that
+deliver it. """
+
+__version__ = """$Id$"""
+
+# What an address costs on the sendmail command line besides its
+# characters: the <> quoting, the terminating NUL and the argv pointer
+ARGV_OVERHEAD = 16
+
+
+def normalize_address(address):
+    """ The form addresses are compared in """
+    return address.strip().lower()
+
+
+def domain_key(address):
+    """ Sort key grouping addresses by domain, subdomains next to their
+    parent domain """
+    domain = address.rpartition('@')[2].lower()
+    return tuple(reversed(domain.split('.')))
+
+
+def parse_batch_size(value):
+    """ A batch size from the ini file; `all` (or 0) means no limit """
+    if isinstance(value, basestring):
+        value = value.strip().lower()
+        if value == 'all':
+            return 0
+    return max(0, int(value))
+
+
+class RecipientPlan(object):
+    """ Every address a message is sent to, once. Addresses are added in
+    named groups (`also_send_to`, `members`, `owners`); an address already
+    in an earlier group, or twice in the same one (a person with several
+    entries or mail values), is skipped and counted in `duplicates`.
+    Addresses that already got the message (see `journal` and `dedupe`)
+    are taken out with `remove`.
+
+    Each group is sent in batches of `batch_size` recipients (0 for all of
+    them in one transaction), sorted by domain so the MTA can deliver a
+    batch over few connections. Batches are also split before their
+    addresses take more than `max_batch_bytes` on a command line.
+
+    """
+
+    def __init__(self, batch_size=50, max_batch_bytes=None,
+                 group_by_domain=True):
+        self.batch_size = int(batch_size)
+        self.max_batch_bytes = max_batch_bytes
+        self.group_by_domain = group_by_domain
+        self.groups = []
+        self.duplicates = 0
+        self.removed = {}  # reason: addresses
+        self._addresses = {}
+        self._seen = set()
+
+    def add(self, group, addresses):
+        """ Add `addresses` to `group`, returns how many were new """
+        if group not in self._addresses:
+            self.groups.append(group)
+            self._addresses[group] = []
+        added = 0
+        for address in addresses:
+            key = normalize_address(address)
+            if not key:
+                continue
+            if key in self._seen:
+                self.duplicates += 1
+                continue
+            self._seen.add(key)
+            self._addresses[group].append(address.strip())
+            added += 1
+        return added
+
+    def remove(self, addresses, reason='already delivered', groups=None):
+        """ Take `addresses` out of `groups` (all by default), returns
+        how many of them were planned """
+        keys = set(normalize_address(address) for address in addresses)
+        removed = 0
+        for group in groups or self.groups:
+            if group not in self._addresses:
+                continue
+            planned = self._addresses[group]
+            kept = [address for address in planned
+                    if normalize_address(address) not in keys]
+            removed += len(planned) - len(kept)
+            self._addresses[group] = kept
+        self.removed[reason] = self.removed.get(reason, 0) + removed
+        return removed
+
+    def addresses(self, group=None):
+        if group is not None:
+            return list(self._addresses.get(group, []))
+        return [address for name in self.groups
+                for address in self._addresses[name]]
+
+    def batches(self, group):
+        """ The recipients of each transaction of `group` """
+        addresses = self._addresses.get(group, [])
+        if self.group_by_domain:
+            addresses = sorted(addresses, key=domain_key)
+        batches = []
+        batch = []
+        size = 0
+        for address in addresses:
+            cost = len(address) + ARGV_OVERHEAD
+            if batch and (
+                    (self.batch_size and len(batch) >= self.batch_size) or
+                    (self.max_batch_bytes and
+                     size + cost > self.max_batch_bytes)):
+                batches.append(batch)
+                batch = []
+                size = 0
+            batch.append(address)
+            size += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __len__(self):
+        return sum(len(addresses) for addresses in self._addresses.values())
+
+    def describe(self):
+        """ A readable summary, one line per transaction """
+        lines = ['%d recipients in %d transactions, %d duplicates skipped' % (
+            len(self), sum(len(self.batches(group)) for group in self.groups),
+            self.duplicates)]
+        for reason, count in sorted(self.removed.items()):
+            if count:
+                lines[0] += ', %d %s' % (count, reason)
+        for group in self.groups:
+            for number, batch in enumerate(self.batches(group)):
+                lines.append('  %s #%d (%d): %s' % (
+                    group, number + 1, len(batch), ', '.join(batch)))
+        return lines
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+""" Spool directory between the Postfix pipe and the expander workers.
+
+With a [spool] section in the configuration the pipe entry point only
+stores the message with its envelope and exits, `roleexpander worker`
+processes expand the spooled messages. The directory is laid out like a
+maildir: messages are written in `tmp/`, moved to `new/` when complete and
+claimed by a worker by moving them to `cur/`; a rename is atomic, so a
+message is never seen half written or expanded twice. Messages that fail
+for good end up in `failed/`.
+
+Every file starts with a line of JSON holding the envelope, followed by
+the message. The file name starts with the time it may be tried again.
+
+"""
+from codes import RETURN_CODES
+from message import SpooledMessage, message_chunks
+import errno
+import json
+import logging
+import os
+import socket
+import time
+
+__version__ = """$Id$"""
+
+log = logging.getLogger('rolesexpander')
+
+SUBDIRS = ('tmp', 'new', 'cur', 'failed')
+
+
+class Spool(object):
+    """ Messages waiting for expansion. A message that fails temporarily
+    is tried again after `retry_delay` seconds, doubling up to
+    `max_retry_delay`, and given up after `max_age` seconds. """
+
+    def __init__(self, path, retry_delay=60, max_retry_delay=3600,
+                 max_age=5 * 24 * 3600):
+        self.path = path
+        self.retry_delay = float(retry_delay)
+        self.max_retry_delay = float(max_retry_delay)
+        self.max_age = float(max_age)
+        self._counter = 0
+        for subdir in SUBDIRS:
+            directory = os.path.join(path, subdir)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _path(self, subdir, name):
+        return os.path.join(self.path, subdir, name)
+
+    def _unique_name(self, not_before):
+        self._counter += 1
+        return '%d.%d_%d.%d.%s' % (not_before, time.time() * 1000000,
+                                   self._counter, os.getpid(),
+                                   socket.gethostname().replace('.', '_'))
+
+    def _write(self, name, envelope, content):
+        """ Write the message in tmp/ and move it to new/ """
+        tmp_path = self._path('tmp', name)
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(json.dumps(envelope) + '\n')
+            for data in message_chunks(content):
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, self._path('new', name))
+
+    def put(self, from_email, role_email, content):
+        """ Spool a message, returns its name """
+        now = time.time()
+        envelope = {'from': from_email, 'to': role_email,
+                    'received': now, 'attempts': 0}
+        name = self._unique_name(now)
+        self._write(name, envelope, content)
+        return name
+
+    def pending(self, now=None):
+        """ Names of the messages that may be tried now, oldest first """
+        if now is None:
+            now = time.time()
+        ready = []
+        for name in os.listdir(os.path.join(self.path, 'new')):
+            try:
+                not_before = int(name.split('.', 1)[0])
+            except ValueError:
+                continue  # Not ours
+            if not_before <= now:
+                ready.append((not_before, name))
+        return [entry[1] for entry in sorted(ready)]
+
+    def claim(self, name):
+        """ Take the message for this worker. Returns `(envelope, content)`
+        (a `SpooledMessage`), or None when another worker was faster. """
+        try:
+            os.rename(self._path('new', name), self._path('cur', name))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        f = open(self._path('cur', name), 'rb')
+        try:
+            envelope = json.loads(f.readline())
+            # Copied chunk by chunk, large messages stay on disk
+            content = SpooledMessage.from_file(f)
+        finally:
+            f.close()
+        for key in ('from', 'to'):  # The expander works with byte strings
+            envelope[key] = envelope[key].encode('utf-8')
+        return envelope, content
+
+    def done(self, name):
+        os.unlink(self._path('cur', name))
+
+    def fail(self, name):
+        os.rename(self._path('cur', name), self._path('failed', name))
+
+    def retry(self, name, envelope, content):
+        """ Put a claimed message back with a later time. Returns False
+        (and moves it to failed/) when it is too old to be tried again. """
+        now = time.time()
+        if now - envelope['received'] > self.max_age:
+            self.fail(name)
+            return False
+        delay = min(self.retry_delay * 2 ** envelope['attempts'],
+                    self.max_retry_delay)
+        envelope = dict(envelope, attempts=envelope['attempts'] + 1)
+        self._write(self._unique_name(now + delay), envelope, content)
+        self.done(name)
+        return True
+
+    def recover(self):
+        """ Put back the messages claimed by workers that died. Only call
+        it when no worker is running. """
+        recovered = 0
+        for name in os.listdir(os.path.join(self.path, 'cur')):
+            os.rename(self._path('cur', name), self._path('new', name))
+            recovered += 1
+        return recovered
+
+    def run_once(self, deliver, limit=None):
+        """ Deliver the pending messages with
+        `deliver(from_email, role_email, content)`, which returns the exit
+        code of the expander. Returns how many messages were claimed. """
+        claimed = 0
+        for name in self.pending():
+            if limit is not None and claimed >= limit:
+                break
+            message = self.claim(name)
+            if message is None:
+                continue
+            claimed += 1
+            envelope, content = message
+            try:
+                self._deliver(name, envelope, content, deliver)
+            finally:
+                content.close()
+        return claimed
+
+    def _deliver(self, name, envelope, content, deliver):
+        try:
+            return_code = deliver(envelope['from'], envelope['to'], content)
+        except Exception:
+            log.exception("Cannot deliver %s", name)
+            return_code = RETURN_CODES['EX_TEMPFAIL']
+
+        if return_code == RETURN_CODES['EX_OK']:
+            self.done(name)
+        elif return_code == RETURN_CODES['EX_TEMPFAIL']:
+            if self.retry(name, envelope, content):
+                log.info("Deferred %s from %s to %s (attempt %d)", name,
+                         envelope['from'], envelope['to'],
+                         envelope['attempts'] + 1)
+            else:
+                log.error("Giving up %s from %s to %s", name,
+                          envelope['from'], envelope['to'])
+        else:
+            # Postfix already accepted the message, it can't bounce it
+            log.error("Error %s for %s from %s to %s, moved to failed/",
+                      return_code, name, envelope['from'], envelope['to'])
+            self.fail(name)
+
+
+def spool_from_config(config):
+    """ Build the spool from the [spool] section """
+    return Spool(config['path'].strip(),
+                 retry_delay=config.get('retry_delay', 60),
+                 max_retry_delay=config.get('max_retry_delay', 3600),
+                 max_age=config.get('max_age', 5 * 24 * 3600))
+
+
+def work(spool, expander, poll_interval=5, should_stop=lambda: False):
+    """ Expand spooled messages until `should_stop()`, waiting
+    `poll_interval` seconds whenever the spool is empty """
+
+    def deliver(from_email, role_email, content):
+        return_code = expander.expand(from_email, role_email, content)
+        if return_code == RETURN_CODES['EX_TEMPFAIL']:
+            # The connection may be broken, start over next time
+            expander.agent.disconnect()
+        return return_code
+
+    while not should_stop():
+        # One message at a time, so the other workers get their share
+        if not spool.run_once(deliver, limit=1):
+            time.sleep(poll_interval)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" Small SQLite backed stores shared by concurrent expander processes.
+
+Postfix runs one expander per message, so anything that must survive
+between invocations (or be shared by parallel pipe processes) is kept in a
+local SQLite file. SQLite takes care of the locking between processes.
+
+"""
+from contextlib import contextmanager
+import os
+import sqlite3
+
+__version__ = """$Id$"""
+
+# Named counters of a store, see `SqliteStore._count`
+COUNTERS_SCHEMA = ('CREATE TABLE IF NOT EXISTS counters ('
+                   ' name TEXT PRIMARY KEY, value INTEGER)')
+
+
+class SqliteStore(object):
+    """ Base class for the on-disk stores. Subclasses list their
+    `CREATE ... IF NOT EXISTS` statements in `schema`.
+
+    The connection is opened lazily and reopened after a fork, so a store
+    can be created before a worker pool is started.
+
+    """
+
+    schema = ()
+    # e.g. 'WAL', so readers don't wait for the writer and vice versa
+    journal_mode = None
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = float(timeout)
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Autocommit mode, transactions are started explicitly
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.text_factory = str
+            if self.journal_mode:
+                conn.execute('PRAGMA journal_mode = %s' % self.journal_mode)
+            for statement in self.schema:
+                conn.execute(statement)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """ Run a write transaction. `BEGIN IMMEDIATE` takes the write lock
+        right away so concurrent read-modify-write cycles can't interleave.
+        """
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass  # The transaction was already rolled back
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    def _count(self, conn, name, increment=1):
+        """ Add `increment` to the counter `name`, in the transaction of
+        `conn`. The store must list `COUNTERS_SCHEMA` in its `schema`. """
+        conn.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+        conn.execute('UPDATE counters SET value = value + ? WHERE name = ?',
+                     (increment, name))
+
+    def counters(self):
+        """ {name: value} of the counters """
+        return dict(self.conn.execute('SELECT name, value FROM counters'))
+
+    def _reset_counters(self, conn):
+        conn.execute('DELETE FROM counters')
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
@@ -0,0 +1,87 @@
+from envcoord.mailexpander.acl import SenderACL
+import cPickle
+import unittest
+
+USERS_DN = 'ou=Users,o=EIONET,l=Europe'
+
+
+def user_dn(user_id):
+    return 'uid=%s,%s' % (user_id, USERS_DN)
+
+
+class Agent(object):
+    """ Just enough of LdapAgent to look users up by e-mail """
+
+    users = {
+        user_dn('owner'): ['Owner@example.com', 'owner2@example.com'],
+        user_dn('member'): ['member@example.com'],
+        user_dn('person'): ['first@example.com', 'second@example.com'],
+    }
+    external = {'cn=external,o=Other': {'mail': ['ext@example.com']}}
+
+    def __init__(self):
+        self.lookups = 0
+
+    def _normalize_dn(self, dn):
+        return ','.join([bit.strip() for bit in dn.lower().split(',')])
+
+    def _is_user_dn(self, dn):
+        return dn.endswith(',' + USERS_DN)
+
+    def users_with_email(self, email):
+        self.lookups += 1
+        found = {}
+        for dn, mails in self.users.items():
+            mails = [mail.lower() for mail in mails]
+            if email in mails:
+                found[self._normalize_dn(dn)] = mails
+        return found
+
+    def _query_many(self, dns, attrlist=None):
+        return dict((dn, self.external[dn]) for dn in dns
+                    if dn in self.external)
+
+
+class SenderACLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = Agent()
+        self.role_data = {
+            'permittedSender': ['Boss@example.com', '*@eaudeweb.ro',
+                                'admin.?@example.org', 'owners', 'members'],
+            'owner': [user_dn('owner')],
+            'uniqueMember': [user_dn('member'), 'cn=external,o=Other'],
+            'inheritedPersons': [user_dn('person')],
+        }
+        self.acl = SenderACL.from_role(self.role_data, self.agent)
+
+    def test_addresses_and_patterns(self):
+        acl = self.acl
+        self.assertEqual(acl.addresses, frozenset(['boss@example.com']))
+        self.assertTrue(acl.allows('boss@example.com', self.agent))
+        self.assertTrue(acl.allows('someone@eaudeweb.ro', self.agent))
+        self.assertTrue(acl.allows('admin.1@example.org', self.agent))
+        self.assertEqual(self.agent.lookups, 0)
+        self.assertFalse(acl.matches_address('admin.12@example.org'))
+
+    def test_dns(self):
+        acl = self.acl
+        self.assertTrue(acl.allows('owner2@example.com', self.agent))
+        self.assertTrue(acl.allows('member@example.com', self.agent))
+        self.assertTrue(acl.allows('ext@example.com', self.agent))
+        # Permitted persons of parents only with their first address
+        self.assertTrue(acl.allows('first@example.com', self.agent))
+        self.assertFalse(acl.allows('second@example.com', self.agent))
+        self.assertFalse(acl.allows('nobody@example.com', self.agent))
+
+    def test_anyone(self):
+        acl = SenderACL.from_role({'permittedSender': ['anyone']},
+                                  self.agent)
+        self.assertTrue(acl.allows('nobody@example.com', self.agent))
+        self.assertEqual(self.agent.lookups, 0)
+
+    def test_pickle(self):
+        acl = cPickle.loads(cPickle.dumps(self.acl))
+        self.assertTrue(acl.allows('someone@eaudeweb.ro', self.agent))
+        self.assertTrue(acl.allows('member@example.com', self.agent))
+        self.assertFalse(acl.allows('nobody@example.com', self.agent))
@@ -0,0 +1,152 @@
+from envcoord.mailexpander.archive import ArchiveSpool, MboxArchive
+from envcoord.mailexpander.archive import ShardedArchive, archive_from_config
+from envcoord.mailexpander.message import SpooledMessage
+import gzip
+import mailbox
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class ArchiveSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mailbox = os.path.join(self.tmp_dir, 'archive.mbox')
+        self.archive = ArchiveSpool(os.path.join(self.tmp_dir, 'spool'),
+                                    MboxArchive(self.mailbox))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_flush(self):
+        self.assertEqual(self.archive.flush(), 0)
+        self.archive.put('one@example.com', 'Subject: one\n\nbody\n')
+        message = SpooledMessage(max_size=10)
+        message.write('Subject: two\n\n' + 'x' * 100 + '\n')
+        self.archive.put('two@example.com', message)
+        self.assertEqual(len(self.archive.pending()), 2)
+        self.assertFalse(os.path.exists(self.mailbox))
+
+        self.assertEqual(self.archive.flush(limit=1), 1)
+        self.assertEqual(self.archive.flush(), 1)
+        self.assertEqual(self.archive.pending(), [])
+        messages = list(mailbox.mbox(self.mailbox))
+        self.assertEqual([m['subject'] for m in messages], ['one', 'two'])
+        self.assertTrue(messages[0].get_from().startswith('one@example.com'))
+        self.assertEqual(messages[1].get_payload(), 'x' * 100 + '\n')
+
+    def test_run(self):
+        self.archive.put('one@example.com', 'Subject: one\n\nbody\n')
+        calls = []
+
+        def should_stop():
+            calls.append(1)
+            return len(calls) > 1
+        self.archive.run(0, should_stop)
+        self.assertEqual(len(list(mailbox.mbox(self.mailbox))), 1)
+
+    def test_from_config(self):
+        self.assertEqual(archive_from_config({'mailbox': self.mailbox}), None)
+        archive = archive_from_config({'mailbox': self.mailbox,
+                                       'archive_spool': self.tmp_dir})
+        self.assertEqual(archive.archive.path, self.mailbox)
+        archive = archive_from_config({'mailbox': self.mailbox,
+                                       'archive_dir': self.tmp_dir,
+                                       'archive_spool': self.tmp_dir})
+        self.assertTrue(isinstance(archive.archive, ShardedArchive))
+
+
+class ShardedArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = ShardedArchive(os.path.join(self.tmp_dir, 'archive'))
+
+    def tearDown(self):
+        self.archive.index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def message(self, number):
+        return ('Message-Id: <%d@example.com>\nSubject: %d\n\nbody %d\n'
+                % (number, number, number))
+
+    def test_append_find(self):
+        now = time.time()
+        self.archive.append([
+            ('one@example.com', 'role-a@example.com', now, self.message(1)),
+            ('two@example.com', 'role-b@example.com', now, self.message(2)),
+            ('one@example.com', 'role-a@example.com', now, self.message(3)),
+        ])
+        self.archive.append([
+            ('two@example.com', 'role-b@example.com', now, self.message(1))])
+        month = time.strftime('%Y-%m.mbox', time.localtime(now))
+        self.assertEqual(self.archive.shards(),
+                         [os.path.join('role-a@example.com', month),
+                          os.path.join('role-b@example.com', month)])
+        shard = os.path.join(self.archive.path, self.archive.shards()[0])
+        self.assertEqual([m['subject'] for m in mailbox.mbox(shard)],
+                         ['1', '3'])
+
+        self.assertEqual(self.archive.find('<9@example.com>'), [])
+        entries = self.archive.find('<1@example.com>')
+        self.assertEqual([e['role'] for e in entries],
+                         ['role-a@example.com', 'role-b@example.com'])
+        entries = self.archive.find('<1@example.com>', 'role-b')
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['sender'], 'two@example.com')
+        self.assertEqual(self.archive.read(entries[0]).getvalue(),
+                         self.message(1))
+        entry = self.archive.find('<3@example.com>')[0]
+        self.assertEqual(self.archive.read(entry).getvalue(),
+                         self.message(3))
+
+    def test_shard_by_date(self):
+        """ A record goes to the shard of its own date, e.g. a copy spooled
+        before the end of a month and flushed after it """
+        last_month = time.time() - 40 * 24 * 3600
+        self.archive.append([('one@example.com', 'role-a@example.com',
+                              last_month, self.message(1))])
+        self.assertEqual(self.archive.shards(), [os.path.join(
+            'role-a@example.com',
+            time.strftime('%Y-%m.mbox', time.localtime(last_month)))])
+
+    def test_spooled(self):
+        spool = ArchiveSpool(os.path.join(self.tmp_dir, 'spool'),
+                             self.archive)
+        message = SpooledMessage(max_size=10)
+        message.write(self.message(1))
+        spool.put('one@example.com', message, 'role-a@example.com')
+        self.assertEqual(spool.flush(), 1)
+        entry = self.archive.find('<1@example.com>', 'role-a')[0]
+        self.assertEqual(self.archive.read(entry).getvalue(),
+                         self.message(1))
+
+    def test_rotate(self):
+        now = time.time()
+        self.archive.append([
+            ('one@example.com', 'role-a', now, self.message(1)),
+            ('one@example.com', 'role-a', now, self.message(2))])
+        self.assertEqual(self.archive.rotate(), 0)
+        next_month = time.time() + 32 * 24 * 3600
+        self.assertEqual(self.archive.rotate(next_month), 1)
+        name = os.path.join('role-a', time.strftime('%Y-%m.mbox.gz'))
+        self.assertEqual(self.archive.shards(), [name])
+        self.assertEqual(self.archive.rotate(next_month), 0)
+        entry = self.archive.find('<2@example.com>')[0]
+        self.assertEqual(entry['shard'], name)
+        self.assertEqual(self.archive.read(entry), self.message(2))
+        shard = gzip.open(os.path.join(self.archive.path, name))
+        self.assertTrue(shard.read().startswith('From one@example.com  '))
+        shard.close()
+
+        # A shard compressed after it was looked up
+        self.archive.append([('one@example.com', 'role-a', now,
+                              self.message(3))])
+        entry = self.archive.find('<3@example.com>')[0]
+        os.rename(os.path.join(self.archive.path, name),
+                  os.path.join(self.tmp_dir, 'old.gz'))
+        self.archive.rotate(next_month)
+        self.assertEqual(self.archive.read(entry), self.message(3))
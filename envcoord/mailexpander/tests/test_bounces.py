@@ -0,0 +1,153 @@
+from envcoord.mailexpander.bounces import BounceStore, bounce_store_from_config
+from envcoord.mailexpander.bounces import digest_message, parse_dsn
+from envcoord.mailexpander.bounces import send_digests
+from envcoord.mailexpander.message import SpooledMessage
+from mock import Mock
+import email
+import os
+import shutil
+import tempfile
+import unittest
+
+DSN = """\
+From: MAILER-DAEMON@mx.example.com
+To: test+bounce@roles.eionet.europa.eu
+Subject: Undelivered Mail Returned to Sender
+MIME-Version: 1.0
+Content-Type: multipart/report; report-type=delivery-status;
+ boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+The mail system could not deliver your message.
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mx.example.com
+
+Final-Recipient: rfc822; Gone@example.com
+Original-Recipient: rfc822;gone@example.com
+Action: failed
+Status: 5.1.1
+Diagnostic-Code: smtp; 550 5.1.1 <gone@example.com>:
+ Recipient address rejected: User unknown
+
+Final-Recipient: rfc822; slow@example.org
+Action: delayed
+Status: 4.4.1
+
+Final-Recipient: rfc822; fine@example.org
+Action: delivered
+Status: 2.0.0
+
+--BOUNDARY
+Content-Type: text/rfc822-headers
+
+Subject: the post
+
+--BOUNDARY--
+"""
+
+
+class ParseDSNTest(unittest.TestCase):
+
+    def test_failures(self):
+        failures = parse_dsn(DSN)
+        self.assertEqual([(f['recipient'], f['status'], f['action'])
+                          for f in failures],
+                         [('Gone@example.com', '5.1.1', 'failed'),
+                          ('slow@example.org', '4.4.1', 'delayed')])
+        self.assertEqual(failures[0]['diagnostic'],
+                         '550 5.1.1 <gone@example.com>: Recipient address '
+                         'rejected: User unknown')
+        self.assertEqual(failures[1]['diagnostic'], '')
+
+        message = SpooledMessage(max_size=10)
+        message.write(DSN)
+        self.assertEqual(parse_dsn(message), failures)
+
+    def test_not_a_dsn(self):
+        self.assertEqual(parse_dsn('Subject: out of office\n\nback soon\n'),
+                         None)
+        self.assertEqual(parse_dsn(DSN.replace('-Recipient:',
+                                               '-Rcpt:')), None)
+        # A DSN for delivered recipients only has nothing to report
+        self.assertEqual(parse_dsn(DSN.replace('Action: failed',
+                                               'Action: relayed')
+                                      .replace('Action: delayed',
+                                               'Action: expanded')), [])
+
+
+class BounceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = BounceStore(os.path.join(self.tmp_dir, 'bounces.sqlite'),
+                                 interval=60)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_digests(self):
+        store = self.store
+        failures = parse_dsn(DSN)
+        self.assertEqual(store.record('test', failures), 2)
+        store.record('test', failures[:1])
+        store.record('other', failures[1:])
+        self.assertEqual(store.stats()['pending'], 4)
+
+        taken = store.take('test')
+        self.assertEqual(taken.keys(), ['test'])
+        self.assertEqual([(e['recipient'], e['count'])
+                          for e in taken['test']],
+                         [('gone@example.com', 2), ('slow@example.org', 1)])
+        # One digest per interval
+        store.record('test', failures[:1])
+        self.assertEqual(store.take('test'), {})
+        self.assertEqual(store.take().keys(), ['other'])
+        self.assertEqual(store.take(interval=0).keys(), ['test'])
+
+        stats = store.stats()
+        self.assertEqual((stats['pending'], stats['notices'],
+                          stats['recipients'], stats['digests']),
+                         (0, 4, 5, 3))
+
+    def test_send_digests(self):
+        store = self.store
+        store.record('test', parse_dsn(DSN))
+        send = Mock(return_value=75)
+        self.assertEqual(send_digests(store, send, 'no-reply@example.com',
+                                      'bounces@example.com'), 0)
+        # Kept, and due again
+        self.assertEqual(store.stats()['pending'], 2)
+        send.return_value = 0
+        self.assertEqual(send_digests(store, send, 'no-reply@example.com',
+                                      'bounces@example.com'), 1)
+        self.assertEqual(send.call_args[0][1], ['bounces@example.com'])
+        digest = email.message_from_string(send.call_args[0][2])
+        self.assertEqual(digest['subject'], 'Bounces for role test: 2 '
+                                            'recipients')
+        body = digest.get_payload(decode=True)
+        self.assertTrue('gone@example.com  5.1.1 failed, 1 times' in body)
+        self.assertTrue('User unknown' in body)
+        self.assertEqual(store.stats()['pending'], 0)
+
+    def test_purge(self):
+        self.store.record('test', parse_dsn(DSN))
+        self.assertEqual(self.store.purge(), 2)
+        self.assertEqual(self.store.stats()['notices'], 0)
+
+    def test_from_config(self):
+        self.assertEqual(bounce_store_from_config({}), None)
+        store = bounce_store_from_config({
+            'bounce_digest_path': os.path.join(self.tmp_dir, 'b.sqlite'),
+            'bounce_digest_interval': '600'})
+        self.assertEqual(store.interval, 600)
+
+    def test_digest_message(self):
+        message = email.message_from_string(digest_message(
+            'test', [], 'no-reply@example.com', 'bounces@example.com'))
+        self.assertEqual(message['to'], 'bounces@example.com')
@@ -0,0 +1,88 @@
+from envcoord.mailexpander.cache import LdapCache, cache_from_config
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+
+class LdapCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache.sqlite')
+        self.cache = LdapCache(self.path, ttl=60, max_entries=3)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_set(self):
+        self.assertEqual(self.cache.get('get_role:test'), None)
+        value = {'members_data': {'uid=a': {'mail': ['a@example.com']}}}
+        self.cache.set('get_role:test', value)
+        self.assertEqual(self.cache.get('get_role:test'), value)
+
+        # Visible from another process opening the same file
+        other = LdapCache(self.path, ttl=60)
+        self.assertEqual(other.get('get_role:test'), value)
+        other.close()
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_ttl(self):
+        self.cache.set('key', 'value')
+        self.cache.execute('UPDATE cache SET created = ?',
+                           (time.time() - 120,))
+        self.assertEqual(self.cache.stats()['expired'], 1)
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_lru_eviction(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key)
+        self.cache.execute('UPDATE cache SET accessed = 0 WHERE key = ?',
+                           ('a',))
+        self.cache.get('a')  # a is now the most recently used
+        self.cache.set('d', 'd')
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'c', 'd'])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_purge(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.execute('UPDATE cache SET created = 0 WHERE key = ?',
+                           ('a',))
+        self.assertEqual(self.cache.purge(expired_only=True), 1)
+        self.assertEqual(self.cache.keys(), ['b'])
+        self.assertEqual(self.cache.purge(), 1)
+        self.assertEqual(self.cache.keys(), [])
+
+    def test_read_without_write_lock(self):
+        """ A lookup doesn't wait for another process writing to the
+        cache, its access time and counters are written afterwards """
+        self.cache.set('key', 'value')
+        cache = LdapCache(self.path, ttl=60, timeout=1)
+        writer = sqlite3.connect(self.path, isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        try:
+            self.assertEqual(cache.get('key'), 'value')
+            self.assertEqual(cache.get('missing'), None)
+        finally:
+            writer.execute('ROLLBACK')
+            writer.close()
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        cache.close()
+
+    def test_cache_from_config(self):
+        self.assertEqual(cache_from_config({}), None)
+        cache = cache_from_config({'cache_path': self.path,
+                                   'cache_ttl': '10',
+                                   'cache_max_entries': '5'})
+        self.assertEqual(cache.ttl, 10)
+        self.assertEqual(cache.max_entries, 5)
@@ -0,0 +1,71 @@
+from envcoord.mailexpander.dedupe import DeliveredSet
+from envcoord.mailexpander.dedupe import delivered_set_from_config
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class DeliveredSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.delivered = DeliveredSet(
+            os.path.join(self.tmp_dir, 'var', 'delivered.sqlite'), window=60)
+
+    def tearDown(self):
+        self.delivered.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_claim(self):
+        delivered = self.delivered
+        self.assertEqual(delivered.claim(
+            '<1@example.com>', 'top@roles',
+            ['One@example.com', 'two@example.com']), [])
+        self.assertEqual(delivered.claim(
+            '<1@example.com>', 'top-sub@roles',
+            ['one@example.com', 'three@example.com']), ['one@example.com'])
+        # The same role again (a retry) keeps its recipients
+        self.assertEqual(delivered.claim('<1@example.com>', 'top@roles',
+                                         ['two@example.com']), [])
+        # Another message
+        self.assertEqual(delivered.claim('<2@example.com>', 'top-sub@roles',
+                                         ['one@example.com']), [])
+        stats = delivered.stats()
+        self.assertEqual((stats['claims'], stats['claimed'],
+                          stats['suppressed'], stats['messages_suppressed']),
+                         (4, 5, 1, 1))
+
+    def test_release(self):
+        delivered = self.delivered
+        delivered.claim('<1@example.com>', 'top@roles',
+                        ['one@example.com', 'two@example.com'])
+        # Only the claims of the role itself
+        self.assertEqual(delivered.release('<1@example.com>', 'top-sub@roles',
+                                           ['one@example.com']), 0)
+        self.assertEqual(delivered.release('<1@example.com>', 'top@roles',
+                                           ['One@example.com']), 1)
+        self.assertEqual(delivered.claim(
+            '<1@example.com>', 'top-sub@roles',
+            ['one@example.com', 'two@example.com']), ['two@example.com'])
+        self.assertEqual(delivered.stats()['released'], 1)
+
+    def test_window(self):
+        delivered = self.delivered
+        delivered.claim('<1@example.com>', 'top@roles', ['one@example.com'])
+        delivered.execute('UPDATE claims SET claimed = ?',
+                          (time.time() - 120,))
+        self.assertEqual(delivered.claim('<1@example.com>', 'top-sub@roles',
+                                         ['one@example.com']), [])
+        delivered.execute('UPDATE claims SET claimed = ?',
+                          (time.time() - 120,))
+        self.assertEqual(delivered.purge(), 1)
+        self.assertEqual(delivered.stats()['claims'], 0)
+
+    def test_from_config(self):
+        self.assertEqual(delivered_set_from_config({}), None)
+        delivered = delivered_set_from_config({
+            'dedupe_path': os.path.join(self.tmp_dir, 'delivered.sqlite'),
+            'dedupe_window': '600'})
+        self.assertEqual(delivered.window, 600)
@@ -0,0 +1,289 @@
+from envcoord.mailexpander.codes import RETURN_CODES
+from envcoord.mailexpander.delivery import LMTPTransport, MaildirTransport
+from envcoord.mailexpander.delivery import SMTPSession, SMTPTransport
+from envcoord.mailexpander.delivery import SendmailTransport
+from envcoord.mailexpander.delivery import transport_from_config
+from envcoord.mailexpander.lmtpd import make_server
+from envcoord.mailexpander.message import SpooledMessage
+from mock import Mock
+import SocketServer
+import mailbox
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import unittest
+
+
+class SMTPHandler(SocketServer.StreamRequestHandler):
+    """ Just enough ESMTP to record what the client sends """
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.wfile.write('220 localhost ESMTP\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.strip()
+            verb = command.split(' ')[0].upper()
+            server.commands.append(command)
+            if verb == 'EHLO':
+                extensions = server.extensions or ['OK']
+                for extension in extensions[:-1]:
+                    self.wfile.write('250-%s\r\n' % extension)
+                self.wfile.write('250 %s\r\n' % extensions[-1])
+            elif verb == 'RCPT' and 'refused' in command:
+                self.wfile.write('550 5.1.1 No such user\r\n')
+            elif verb == 'DATA':
+                self.wfile.write('354 Go ahead\r\n')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if line == '.\r\n':
+                        break
+                    data.append(line)
+                server.messages.append(''.join(data))
+                self.wfile.write('250 2.0.0 Queued\r\n')
+            elif verb == 'QUIT':
+                self.wfile.write('221 Bye\r\n')
+                break
+            elif verb == 'RSET' and server.drop_on_rset:
+                server.drop_on_rset = False
+                break
+            else:
+                self.wfile.write('250 Ok\r\n')
+            self.wfile.flush()
+
+
+class SMTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SMTPServer(('127.0.0.1', 0), SMTPHandler)
+        self.server.connections = 0
+        self.server.commands = []
+        self.server.messages = []
+        self.server.extensions = ['PIPELINING']
+        self.server.drop_on_rset = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.session = SMTPSession(*self.server.server_address)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def verbs(self):
+        return [command.split(' ')[0].upper()
+                for command in self.server.commands]
+
+    def test_one_connection(self):
+        for i in range(3):
+            self.assertEqual(self.session.sendmail(
+                'owner-test@example.com',
+                ['one@example.com', 'two@example.com'], 'Subject: %d\n' % i),
+                {})
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.messages[2], 'Subject: 2\r\n')
+        self.assertEqual(self.verbs(), [
+            'EHLO', 'MAIL', 'RCPT', 'RCPT', 'DATA',
+            'RSET', 'MAIL', 'RCPT', 'RCPT', 'DATA',
+            'RSET', 'MAIL', 'RCPT', 'RCPT', 'DATA'])
+
+    def test_refused_recipients(self):
+        refused = self.session.sendmail(
+            'owner-test@example.com',
+            ['one@example.com', 'refused@example.com'], 'body')
+        self.assertEqual(refused.keys(), ['refused@example.com'])
+        self.assertRaises(smtplib.SMTPRecipientsRefused,
+                          self.session.sendmail, 'owner-test@example.com',
+                          ['refused@example.com'], 'body')
+        # The session is still usable
+        self.session.sendmail('owner-test@example.com', ['one@example.com'],
+                              'body')
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnect(self):
+        """ The server closed the idle connection """
+        self.session.sendmail('owner-test@example.com', ['one@example.com'],
+                              'body')
+        self.server.drop_on_rset = True
+        self.session.sendmail('owner-test@example.com', ['one@example.com'],
+                              'body')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_spooled_message(self):
+        message = SpooledMessage(max_size=10)
+        message.write('Subject: spooled\n\n.dot\n' + 'x' * 100)
+        self.session.sendmail('owner-test@example.com', ['one@example.com'],
+                              message)
+        self.assertEqual(self.server.messages, [
+            'Subject: spooled\r\n\r\n..dot\r\n' + 'x' * 100 + '\r\n'])
+
+    def test_without_pipelining(self):
+        self.server.extensions = []
+        self.session.sendmail('owner-test@example.com', ['one@example.com'],
+                              'body')
+        self.assertEqual(self.verbs(), ['EHLO', 'MAIL', 'RCPT', 'DATA'])
+        self.assertEqual(len(self.server.messages), 1)
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_maildir(self):
+        path = os.path.join(self.tmp_dir, 'Maildir')
+        os.mkdir(path)
+        transport = MaildirTransport(path)
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com', 'two@example.com'],
+                                        'Subject: test\n\nbody\n'),
+                         RETURN_CODES['EX_OK'])
+        [message] = mailbox.Maildir(path, factory=None)
+        self.assertEqual(message['return-path'], '<owner-test@example.com>')
+        self.assertEqual(message['x-envelope-to'],
+                         'one@example.com, two@example.com')
+        self.assertEqual(message.get_payload(), 'body\n')
+
+        stats = transport.stats()
+        self.assertEqual((stats['messages'], stats['recipients'],
+                          stats['errors']), (1, 2, 0))
+        self.assertEqual(stats['bytes'], len('Subject: test\n\nbody\n'))
+        self.assertTrue(stats['recipients_per_second'] > 0)
+
+    def test_sendmail(self):
+        output = os.path.join(self.tmp_dir, 'output')
+        script = os.path.join(self.tmp_dir, 'sendmail')
+        f = open(script, 'w')
+        f.write('#!/bin/sh\necho "$@" > %s\ncat >> %s\n' % (output, output))
+        f.close()
+        os.chmod(script, 0755)
+
+        transport = SendmailTransport(script)
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com'], 'body\n'),
+                         RETURN_CODES['EX_OK'])
+        self.assertEqual(open(output).read(),
+                         '-f <owner-test@example.com> -- <one@example.com>\n'
+                         'body\n')
+
+    def test_sendmail_fallback(self):
+        fallback = Mock()
+        fallback.send.return_value = RETURN_CODES['EX_OK']
+        transport = SendmailTransport(
+            os.path.join(self.tmp_dir, 'missing'), fallback)
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com'], 'body'),
+                         RETURN_CODES['EX_OK'])
+        fallback.send.assert_called_once_with(
+            'owner-test@example.com', ['one@example.com'], 'body')
+
+    def test_smtp_errors(self):
+        transport = SMTPTransport()
+        transport.sessions = Mock()
+        transport.sessions.sendmail.side_effect = smtplib.SMTPSenderRefused(
+            451, 'Try again later', 'owner-test@example.com')
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com'], 'body'),
+                         RETURN_CODES['EX_TEMPFAIL'])
+        transport.sessions.sendmail.side_effect = \
+            smtplib.SMTPRecipientsRefused({})
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com'], 'body'),
+                         RETURN_CODES['EX_PROTOCOL'])
+        transport.sessions.sendmail.side_effect = IOError
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com'], 'body'),
+                         RETURN_CODES['EX_UNAVAILABLE'])
+        self.assertEqual(transport.stats()['errors'], 3)
+
+    def test_smtp_deferred_recipients(self):
+        """ A recipient refused with a 4xx reply defers the whole batch,
+        one refused with a 5xx reply is only logged """
+        transport = SMTPTransport()
+        transport.sessions = Mock()
+        transport.sessions.sendmail.return_value = {
+            'two@example.com': (452, '4.5.3 Too many recipients')}
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com',
+                                         'two@example.com'], 'body'),
+                         RETURN_CODES['EX_TEMPFAIL'])
+        transport.sessions.sendmail.side_effect = \
+            smtplib.SMTPRecipientsRefused({
+                'one@example.com': (550, '5.1.1 No such user'),
+                'two@example.com': (451, '4.3.0 Try again later')})
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com',
+                                         'two@example.com'], 'body'),
+                         RETURN_CODES['EX_TEMPFAIL'])
+        transport.sessions.sendmail.side_effect = None
+        transport.sessions.sendmail.return_value = {
+            'two@example.com': (550, '5.1.1 No such user')}
+        self.assertEqual(transport.send('owner-test@example.com',
+                                        ['one@example.com',
+                                         'two@example.com'], 'body'),
+                         RETURN_CODES['EX_OK'])
+
+    def test_lmtp(self):
+        """ Deliver to the expander's own LMTP server """
+        delivered = []
+
+        def deliver(sender, rcpt, content):
+            delivered.append((sender, rcpt, content.getvalue()))
+            if rcpt.startswith('unknown'):
+                return RETURN_CODES['EX_NOUSER']
+            return RETURN_CODES['EX_OK']
+        pool = Mock()
+        pool.deliver.side_effect = deliver
+        path = os.path.join(self.tmp_dir, 'lmtp.sock')
+        server = make_server(path, pool)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        transport = LMTPTransport(path)
+        try:
+            for i in range(2):
+                self.assertEqual(transport.send(
+                    'owner-test@example.com',
+                    ['one@example.com', 'unknown@example.com'],
+                    'body\n.dot\n'), RETURN_CODES['EX_OK'])
+            self.assertEqual(transport.send(
+                'owner-test@example.com', ['unknown@example.com'], 'body'),
+                RETURN_CODES['EX_PROTOCOL'])
+        finally:
+            transport.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(pool.deliver.call_count, 5)
+        self.assertEqual(delivered[0], ('owner-test@example.com',
+                                        'one@example.com', 'body\n.dot\n'))
+
+    def test_from_config(self):
+        self.assertEqual(transport_from_config({}).name, 'sendmail')
+        self.assertEqual(
+            transport_from_config({'delivery': 'smtp'}).name, 'smtp')
+        self.assertEqual(
+            transport_from_config({'delivery': 'LMTP'}).name, 'lmtp')
+        self.assertEqual(transport_from_config({
+            'delivery': 'maildir',
+            'maildir_path': os.path.join(self.tmp_dir, 'Maildir')}).name,
+            'maildir')
+        self.assertRaises(ValueError, transport_from_config,
+                          {'delivery': 'pigeon'})
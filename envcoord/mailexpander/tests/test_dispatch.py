@@ -0,0 +1,73 @@
+from envcoord.mailexpander.codes import RETURN_CODES
+from envcoord.mailexpander.dispatch import BatchDispatcher
+import threading
+import time
+import unittest
+
+OK = RETURN_CODES['EX_OK']
+
+
+class BatchDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def send(self, batch, delay=0.01, errors={}):
+        with self.lock:
+            self.sent.append(batch)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(delay)
+        with self.lock:
+            self.running -= 1
+        if isinstance(errors.get(batch), Exception):
+            raise errors[batch]
+        return errors.get(batch, OK)
+
+    def test_serial(self):
+        dispatcher = BatchDispatcher()
+        errors = {2: RETURN_CODES['EX_TEMPFAIL']}
+        self.assertEqual(
+            dispatcher.dispatch(lambda b: self.send(b, 0, errors), range(5)),
+            RETURN_CODES['EX_TEMPFAIL'])
+        self.assertEqual(self.sent, [0, 1, 2])
+        self.assertEqual(self.max_running, 1)
+
+    def test_concurrent(self):
+        dispatcher = BatchDispatcher(max_concurrency=4)
+        self.assertEqual(dispatcher.dispatch(self.send, range(40)), OK)
+        self.assertEqual(sorted(self.sent), range(40))
+        self.assertEqual(self.max_running, 4)
+        self.assertEqual(dispatcher.concurrency, 4)
+
+    def test_first_error_in_batch_order(self):
+        dispatcher = BatchDispatcher(max_concurrency=4)
+        dispatcher.limit = 4.0
+        # Batch 3 fails after batch 1 did
+        errors = {1: RETURN_CODES['EX_PROTOCOL'],
+                  3: RETURN_CODES['EX_TEMPFAIL']}
+
+        def send(batch):
+            return self.send(batch, batch == 1 and 0.05 or 0, errors)
+        self.assertEqual(dispatcher.dispatch(send, range(20)),
+                         RETURN_CODES['EX_PROTOCOL'])
+        # Nothing is sent twice or after the failure was seen
+        self.assertEqual(len(self.sent), len(set(self.sent)))
+        self.assertTrue(len(self.sent) < 20)
+        self.assertTrue(dispatcher.concurrency < 4)
+
+    def test_exception(self):
+        dispatcher = BatchDispatcher(max_concurrency=3)
+        errors = {2: ValueError('boom')}
+        self.assertRaises(ValueError, dispatcher.dispatch,
+                          lambda b: self.send(b, 0, errors), range(3))
+
+    def test_slow_batches(self):
+        """ Concurrency is halved when batches take too long """
+        dispatcher = BatchDispatcher(max_concurrency=8, latency_target=0.005)
+        dispatcher.limit = 8.0
+        dispatcher.dispatch(self.send, range(3))
+        self.assertEqual(dispatcher.concurrency, 1)
@@ -2,22 +2,49 @@
 # -*- coding: utf-8 -*-
 
 from copy import deepcopy
+from envcoord.mailexpander.cache import LdapCache
+from envcoord.mailexpander.dedupe import DeliveredSet
+from envcoord.mailexpander.dispatch import BatchDispatcher
 from envcoord.mailexpander.expander import Expander, RETURN_CODES, log
+from envcoord.mailexpander.journal import DeliveryJournal
+from envcoord.mailexpander.message import SpooledMessage
 from mock import Mock
 from test_ldap_agent import StubbedLdapAgent
 import email
 import ldap
 import logging
 import os
+import re
+import shutil
 import smtplib
+import tempfile
 import unittest
 
 
 log.setLevel(logging.CRITICAL)
 
 
-def ldap_search(dn, scope, ldap_data, **kwargs):
+def ldap_search(dn, scope, ldap_data, filterstr=None, **kwargs):
     """ Used to return data from different ldap_data sources """
+    if filterstr and filterstr.startswith('(mail='):
+        # Look up users by e-mail (one level below `dn`)
+        mail = filterstr[len('(mail='):-1].lower()
+        found = []
+        for l_dn, l_scope, data in ldap_data:
+            for entry_dn, attrs in data:
+                mails = [m.lower() for m in attrs.get('mail', [])]
+                if entry_dn.endswith(',' + dn) and mail in mails:
+                    found.append((entry_dn, attrs))
+        return found
+    if scope == ldap.SCOPE_SUBTREE:
+        # Roles below `dn`, the agent checks their names itself
+        found = []
+        for l_dn, l_scope, data in ldap_data:
+            for entry_dn, attrs in data:
+                if (entry_dn.endswith(',' + dn) and
+                        'groupOfUniqueNames' in attrs.get('objectClass', [])):
+                    found.append((entry_dn, attrs))
+        return found
     for l_dn, l_scope, data in ldap_data:
         if (l_dn, l_scope) == (dn, scope):
             return data
@@ -218,16 +245,37 @@ class ExpanderTest(unittest.TestCase):
                 }
                 return data[role_dn]
 
+            def _roles_info(self, role_dns):
+                return [self._role_info(role_dn) for role_dn in role_dns]
+
         self.expander.agent = Agent()
         role_data = self.expander.add_inherited_senders(
             'top-middle-end', {'permittedSender': ['control']})
 
+        # Users are only referenced by DN, nobody is queried
         assert set(role_data['permittedSender']) == set(
             ['control',
-             'parent_owner@example.com',
-             'parent_sender@example.com',
-             'member_one@example.com',
-             'root_parent_person@example.com'])
+             'parent_sender@example.com'])
+        assert set(role_data['inheritedSenders']) == set(
+            ['parent_owner', 'member_one'])
+        assert role_data['inheritedPersons'] == ['top_person']
+
+    def test_can_expand_inherited_by_dn(self):
+        """ Senders allowed through a parent role are matched by looking up
+        the sender's DN once, not by fetching every allowed user """
+        role_data = self.agent.get_role('test-ro')
+        self.mock_conn.search_s.reset_mock()
+
+        # user3 is an owner of the parent role `test` (pattern `owners`)
+        self.assertTrue(self.expander.can_expand(
+            'User_Three@example.com', 'test-ro', dict(role_data)))
+        # userone is only a member of `test`, which doesn't inherit
+        self.assertFalse(self.expander.can_expand(
+            'user_one@example.com', 'test-ro', dict(role_data)))
+
+        user_dn = self.agent._user_dn
+        for call in self.mock_conn.search_s.call_args_list:
+            self.assertNotEqual(call[0][0], user_dn('user3'))
 
     def test_send(self):
         """ Test successful sending of the e-mails (7bit, 8bit, base64, binary)
@@ -259,8 +307,7 @@ class ExpanderTest(unittest.TestCase):
                               'list-post', 'return-path', 'x-auth-id',
                               'from', 'cc')  # Checked above or modified
             # Check the rest of the message, make sure they stay the same
-            old_em = email.message_from_string(
-                email.message_from_string(fixture_content).as_string())
+            old_em = email.message_from_string(fixture_content)
 
             for header, value in em.items():
                 if header.lower() not in ignore_headers:
@@ -275,6 +322,45 @@ class ExpanderTest(unittest.TestCase):
                     partition(boundary)[2].partition(boundary)[2]
                 self.assertEquals(old_body, new_body)
 
+    def test_body_bytes_untouched(self):
+        """ Only the header block is rewritten, the body is sent byte for
+        byte as it came """
+        self.expander.can_expand = Mock(return_value=True)
+        for fixture_name in ('content_7bit', 'content_8bit', 'content_base64',
+                             'content_html'):
+            fixture_content = self.fixtures[fixture_name]
+            head, body = re.split(r'\r?\n\r?\n', fixture_content, 1)
+            for content in (fixture_content, SpooledMessage(max_size=1024)):
+                if isinstance(content, SpooledMessage):
+                    content.write(fixture_content)
+                self.expander.expand('user_one@example.com',
+                                     'test@roles.eionet.europa.eu', content)
+                sent = self.expander.send_emails.call_args[0][2]
+                if not isinstance(sent, basestring):
+                    sent = sent.getvalue()
+                new_head, new_body = re.split(r'\r?\n\r?\n', sent, 1)
+                self.assertEqual(new_body, body, fixture_name)
+                self.assertNotEqual(new_head, head)
+
+    def test_send_spooled_message(self):
+        """ A message read into a `SpooledMessage` is sent as one, with the
+        same content as when it is a string """
+        self.expander.can_expand = Mock(return_value=True)
+        for fixture_name, fixture_content in self.fixtures.iteritems():
+            self.expander.expand('user_one@example.com',
+                                 'test@roles.eionet.europa.eu',
+                                 fixture_content)
+            expected = self.expander.send_emails.call_args[0][2]
+
+            message = SpooledMessage(max_size=1024)
+            message.write(fixture_content)
+            self.assertEqual(self.expander.expand(
+                'user_one@example.com', 'test@roles.eionet.europa.eu',
+                message), RETURN_CODES['EX_OK'])
+            sent = self.expander.send_emails.call_args[0][2]
+            self.assertFalse(isinstance(sent, basestring))
+            self.assertEqual(sent.getvalue(), expected)
+
     def test_send_to_owners(self):
         from_email = 'user_one@example.com'
         role_email = 'owner-test@roles.eionet.europa.eu'
@@ -573,6 +659,36 @@ class ExpanderTest(unittest.TestCase):
         # 3 x 1 + 1 * 2 + 118 = 123
         self.assertEqual(total_mails, 123)
 
+    def test_send_batches_concurrently(self):
+        self.expander.dispatcher = BatchDispatcher(max_concurrency=3)
+        batches = [['user%d@example.com' % i] for i in range(10)]
+
+        def send_emails_called(from_email, emails, content):
+            if emails == ['user5@example.com']:
+                return RETURN_CODES['EX_TEMPFAIL']
+            return RETURN_CODES['EX_OK']
+
+        self.expander.send_emails.side_effect = send_emails_called
+        self.assertEqual(self.expander.send_batches(
+            'owner-test@roles.eionet.europa.eu', batches, 'content'),
+            RETURN_CODES['EX_TEMPFAIL'])
+        sent = [call[0][1] for call in
+                self.expander.send_emails.call_args_list]
+        self.assertTrue(['user5@example.com'] in sent)
+        self.assertEqual(len(sent), len(set(map(tuple, sent))))
+
+    def test_throttled_batches_deferred(self):
+        self.expander.throttle = Mock()
+        self.expander.throttle.acquire.side_effect = \
+            lambda emails, deadline: emails != ['user@gov.be']
+        self.assertEqual(self.expander.send_batches(
+            'owner-test@roles.eionet.europa.eu',
+            [['user@example.com'], ['user@gov.be'], ['other@example.com']],
+            'content'), RETURN_CODES['EX_TEMPFAIL'])
+        sent = [call[0][1] for call in
+                self.expander.send_emails.call_args_list]
+        self.assertEqual(sent, [['user@example.com']])
+
     def test_empty_role(self):
         """ Test invalid role scenarios (missing members,
         empty uniqueMember's)
@@ -723,6 +839,201 @@ class ExpanderTest(unittest.TestCase):
         self.assertIsNotNone(also_call,
                              "also_send_to addresses were not sent to")
 
+    def test_recipients_deduplicated(self):
+        """ Every address gets the message once: addresses repeated by
+        members, or already in also_send_to, are skipped """
+        ldap_data = deepcopy(self.ldap_data)
+        for l_dn, l_scope, data in ldap_data:
+            if l_dn == self.agent._user_dn('usertwo'):
+                data[0][1]['mail'] = ['User_One@example.com',
+                                      'user_two@example.com']
+            if l_dn == self.agent._user_dn('user4'):
+                data[0][1]['mail'] = ['archive@example.com']
+
+        def ldap_search_called(dn, scope, **kwargs):
+            return ldap_search(dn, scope, ldap_data, **kwargs)
+
+        self.mock_conn.search_s.side_effect = ldap_search_called
+        self.expander.also_send_to = ['archive@example.com']
+        self.expander.skip_confirmation_email = True
+        self.expander.expand('user_one@example.com',
+                             'test@roles.eionet.europa.eu',
+                             self.fixtures['content_7bit'])
+
+        sent = [call[0][1] for call in
+                self.expander.send_emails.call_args_list]
+        self.assertEqual(sent[0], ['archive@example.com'])
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(sorted(address.lower() for address in sent[1]), [
+            'user_3333@example.com', 'user_one@example.com',
+            'user_three@example.com', 'user_two@example.com'])
+
+    def test_retry_resumes(self):
+        """ A retry sends only to the recipients of the batches that
+        failed, and doesn't archive the message again """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.expander.journal = DeliveryJournal(
+            os.path.join(tmp_dir, 'journal.sqlite'))
+        self.expander.batch_size = 2
+        self.expander.also_send_to = ['archive@example.com']
+        self.expander.skip_confirmation_email = True
+        self.expander.write_to_archive = Mock()
+
+        def send_emails_called(from_email, emails, content):
+            if 'user_two@example.com' in emails:
+                return RETURN_CODES['EX_TEMPFAIL']
+            return RETURN_CODES['EX_OK']
+        self.expander.send_emails.side_effect = send_emails_called
+        self.assertEqual(self.expander.expand(
+            'user_one@example.com', 'test@roles.eionet.europa.eu',
+            self.fixtures['content_7bit']), RETURN_CODES['EX_TEMPFAIL'])
+        first = [call[0][1] for call in
+                 self.expander.send_emails.call_args_list]
+        # also_send_to, then the first batch of members failed
+        self.assertEqual(len(first), 2)
+
+        self.expander.send_emails.reset_mock()
+        self.expander.send_emails.side_effect = None
+        self.assertEqual(self.expander.expand(
+            'user_one@example.com', 'test@roles.eionet.europa.eu',
+            self.fixtures['content_7bit']), RETURN_CODES['EX_OK'])
+        retried = [call[0][1] for call in
+                   self.expander.send_emails.call_args_list]
+        self.assertEqual(retried[0], first[1])
+        self.assertEqual(sorted(sum(retried, [])), [
+            'user_3333@example.com', 'user_four@example.com',
+            'user_one@example.com', 'user_three@example.com',
+            'user_two@example.com'])
+        self.assertEqual(self.expander.write_to_archive.call_count, 1)
+
+        # Without a Message-Id a message can't be recognized
+        self.expander.send_emails.reset_mock()
+        self.expander.expand('user_one@example.com',
+                             'test@roles.eionet.europa.eu',
+                             'Subject: no id\n\nbody\n')
+        self.assertEqual(self.expander.send_emails.call_count, 4)
+
+    def test_archive_spooled(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        mbox = os.path.join(tmp_dir, 'archive.mbox')
+        expander = Expander(self.agent, mailbox=mbox,
+                            archive_spool=os.path.join(tmp_dir, 'spool'))
+        expander.write_to_archive('user_one@example.com', 'Subject: x\n\n')
+        self.assertFalse(os.path.exists(mbox))
+        self.assertEqual(len(expander.archive_spool.pending()), 1)
+        self.assertEqual(expander.archive_spool.flush(), 1)
+        self.assertTrue(open(mbox).read().startswith(
+            'From user_one@example.com  '))
+
+    def test_archive_sharded(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        expander = Expander(self.agent, archive_dir=tmp_dir)
+        expander.write_to_archive('user_one@example.com',
+                                  'Message-Id: <1@x>\n\nbody\n',
+                                  'test@roles.eionet.europa.eu')
+        entries = expander.archive.find('<1@x>', 'test')
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(expander.archive.read(entries[0]).getvalue(),
+                         'Message-Id: <1@x>\n\nbody\n')
+
+    def test_cross_posted_to_subrole(self):
+        """ Members of a role and its subrole get a message sent to both
+        once; also_send_to gets every copy """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.expander.delivered_set = DeliveredSet(
+            os.path.join(tmp_dir, 'delivered.sqlite'))
+        self.expander.can_expand = Mock(return_value=True)
+        self.expander.also_send_to = ['archive@example.com']
+        self.expander.skip_confirmation_email = True
+        for role_email in ('test@roles.eionet.europa.eu',
+                           'test-gb@roles.eionet.europa.eu'):
+            self.assertEqual(self.expander.expand(
+                'user_one@example.com', role_email,
+                self.fixtures['content_7bit']), RETURN_CODES['EX_OK'])
+        sent = [call[0][1] for call in
+                self.expander.send_emails.call_args_list]
+        self.assertEqual(sent[-1], ['archive@example.com'])
+        recipients = sum(sent, [])
+        self.assertEqual(recipients.count('user_three@example.com'), 1)
+        self.assertEqual(recipients.count('archive@example.com'), 2)
+        self.assertEqual(self.expander.delivered_set.stats()['suppressed'], 2)
+
+    def test_failed_role_releases_claims(self):
+        """ Members the first role claimed but could not send to get the
+        message from the subrole """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.expander.delivered_set = DeliveredSet(
+            os.path.join(tmp_dir, 'delivered.sqlite'))
+        self.expander.can_expand = Mock(return_value=True)
+        self.expander.also_send_to = ['archive@example.com']
+        self.expander.skip_confirmation_email = True
+
+        def send(from_email, emails, content):
+            if emails == ['archive@example.com']:
+                return RETURN_CODES['EX_OK']
+            return RETURN_CODES['EX_PROTOCOL']
+        self.expander.send_emails.side_effect = send
+        self.assertEqual(self.expander.expand(
+            'user_one@example.com', 'test@roles.eionet.europa.eu',
+            self.fixtures['content_7bit']), RETURN_CODES['EX_PROTOCOL'])
+        self.assertEqual(self.expander.delivered_set.stats()['claims'], 0)
+
+        self.expander.send_emails.side_effect = None
+        self.expander.send_emails.reset_mock()
+        self.assertEqual(self.expander.expand(
+            'user_one@example.com', 'test-gb@roles.eionet.europa.eu',
+            self.fixtures['content_7bit']), RETURN_CODES['EX_OK'])
+        recipients = sum([call[0][1] for call in
+                          self.expander.send_emails.call_args_list], [])
+        self.assertTrue('user_three@example.com' in recipients)
+        stats = self.expander.delivered_set.stats()
+        self.assertEqual((stats['suppressed'], stats['released']), (0, 5))
+
+    def test_owners_in_one_transaction(self):
+        ldap_data = deepcopy(self.ldap_data)
+        ldap_data[0][2][0][1]['owner'] = [self.agent._user_dn('user3'),
+                                          self.agent._user_dn('user4'),
+                                          self.agent._user_dn('user3')]
+
+        def ldap_search_called(dn, scope, **kwargs):
+            return ldap_search(dn, scope, ldap_data, **kwargs)
+
+        self.mock_conn.search_s.side_effect = ldap_search_called
+        self.expander.expand('user_one@example.com',
+                             'owner-test@roles.eionet.europa.eu',
+                             self.fixtures['content_7bit'])
+        self.assertEqual(self.expander.send_emails.call_count, 1)
+        self.assertEqual(sorted(self.expander.send_emails.call_args[0][1]), [
+            'user_3333@example.com', 'user_four@example.com',
+            'user_three@example.com'])
+
+    def test_role_batch_size(self):
+        expander = Expander(self.agent, batch_size='2',
+                            role_batch_sizes='test=all, other=10')
+        self.assertEqual(expander.recipient_plan('test').batch_size, 0)
+        self.assertEqual(expander.recipient_plan('other').batch_size, 10)
+        self.assertEqual(expander.recipient_plan('test-gb').batch_size, 2)
+        self.assertEqual(Expander(self.agent).batch_size, 50)
+
+    def test_recipient_plan_in_debug_mode(self):
+        """ With -t nothing is sent, the plan is logged instead """
+        self.expander.log_plan = Mock()
+        self.expander.expand('user_one@example.com',
+                             'test@roles.eionet.europa.eu',
+                             self.fixtures['content_7bit'], debug_mode=True)
+        self.assertFalse(self.expander.send_emails.called)
+        role_email, plan = self.expander.log_plan.call_args[0]
+        self.assertEqual(len(plan), 5)
+        lines = plan.describe()
+        self.assertEqual(lines[0], '5 recipients in 1 transactions, '
+                                   '0 duplicates skipped')
+        self.assertTrue(lines[1].startswith('  members #1 (5): '))
+
     def test_can_expand_email_with_equals(self):
         """ Test that from_email with = character is handled correctly.
         Fix for #18085: bounced emails can have encoded addresses like
@@ -871,6 +1182,135 @@ class ExpanderTest(unittest.TestCase):
         self.assertEqual(return_code, RETURN_CODES['EX_OK'])
         self.assertFalse(self.expander.send_emails.called)
 
+    def test_bounce_does_not_connect(self):
+        """ Bounces and delivery-failure notices don't need the directory,
+        the agent must not even bind for them """
+        agent = StubbedLdapAgent(ldap_server='', user_dn='', user_pw='')
+        expander = Expander(agent, bounce_send_to='bounces@example.com')
+        expander.send_emails = Mock(return_value=RETURN_CODES['EX_OK'])
+        for from_email, role_email in [
+                ('mailer-daemon@somewhere.com',
+                 'test+bounce@roles.eionet.europa.eu'),
+                ('', 'owner-test@roles.eionet.europa.eu')]:
+            self.assertEqual(expander.expand(from_email, role_email,
+                                             self.fixtures['content_7bit']),
+                             RETURN_CODES['EX_OK'])
+        self.assertEqual(expander.send_emails.call_count, 2)
+        self.assertFalse(agent.connected)
+
+    def test_bounce_digests(self):
+        """ With bounce_digest_path DSNs are recorded and sent as a digest
+        per role and interval; other notices are still forwarded """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        expander = Expander(self.agent, bounce_send_to='bounces@example.com',
+                            bounce_digest_path=os.path.join(
+                                tmp_dir, 'bounces.sqlite'))
+        expander.send_emails = Mock(return_value=RETURN_CODES['EX_OK'])
+        dsn = (
+            'Subject: Undelivered Mail\n'
+            'Content-Type: multipart/report; report-type=delivery-status;'
+            ' boundary="B"\n\n'
+            '--B\nContent-Type: message/delivery-status\n\n'
+            'Reporting-MTA: dns; mx.example.com\n\n'
+            'Final-Recipient: rfc822; %s\nAction: failed\n'
+            'Status: 5.1.1\n\n--B--\n')
+        for from_email, role_email, recipient in [
+                ('mailer-daemon@mx.example.com',
+                 'test+bounce@roles.eionet.europa.eu', 'one@example.com'),
+                ('', 'owner-test@roles.eionet.europa.eu', 'two@example.com'),
+                ('', 'owner-test@roles.eionet.europa.eu', 'one@example.com')]:
+            self.assertEqual(expander.expand(from_email, role_email,
+                                             dsn % recipient),
+                             RETURN_CODES['EX_OK'])
+        # The first notice sent the digest, the others wait for the next
+        self.assertEqual(expander.send_emails.call_count, 1)
+        self.assertEqual(expander.send_emails.call_args[0][1],
+                         ['bounces@example.com'])
+        self.assertEqual(expander.bounce_store.stats()['pending'], 2)
+
+        expander.expand('mailer-daemon@mx.example.com',
+                        'test+bounce@roles.eionet.europa.eu',
+                        self.fixtures['content_7bit'])
+        self.assertEqual(expander.send_emails.call_count, 2)
+        self.assertEqual(expander.send_emails.call_args[0][2],
+                         self.fixtures['content_7bit'])
+
+    def test_bind_failure_is_temporary(self):
+        """ A failed bind defers the message instead of bouncing it """
+        agent = StubbedLdapAgent(ldap_server='', user_dn='', user_pw='')
+        agent.connect = Mock(return_value=Mock())
+        agent.connect.return_value.simple_bind_s.side_effect = \
+            ldap.INVALID_CREDENTIALS
+        expander = Expander(agent)
+        expander.send_emails = Mock(return_value=RETURN_CODES['EX_OK'])
+        self.assertEqual(expander.expand('user_one@example.com',
+                                         'test@roles.eionet.europa.eu',
+                                         self.fixtures['content_7bit']),
+                         RETURN_CODES['EX_TEMPFAIL'])
+        self.assertFalse(expander.send_emails.called)
+
+    def test_corrupt_cache(self):
+        """ A cache file that is not a database is skipped, the role is
+        looked up in LDAP instead of bouncing the message """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'cache.sqlite')
+        f = open(path, 'wb')
+        f.write('not a database' * 100)
+        f.close()
+        self.agent._cache = LdapCache(path)
+        self.expander.can_expand = Mock(return_value=True)
+        self.assertEqual(self.expander.expand(
+            'user_one@example.com', 'test@roles.eionet.europa.eu',
+            self.fixtures['content_7bit']), RETURN_CODES['EX_OK'])
+        self.assertTrue(self.expander.send_emails.called)
+
+    def test_member_lookup_outage_is_temporary(self):
+        """ Members and owners are fetched after the role: an LDAP outage
+        while resolving them defers the message instead of bouncing it """
+        self.expander.can_expand = Mock(return_value=True)
+        # The bind errors happen here too when the role came from the cache
+        for error in (ldap.SERVER_DOWN, ldap.INVALID_CREDENTIALS,
+                      ldap.CONNECT_ERROR, ldap.TIMEOUT,
+                      ldap.TIMELIMIT_EXCEEDED, ldap.ADMINLIMIT_EXCEEDED):
+            self.agent._query_many = Mock(side_effect=error)
+            for role_email in ('test@roles.eionet.europa.eu',
+                               'owner-test@roles.eionet.europa.eu'):
+                self.assertEqual(self.expander.expand(
+                    'user_one@example.com', role_email,
+                    self.fixtures['content_7bit']),
+                    RETURN_CODES['EX_TEMPFAIL'])
+        self.assertFalse(self.expander.send_emails.called)
+
+    def test_can_expand_outage_is_temporary(self):
+        """ Checking the sender looks up the members and owners as well """
+        for error in (ldap.SERVER_DOWN, ldap.INVALID_CREDENTIALS,
+                      ldap.CONNECT_ERROR, ldap.TIMEOUT):
+            self.agent._query_many = Mock(side_effect=error)
+            self.assertEqual(self.expander.expand(
+                'user_one@example.com', 'test@roles.eionet.europa.eu',
+                self.fixtures['content_7bit']), RETURN_CODES['EX_TEMPFAIL'])
+        self.assertFalse(self.expander.send_emails.called)
+
+    def test_lazy_bind_failure_is_temporary(self):
+        """ With the role in the cache the first bind happens while
+        resolving the members: a failed bind defers the message instead of
+        sending it to nobody """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.agent._cache = LdapCache(os.path.join(tmp_dir, 'cache.sqlite'))
+        self.agent.get_role('test')  # Caches the role, not its members
+        self.agent.disconnect()
+        conn = Mock()
+        conn.simple_bind_s.side_effect = ldap.INVALID_CREDENTIALS
+        self.agent.connect = Mock(return_value=conn)
+        self.expander.can_expand = Mock(return_value=True)
+        self.assertEqual(self.expander.expand(
+            'user_one@example.com', 'test@roles.eionet.europa.eu',
+            self.fixtures['content_7bit']), RETURN_CODES['EX_TEMPFAIL'])
+        self.assertFalse(self.expander.send_emails.called)
+
     def test_subject_tag_uses_role_address_not_full_to(self):
         """ The Subject tag must carry the short list address, never the whole
         incoming To: header. A reply whose To: lists every recipient must not
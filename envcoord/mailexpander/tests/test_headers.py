@@ -0,0 +1,67 @@
+from envcoord.mailexpander.headers import read_headers
+from envcoord.mailexpander.message import SpooledMessage
+import email
+import os
+import re
+import unittest
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class ReadHeadersTest(unittest.TestCase):
+
+    def test_values_like_email(self):
+        """ Every header reads the same as with the email package """
+        for name in os.listdir(FIXTURES):
+            content = open(os.path.join(FIXTURES, name), 'rb').read()
+            headers, offset = read_headers(content)
+            em = email.message_from_string(content)
+            self.assertEqual(headers.items(), em.items())
+            self.assertEqual(content[offset:],
+                             re.split(r'\r?\n\r?\n', content, 1)[1], name)
+            # Unchanged headers are written back as they came, without the
+            # unix From_ line
+            head = content[:offset]
+            if head.startswith('From '):
+                head = head.split('\n', 1)[1]
+            self.assertEqual(headers.as_string(), head)
+
+    def test_rewrite(self):
+        content = ('Subject: hello\nCc: one@example.com,\n\ttwo@example.com\n'
+                   'List-Help: <mailto:help@example.com>\n'
+                   'X-Other: kept\n\nbody\n')
+        headers, offset = read_headers(content)
+        self.assertEqual(headers.get('cc'),
+                         'one@example.com,\n\ttwo@example.com')
+        headers.replace_header('subject', '[role] hello')
+        del headers['list-help']
+        del headers['missing']
+        headers['From'] = 'role@example.com'
+        self.assertRaises(KeyError, headers.replace_header, 'Sender', 'x')
+        self.assertEqual(headers.as_string() + content[offset:],
+                         'Subject: [role] hello\n'
+                         'Cc: one@example.com,\n\ttwo@example.com\n'
+                         'X-Other: kept\nFrom: role@example.com\n\nbody\n')
+
+    def test_crlf(self):
+        content = 'From sender Thu Jan 27\r\nSubject: x\r\n\r\nbody\r\n'
+        headers, offset = read_headers(content)
+        headers['Cc'] = 'one@example.com,\n two@example.com'
+        self.assertEqual(headers.as_string(),
+                         'Subject: x\r\nCc: one@example.com,\r\n'
+                         ' two@example.com\r\n\r\n')
+        self.assertEqual(content[offset:], 'body\r\n')
+
+    def test_no_separator(self):
+        headers, offset = read_headers('Subject: x\nbody line\n')
+        self.assertEqual(offset, len('Subject: x\n'))
+        self.assertEqual(headers.as_string(), 'Subject: x\n\n')
+        headers, offset = read_headers('')
+        self.assertEqual((headers.items(), offset), ([], 0))
+
+    def test_spooled_message(self):
+        message = SpooledMessage(max_size=10)
+        message.write('Subject: spooled\n\n' + 'x' * 100)
+        headers, offset = read_headers(message)
+        self.assertEqual(headers.get('subject'), 'spooled')
+        self.assertEqual(offset, len('Subject: spooled\n\n'))
@@ -0,0 +1,63 @@
+from envcoord.mailexpander.journal import DeliveryJournal
+from envcoord.mailexpander.journal import journal_from_config
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class DeliveryJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal = DeliveryJournal(
+            os.path.join(self.tmp_dir, 'var', 'journal.sqlite'), ttl=60)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_retry(self):
+        journal = self.journal
+        self.assertEqual(journal.start('<1@example.com>', 'test@roles'),
+                         (set(), False))
+        journal.archived('<1@example.com>', 'test@roles')
+        journal.delivered('<1@example.com>', 'test@roles',
+                          ['One@example.com', 'two@example.com'])
+        journal.delivered('<1@example.com>', 'test@roles', ['one@example.com'])
+        # Another role, or another message, starts from scratch
+        self.assertEqual(journal.start('<1@example.com>', 'other@roles'),
+                         (set(), False))
+        self.assertEqual(journal.start('<2@example.com>', 'test@roles'),
+                         (set(), False))
+
+        self.assertEqual(journal.start('<1@example.com>', 'test@roles'),
+                         (set(['one@example.com', 'two@example.com']), True))
+        stats = journal.stats()
+        self.assertEqual((stats['messages'], stats['recipients'],
+                          stats['retries'], stats['skipped']), (3, 2, 1, 2))
+
+    def test_expire(self):
+        journal = self.journal
+        journal.start('<1@example.com>', 'test@roles')
+        journal.delivered('<1@example.com>', 'test@roles', ['a@example.com'])
+        journal.execute('UPDATE messages SET created = ?',
+                        (time.time() - 120,))
+        # Expired entries are removed when the next message starts
+        self.assertEqual(journal.start('<1@example.com>', 'test@roles'),
+                         (set(), False))
+        self.assertEqual(journal.stats()['recipients'], 0)
+
+        journal.execute('UPDATE messages SET created = ?',
+                        (time.time() - 120,))
+        self.assertEqual(journal.purge(), 1)
+        journal.start('<2@example.com>', 'test@roles')
+        self.assertEqual(journal.purge(expired_only=False), 1)
+
+    def test_from_config(self):
+        self.assertEqual(journal_from_config({}), None)
+        journal = journal_from_config({
+            'journal_path': os.path.join(self.tmp_dir, 'journal.sqlite'),
+            'journal_ttl': '3600'})
+        self.assertEqual(journal.ttl, 3600)
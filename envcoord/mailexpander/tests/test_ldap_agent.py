@@ -1,6 +1,10 @@
 from envcoord.mailexpander import ldap_agent
 from mock import Mock   #, patch    #, wraps
 import ldap
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
 
@@ -99,6 +103,7 @@ class LdapAgentTest(unittest.TestCase):
                     'o': ['Testers Club'],
                 }),
             ]),
+            (user_dn('usertwo'), ldap.SCOPE_BASE, []),
         ]
 
         def mock_called(dn, scope):
@@ -111,6 +116,28 @@ class LdapAgentTest(unittest.TestCase):
         assert len(data['members_data']) == 1
         assert data['members_data'].keys() == [user_dn('userone')]
 
+    def test_member_lookup_errors_raised(self):
+        """ Only a member that doesn't exist is left out, any other error
+        of the member searches is raised instead of emptying the role """
+        for options in ({}, {'bulk_lookup': 'true'},
+                        {'pipeline_window': '2'}):
+            agent = StubbedLdapAgent(ldap_server='', user_dn='', user_pw='',
+                                     **options)
+            role_dn = agent._role_dn
+            user_dn = agent._user_dn
+
+            def search_s(dn, scope, **kwargs):
+                if dn == role_dn('A'):
+                    return [(role_dn('A'),
+                             {'uniqueMember': [user_dn('userone')]})]
+                raise ldap.TIMEOUT
+            agent.conn.search_s.side_effect = search_s
+            agent.conn.result3.side_effect = ldap.TIMEOUT
+
+            role_data = agent.get_role('A')
+            self.assertRaises(ldap.TIMEOUT, role_data.__getitem__,
+                              'members_data')
+
     def test_empty_member(self):
         """ When an uniqueMember is empty """
 
@@ -144,3 +171,354 @@ class LdapAgentTest(unittest.TestCase):
         self.assertEquals(len(role_data['members_data']), 1)
         self.assertEquals([user_dn('userone')],
                     role_data['members_data'].keys())
+
+    def test_get_role_bulk_lookup(self):
+        """ With `bulk_lookup` the members are fetched with chunked
+        (uid=...) searches under users_dn instead of one search each """
+        agent = StubbedLdapAgent(ldap_server='', user_dn='', user_pw='',
+                                 bulk_lookup='true', bulk_chunk_size='2')
+        role_dn = agent._role_dn
+        user_dn = agent._user_dn
+        users_dn = agent._user_dn_suffix
+
+        calls_list = [
+            (role_dn('A'), ldap.SCOPE_BASE, [
+                (role_dn('A'), {
+                    'uniqueMember': [user_dn('userone'), user_dn('usertwo'),
+                                     user_dn('user3'), ''],
+                }),
+            ]),
+            (users_dn, ldap.SCOPE_ONELEVEL, [
+                (user_dn('userone'), {'mail': ['user_one@example.com']}),
+                (user_dn('usertwo'), {'mail': ['user_two@example.com']}),
+            ]),
+            # user3 no longer exists in ldap
+            (users_dn, ldap.SCOPE_ONELEVEL, []),
+        ]
+        filters = []
+
+        def mock_called(dn, scope, filterstr=None):
+            filters.append(filterstr)
+            return called_mock(dn, scope, calls_list)
+        agent.conn.search_s.side_effect = mock_called
+
+        role_data = agent.get_role('A')
+        members_data = role_data['members_data']
+        self.assertEqual(filters, [None, '(|(uid=userone)(uid=usertwo))',
+                                   '(|(uid=user3))'])
+        self.assertEqual(members_data, {
+            user_dn('userone'): {'mail': ['user_one@example.com']},
+            user_dn('usertwo'): {'mail': ['user_two@example.com']},
+        })
+        self.assertEqual(role_data['owners_data'], {})
+
+    def test_bulk_lookup_failed_chunk(self):
+        """ The members of a chunk whose search failed are looked up one
+        by one instead of being dropped """
+        agent = StubbedLdapAgent(ldap_server='', user_dn='', user_pw='',
+                                 bulk_lookup='true')
+        user_dn = agent._user_dn
+        entries = {
+            user_dn('userone'): [(user_dn('userone'),
+                                  {'mail': ['user_one@example.com']})],
+        }
+
+        def search_s(dn, scope, **kwargs):
+            if scope == ldap.SCOPE_ONELEVEL:
+                raise ldap.NO_SUCH_OBJECT
+            if dn not in entries:
+                raise ldap.NO_SUCH_OBJECT
+            return entries[dn]
+        agent.conn.search_s.side_effect = search_s
+
+        self.assertEqual(
+            agent._query_many([user_dn('userone'), user_dn('usertwo')]),
+            {user_dn('userone'): {'mail': ['user_one@example.com']}})
+        self.assertEqual(agent.conn.search_s.call_count, 3)
+
+    def test_get_role_attribute_projection(self):
+        """ Only the configured attributes are requested from ldap """
+        agent = StubbedLdapAgent(
+            ldap_server='', user_dn='', user_pw='',
+            member_attrs='mail', owner_attrs='mail, cn',
+            role_attrs='permittedSender,permittedPerson,owner,uniqueMember,l')
+        role_dn = agent._role_dn
+        user_dn = agent._user_dn
+
+        calls_list = [
+            (role_dn('A'), ldap.SCOPE_BASE, [
+                (role_dn('A'), {
+                    'uniqueMember': [user_dn('userone')],
+                    'owner': [user_dn('usertwo')],
+                }),
+            ]),
+            (user_dn('userone'), ldap.SCOPE_BASE, [
+                (user_dn('userone'), {'mail': ['user_one@example.com']}),
+            ]),
+            (user_dn('usertwo'), ldap.SCOPE_BASE, [
+                (user_dn('usertwo'), {'mail': ['user_two@example.com'],
+                                      'cn': ['User two']}),
+            ]),
+        ]
+        attrlists = []
+
+        def mock_called(dn, scope, attrlist=None):
+            attrlists.append(attrlist)
+            return called_mock(dn, scope, calls_list)
+        agent.conn.search_s.side_effect = mock_called
+
+        role_data = agent.get_role('A')
+        role_data['members_data']
+        role_data['owners_data']
+        self.assertEqual(attrlists, [
+            ['permittedSender', 'permittedPerson', 'owner', 'uniqueMember',
+             'l'],
+            ['mail'],
+            ['mail', 'cn'],
+        ])
+        self.assertEqual(role_data['members_data'], {
+            user_dn('userone'): {'mail': ['user_one@example.com']}})
+
+    def test_get_role_cached(self):
+        """ A cache hit doesn't touch ldap, even from a new agent """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = dict(ldap_server='', user_dn='', user_pw='',
+                          cache_path=os.path.join(tmp_dir, 'cache.sqlite'))
+            role_dn = self.agent._role_dn
+            user_dn = self.agent._user_dn
+            calls_list = [
+                (role_dn('A'), ldap.SCOPE_BASE, [
+                    (role_dn('A'), {'uniqueMember': [user_dn('userone')]}),
+                ]),
+                (user_dn('userone'), ldap.SCOPE_BASE, [
+                    (user_dn('userone'), {'mail': ['user_one@example.com']}),
+                ]),
+            ]
+
+            def mock_called(dn, scope):
+                return called_mock(dn, scope, calls_list)
+
+            agent = StubbedLdapAgent(**config)
+            agent.conn.search_s.side_effect = mock_called
+            role_data = agent.get_role('A')
+            role_data['members_data']
+
+            other_agent = StubbedLdapAgent(**config)
+            self.assertEqual(other_agent.get_role('A'), role_data)
+            self.assertFalse(other_agent.conn.search_s.called)
+            self.assertEqual(
+                other_agent.get_role('A')['members_data'],
+                {user_dn('userone'): {'mail': ['user_one@example.com']}})
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_failed_lookup_not_cached(self):
+        """ Members that could not be looked up are not cached as an empty
+        role, the next agent asks LDAP again """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = dict(ldap_server='', user_dn='', user_pw='',
+                          cache_path=os.path.join(tmp_dir, 'cache.sqlite'))
+            role_dn = self.agent._role_dn
+            user_dn = self.agent._user_dn
+            entries = {
+                role_dn('A'): [(role_dn('A'),
+                                {'uniqueMember': [user_dn('userone')]})],
+                user_dn('userone'): [(user_dn('userone'),
+                                      {'mail': ['user_one@example.com']})],
+            }
+
+            def timeout(dn, scope):
+                if dn == role_dn('A'):
+                    return entries[dn]
+                raise ldap.TIMEOUT
+
+            agent = StubbedLdapAgent(**config)
+            agent.conn.search_s.side_effect = timeout
+            self.assertRaises(ldap.TIMEOUT, agent.get_role('A').__getitem__,
+                              'members_data')
+            self.assertEqual(agent._cache.get('members_data:A'), None)
+
+            other_agent = StubbedLdapAgent(**config)
+            other_agent.conn.search_s.side_effect = \
+                lambda dn, scope: entries[dn]
+            self.assertEqual(
+                other_agent.get_role('A')['members_data'],
+                {user_dn('userone'): {'mail': ['user_one@example.com']}})
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_broken_cache_skipped(self):
+        """ Errors of the cache are logged and LDAP is queried instead """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            agent = StubbedLdapAgent(
+                ldap_server='', user_dn='', user_pw='',
+                cache_path=os.path.join(tmp_dir, 'cache.sqlite'))
+            agent._cache.get = Mock(side_effect=sqlite3.OperationalError(
+                'database is locked'))
+            agent._cache.set = Mock(side_effect=OSError(13, 'denied'))
+            role_dn = agent._role_dn
+            agent.conn.search_s.return_value = [
+                (role_dn('A'), {'uniqueMember': []})]
+            self.assertEqual(agent.get_role('A')['uniqueMember'], [])
+            self.assertEqual(agent._roles_info([role_dn('A')]),
+                             [{'uniqueMember': []}])
+            self.assertTrue(agent._cache.set.called)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_lookups_memoized(self):
+        """ Entries fetched by get_role are not queried again while
+        handling the same message """
+        role_dn = self.agent._role_dn
+        user_dn = self.agent._user_dn
+        calls_list = [
+            (role_dn('A'), ldap.SCOPE_BASE, [
+                (role_dn('A'), {'uniqueMember': [user_dn('userone')],
+                                'owner': [user_dn('usertwo')]}),
+            ]),
+            (user_dn('userone'), ldap.SCOPE_BASE, [
+                (user_dn('userone'), {'mail': ['user_one@example.com']}),
+            ]),
+            (user_dn('usertwo'), ldap.SCOPE_BASE, [
+                (user_dn('usertwo'), {'mail': ['user_two@example.com']}),
+            ]),
+        ]
+
+        def mock_called(dn, scope):
+            return called_mock(dn, scope, calls_list)
+        self.mock_conn.search_s.side_effect = mock_called
+
+        role_data = self.agent.get_role('A')
+        role_data['members_data']
+        role_data['owners_data']
+        self.assertEqual(self.agent._query(user_dn('usertwo')),
+                         {'mail': ['user_two@example.com']})
+        self.assertEqual(self.agent._query(user_dn('UserOne')),
+                         {'mail': ['user_one@example.com']})
+        self.assertEqual(self.agent.lookup_stats, {'queries': 3, 'saved': 2})
+
+        self.agent.reset_lookups()
+        self.assertEqual(self.agent.lookup_stats, {'queries': 0, 'saved': 0})
+        self.assertRaises(IndexError, self.agent._query, user_dn('userone'))
+
+    def test_pipelined_lookups(self):
+        """ With a `pipeline_window` the member searches are sent with the
+        asynchronous API and several of them are outstanding at once """
+        agent = StubbedLdapAgent(ldap_server='', user_dn='', user_pw='',
+                                 pipeline_window='2')
+        role_dn = agent._role_dn
+        user_dn = agent._user_dn
+        agent.conn.search_s.return_value = [
+            (role_dn('A'), {'uniqueMember': [user_dn('userone'),
+                                             user_dn('usertwo'),
+                                             user_dn('user3')]})]
+
+        entries = {
+            user_dn('userone'): {'mail': ['user_one@example.com']},
+            user_dn('user3'): {'mail': ['user_three@example.com']},
+        }
+        sent = []
+        events = []
+
+        def search_ext(base, scope, filterstr, attrlist):
+            sent.append(base)
+            events.append('send')
+            return len(sent)
+
+        def result3(msgid, all=1):
+            events.append('result')
+            dn = sent[msgid - 1]
+            if dn not in entries:
+                raise ldap.NO_SUCH_OBJECT
+            return (ldap.RES_SEARCH_RESULT, [(dn, entries[dn])], msgid, [])
+
+        agent.conn.search_ext.side_effect = search_ext
+        agent.conn.result3.side_effect = result3
+
+        role_data = agent.get_role('A')
+        self.assertEqual(role_data['members_data'], entries)
+        self.assertEqual(events, ['send', 'send', 'result', 'send',
+                                  'result', 'result'])
+        self.assertEqual(agent.lookup_stats['queries'], 4)
+
+    def test_get_role_lazy(self):
+        """ Members and owners are only fetched when they are used """
+        role_dn = self.agent._role_dn
+        user_dn = self.agent._user_dn
+        calls_list = [
+            (role_dn('A'), ldap.SCOPE_BASE, [
+                (role_dn('A'), {'uniqueMember': [user_dn('userone')],
+                                'owner': [user_dn('usertwo')],
+                                'l': ['deactivated:True']}),
+            ]),
+            (user_dn('usertwo'), ldap.SCOPE_BASE, [
+                (user_dn('usertwo'), {'mail': ['user_two@example.com']}),
+            ]),
+        ]
+
+        def mock_called(dn, scope):
+            return called_mock(dn, scope, calls_list)
+        self.mock_conn.search_s.side_effect = mock_called
+
+        role_data = self.agent.get_role('A')
+        self.assertTrue('members_data' in role_data)
+        self.assertEqual(role_data['l'], ['deactivated:True'])
+        self.assertEqual(self.mock_conn.search_s.call_count, 1)
+
+        self.assertEqual(role_data['owners_data'], {
+            user_dn('usertwo'): {'mail': ['user_two@example.com']}})
+        self.assertEqual(self.mock_conn.search_s.call_count, 2)
+        self.assertFalse(role_data.is_resolved('members_data'))
+
+    def test_subrole_members(self):
+        """ Members of the filtered subroles are found with one search """
+        role_dn = self.agent._role_dn
+        user_dn = self.agent._user_dn
+        self.mock_conn.search_s.return_value = [
+            (role_dn('A-gb'), {'uniqueMember': [user_dn('userone'), '']}),
+            (role_dn('A-gb-x'), {'uniqueMember': [user_dn('usertwo')]}),
+            (role_dn('A-ro'), {'uniqueMember': [user_dn('user3')]}),
+        ]
+        members = self.agent.subrole_members('A', '-gb')
+        self.assertEqual(members, set([
+            self.agent._normalize_dn(user_dn('userone')),
+            self.agent._normalize_dn(user_dn('usertwo'))]))
+        self.assertEqual(self.mock_conn.search_s.call_count, 1)
+        self.assertEqual(self.mock_conn.search_s.call_args[0],
+                         (role_dn('A'), ldap.SCOPE_SUBTREE))
+
+    def test_subrole_members_memberof(self):
+        """ In memberof mode the members' memberOf values are used """
+        agent = StubbedLdapAgent(ldap_server='', user_dn='', user_pw='',
+                                 filter_mode='memberOf', member_attrs='mail')
+        self.assertEqual(agent._member_attrs, ['mail', 'memberOf'])
+        role_dn = agent._role_dn
+        user_dn = agent._user_dn
+        members_data = {
+            user_dn('userone'): {'memberOf': [role_dn('A'),
+                                              role_dn('A-gb')]},
+            user_dn('usertwo'): {'memberOf': [role_dn('A'),
+                                              role_dn('B-gb')]},
+            user_dn('user3'): {},
+        }
+        self.assertEqual(agent.subrole_members('A', '-gb', members_data),
+                         set([agent._normalize_dn(user_dn('userone'))]))
+        self.assertFalse(agent.conn.search_s.called)
+
+    def test_connect_lazily(self):
+        """ The agent binds on its first query, not when it is created """
+        agent = StubbedLdapAgent(ldap_server='', user_dn=' bind_dn ',
+                                 user_pw='secret ')
+        self.assertFalse(agent.connected)
+        conn = agent.conn
+        self.assertTrue(agent.connected)
+        conn.simple_bind_s.assert_called_once_with('bind_dn', 'secret')
+        self.assertTrue(agent.conn is conn)
+
+        agent.disconnect()
+        self.assertFalse(agent.connected)
+        conn.unbind_s.assert_called_once_with()
+        self.assertFalse(agent.conn is conn)
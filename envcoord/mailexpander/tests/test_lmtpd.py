@@ -0,0 +1,92 @@
+from envcoord.mailexpander.expander import RETURN_CODES
+from envcoord.mailexpander.lmtpd import ExpanderPool, make_server, reply_for
+from mock import Mock
+import os
+import shutil
+import smtplib
+import tempfile
+import test_expander
+import threading
+import unittest
+
+
+class LMTPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        # The expander with the fake directory of the expander tests
+        fixture = test_expander.ExpanderTest('test_send')
+        fixture.setUp()
+        self.expander = fixture.expander
+        self.expander.skip_confirmation_email = True
+        self.content = fixture.fixtures['content_7bit']
+        # The message is closed once delivered, keep what was sent
+        self.sent = []
+        send_emails = self.expander.send_emails
+
+        def record(from_email, emails, content, *args, **kwargs):
+            self.sent.append(content if isinstance(content, str)
+                             else content.getvalue())
+            return send_emails(from_email, emails, content, *args, **kwargs)
+        self.expander.send_emails = Mock(side_effect=record)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'lmtp.sock')
+        self.server = make_server(self.path,
+                                  ExpanderPool(lambda: self.expander, 1))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.client = smtplib.LMTP(self.path)
+        self.client.ehlo_or_helo_if_needed()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reply_per_recipient(self):
+        """ Each recipient gets the reply of its own expansion """
+        client = self.client
+        self.assertEqual(client.mail('user_one@example.com')[0], 250)
+        self.assertEqual(client.rcpt('test@roles.eionet.europa.eu')[0], 250)
+        self.assertEqual(client.rcpt('test1@roles.eionet.europa.eu')[0], 250)
+        self.assertEqual(client.data(self.content)[0], 250)
+        self.assertEqual(client.getreply(), (550, '5.1.1 User unknown'))
+
+        self.assertEqual(self.expander.send_emails.call_args[0][0],
+                         'owner-test@roles.eionet.europa.eu')
+        self.assertEqual(sorted(self.expander.send_emails.call_args[0][1]),
+                         ['user_3333@example.com', 'user_four@example.com',
+                          'user_one@example.com', 'user_three@example.com',
+                          'user_two@example.com'])
+        self.assertFalse('\r\n\r\n' in self.sent[0])
+
+    def test_temporary_failure(self):
+        self.expander.expand = Mock(
+            return_value=RETURN_CODES['EX_TEMPFAIL'])
+        self.expander.agent.disconnect = Mock()
+        self.client.mail('user_one@example.com')
+        self.client.rcpt('test@roles.eionet.europa.eu')
+        self.assertEqual(self.client.data(self.content),
+                         (451, '4.3.0 Temporary failure'))
+        self.assertTrue(self.expander.agent.disconnect.called)
+
+    def test_session(self):
+        """ Commands out of order are refused, RSET starts over """
+        client = self.client
+        self.assertEqual(client.rcpt('test@roles.eionet.europa.eu')[0], 503)
+        self.assertEqual(client.mail('')[0], 250)
+        self.assertEqual(client.mail('')[0], 503)
+        self.assertEqual(client.docmd('DATA')[0], 503)
+        self.assertEqual(client.rset()[0], 250)
+        self.assertEqual(client.noop()[0], 250)
+        self.assertEqual(client.docmd('HELO', 'localhost')[0], 500)
+        self.assertEqual(client.quit()[0], 221)
+
+    def test_reply_for(self):
+        self.assertEqual(reply_for(RETURN_CODES['EX_OK']), '250 2.0.0 Ok')
+        self.assertEqual(reply_for(RETURN_CODES['EX_NOPERM'])[:3], '550')
+        self.assertEqual(reply_for(RETURN_CODES['EX_OSERR'])[:3], '451')
+        self.assertEqual(reply_for(1)[:3], '451')
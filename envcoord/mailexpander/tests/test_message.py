@@ -0,0 +1,68 @@
+from StringIO import StringIO
+from envcoord.mailexpander.message import FileMessage, SpooledMessage
+from envcoord.mailexpander.message import message_chunks, message_lines
+from envcoord.mailexpander.message import splice
+import os
+import tempfile
+import unittest
+
+
+class SpooledMessageTest(unittest.TestCase):
+
+    def test_from_file(self):
+        content = 'Subject: big\n\n' + 'x' * 200 + '\n.dot\nlast'
+        message = SpooledMessage.from_file(StringIO(content), max_size=100)
+        self.assertEqual(len(message), len(content))
+        self.assertFalse(message.in_memory)
+        self.assertEqual(message.getvalue(), content)
+        self.assertEqual(list(message.lines()),
+                         list(message_lines(content)))
+        self.assertEqual(''.join(message.chunks(7)), content)
+
+        small = SpooledMessage.from_file(StringIO('Subject: small\n\n'))
+        self.assertTrue(small.in_memory)
+
+    def test_readers(self):
+        """ Every reader has its own position """
+        message = SpooledMessage()
+        message.write('one\ntwo\n')
+        first, second = message.open(), message.open()
+        self.assertEqual(first.readline(), 'one\n')
+        self.assertEqual(second.read(2), 'on')
+        self.assertEqual(first.read(), 'two\n')
+        self.assertEqual(list(second), ['e\n', 'two\n'])
+
+    def test_splice(self):
+        message = SpooledMessage(max_size=10)
+        message.write('Subject: old\n\nbody\n' + 'x' * 100)
+        spliced = splice('Subject: new\nFrom: role\n\n', message,
+                         len('Subject: old\n\n'))
+        expected = 'Subject: new\nFrom: role\n\nbody\n' + 'x' * 100
+        self.assertEqual(len(spliced), len(expected))
+        self.assertEqual(spliced.getvalue(), expected)
+        self.assertEqual(''.join(spliced.chunks(5)), expected)
+        self.assertEqual(list(spliced.lines()), list(message_lines(expected)))
+        self.assertEqual(splice('Subject: new\n\n', 'Subject: old\n\nbody',
+                                len('Subject: old\n\n')),
+                         'Subject: new\n\nbody')
+
+    def test_file_message(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        os.write(fd, 'envelope\none\ntwo\nnext')
+        os.close(fd)
+        message = FileMessage(path, len('envelope\n'))
+        self.assertEqual(message.getvalue(), 'one\ntwo\nnext')
+        part = FileMessage(path, len('envelope\n'), len('one\ntwo\n'))
+        self.assertEqual(len(part), 8)
+        self.assertEqual(list(part.lines()), ['one\n', 'two\n'])
+        self.assertEqual(''.join(part.chunks(3)), 'one\ntwo\n')
+        part.close()
+        message.close()
+
+    def test_strings(self):
+        self.assertEqual(list(message_chunks('abc')), ['abc'])
+        self.assertEqual(list(message_chunks('')), [])
+        self.assertEqual(list(message_lines('a\nb')), ['a\n', 'b'])
+        self.assertEqual(list(message_lines('a\r\nb\rc\n')),
+                         ['a\r\n', 'b\rc\n'])
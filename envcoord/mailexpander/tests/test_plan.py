@@ -0,0 +1,69 @@
+from envcoord.mailexpander.plan import ARGV_OVERHEAD, RecipientPlan
+from envcoord.mailexpander.plan import parse_batch_size
+import unittest
+
+
+class RecipientPlanTest(unittest.TestCase):
+
+    def test_deduplicated(self):
+        plan = RecipientPlan()
+        self.assertEqual(plan.add('also_send_to', ['', 'Archive@example.com']),
+                         1)
+        self.assertEqual(plan.add('members', [
+            'one@example.com', ' archive@EXAMPLE.com', 'One@example.com']), 1)
+        self.assertEqual(plan.addresses(), ['Archive@example.com',
+                                            'one@example.com'])
+        self.assertEqual(plan.duplicates, 2)
+        self.assertEqual(len(plan), 2)
+
+    def test_remove(self):
+        plan = RecipientPlan(batch_size=2)
+        plan.add('also_send_to', ['archive@example.com'])
+        plan.add('members', ['one@example.com', 'Two@example.com',
+                             'three@example.com'])
+        self.assertEqual(plan.remove(['archive@example.com',
+                                      'two@example.com', 'gone@example.com']),
+                         2)
+        self.assertEqual(plan.batches('also_send_to'), [])
+        self.assertEqual(plan.batches('members'),
+                         [['one@example.com', 'three@example.com']])
+        self.assertEqual(len(plan), 2)
+        self.assertTrue(plan.describe()[0].endswith(', 2 already delivered'))
+        # Still not added again
+        self.assertEqual(plan.add('members', ['two@example.com']), 0)
+
+    def test_grouped_by_domain(self):
+        plan = RecipientPlan(batch_size=3)
+        plan.add('members', ['a@gov.be', 'b@example.com', 'c@mail.gov.be',
+                             'd@example.com', 'e@gov.be', 'f@example.org'])
+        self.assertEqual(plan.batches('members'), [
+            ['a@gov.be', 'e@gov.be', 'c@mail.gov.be'],
+            ['b@example.com', 'd@example.com', 'f@example.org']])
+
+        plan.group_by_domain = False
+        self.assertEqual(plan.batches('members')[0],
+                         ['a@gov.be', 'b@example.com', 'c@mail.gov.be'])
+
+    def test_batch_size(self):
+        addresses = ['user%d@example.com' % i for i in range(120)]
+        plan = RecipientPlan(batch_size=50)
+        plan.add('members', addresses)
+        self.assertEqual(map(len, plan.batches('members')), [50, 50, 20])
+        plan.batch_size = parse_batch_size('all')
+        self.assertEqual(map(len, plan.batches('members')), [120])
+        self.assertEqual(plan.batches('owners'), [])
+
+    def test_argv_limit(self):
+        """ Batches are split before they get too long for a command line """
+        addresses = ['user%03d@example.com' % i for i in range(100)]
+        cost = len(addresses[0]) + ARGV_OVERHEAD
+        plan = RecipientPlan(batch_size=0, max_batch_bytes=cost * 30 + 1)
+        plan.add('members', addresses)
+        batches = plan.batches('members')
+        self.assertEqual(map(len, batches), [30, 30, 30, 10])
+        self.assertEqual(sum(batches, []), addresses)
+
+    def test_parse_batch_size(self):
+        self.assertEqual(parse_batch_size(' 200 '), 200)
+        self.assertEqual(parse_batch_size('ALL'), 0)
+        self.assertEqual(parse_batch_size(50), 50)
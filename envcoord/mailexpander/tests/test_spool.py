@@ -0,0 +1,91 @@
+from envcoord.mailexpander.expander import RETURN_CODES
+from envcoord.mailexpander.spool import Spool
+from mock import Mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spool = Spool(os.path.join(self.tmp_dir, 'spool'),
+                           retry_delay=60, max_retry_delay=300)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def listdir(self, subdir):
+        return os.listdir(os.path.join(self.spool.path, subdir))
+
+    def test_put_and_deliver(self):
+        name = self.spool.put('sender@example.com',
+                              'test@roles.eionet.europa.eu', 'Subject: x\n')
+        self.assertEqual(self.listdir('tmp'), [])
+        self.assertEqual(self.spool.pending(), [name])
+
+        delivered = []
+
+        def deliver(from_email, role_email, content):
+            delivered.append((from_email, role_email, content.getvalue()))
+            return RETURN_CODES['EX_OK']
+        self.assertEqual(self.spool.run_once(deliver), 1)
+        self.assertEqual(delivered, [('sender@example.com',
+                                      'test@roles.eionet.europa.eu',
+                                      'Subject: x\n')])
+        self.assertEqual(type(delivered[0][0]), str)
+        for subdir in ('new', 'cur', 'failed'):
+            self.assertEqual(self.listdir(subdir), [])
+
+    def test_claimed_once(self):
+        name = self.spool.put('sender@example.com', 'test@example.com', '')
+        self.assertTrue(self.spool.claim(name) is not None)
+        self.assertTrue(self.spool.claim(name) is None)
+        self.assertEqual(self.spool.pending(), [])
+
+    def test_retry_with_backoff(self):
+        self.spool.put('sender@example.com', 'test@example.com', 'body')
+        deliver = Mock(return_value=RETURN_CODES['EX_TEMPFAIL'])
+        self.assertEqual(self.spool.run_once(deliver), 1)
+        # Deferred, not tried again right away
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(self.spool.run_once(deliver), 0)
+
+        now = time.time()
+        self.assertEqual(self.spool.pending(now + 59), [])
+        [name] = self.spool.pending(now + 61)
+        envelope, content = self.spool.claim(name)
+        self.assertEqual(envelope['attempts'], 1)
+        self.assertEqual(content.getvalue(), 'body')
+
+        # The delay doubles up to max_retry_delay
+        self.spool.retry(name, envelope, content)
+        self.assertEqual(self.spool.pending(now + 119), [])
+        [name] = self.spool.pending(now + 121)
+        envelope, content = self.spool.claim(name)
+        envelope['attempts'] = 10
+        self.spool.retry(name, envelope, content)
+        self.assertEqual(self.spool.pending(now + 299), [])
+        self.assertEqual(len(self.spool.pending(now + 301)), 1)
+
+    def test_give_up(self):
+        """ Permanent errors and messages too old to retry go to failed/ """
+        self.spool.put('sender@example.com', 'nobody@example.com', '')
+        self.spool.run_once(Mock(return_value=RETURN_CODES['EX_NOUSER']))
+        self.assertEqual(len(self.listdir('failed')), 1)
+
+        self.spool.max_age = 0
+        self.spool.put('sender@example.com', 'test@example.com', '')
+        time.sleep(0.01)
+        self.spool.run_once(Mock(side_effect=ValueError))
+        self.assertEqual(len(self.listdir('failed')), 2)
+        self.assertEqual(self.listdir('new'), [])
+
+    def test_recover(self):
+        name = self.spool.put('sender@example.com', 'test@example.com', '')
+        self.spool.claim(name)
+        self.assertEqual(self.spool.recover(), 1)
+        self.assertEqual(self.spool.pending(), [name])
@@ -0,0 +1,105 @@
+from envcoord.mailexpander.throttle import DomainThrottle, parse_rates
+from envcoord.mailexpander.throttle import throttle_from_config
+from mock import patch
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class DomainThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'var', 'throttle.json')
+        self.now = 1000.0
+        self.slept = []
+        time_patch = patch('envcoord.mailexpander.throttle.time')
+        clock = time_patch.start()
+        self.addCleanup(time_patch.stop)
+        clock.time.side_effect = lambda: self.now
+        clock.sleep.side_effect = self.sleep
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def throttle(self, **kwargs):
+        return DomainThrottle(self.path, parse_rates('gov.be=10/60, '
+                                                     'example.com=2/1'),
+                              **kwargs)
+
+    def test_parse_rates(self):
+        self.assertEqual(parse_rates(' gov.be=100/60, Example.COM=2/1,'),
+                         {'gov.be': (100, 60), 'example.com': (2, 1)})
+        self.assertEqual(parse_rates(''), {})
+
+    def test_domain_of(self):
+        throttle = self.throttle()
+        self.assertEqual(throttle.domain_of('a@gov.be'), 'gov.be')
+        self.assertEqual(throttle.domain_of('a@Health.FGOV.gov.be'), 'gov.be')
+        self.assertEqual(throttle.domain_of('a@fgov.be'), None)
+
+    def test_pace(self):
+        throttle = self.throttle()
+        batch = ['user%d@gov.be' % i for i in range(5)] + ['x@elsewhere.org']
+        self.assertTrue(throttle.acquire(batch))
+        self.assertTrue(throttle.acquire(batch))
+        self.assertEqual(self.slept, [])
+        # The bucket is empty, 5 tokens take 30 seconds to come back
+        self.assertTrue(throttle.acquire(batch))
+        self.assertEqual(self.slept, [30])
+        self.assertEqual(throttle.stats(), {'gov.be': {
+            'recipients': 15, 'throttled': 1, 'waited': 30}})
+        # Unlimited domains never wait
+        self.assertTrue(throttle.acquire(['x@elsewhere.org'] * 100))
+        self.assertEqual(len(self.slept), 1)
+
+    def test_shared_between_processes(self):
+        self.assertTrue(self.throttle().acquire(['a@gov.be'] * 10))
+        throttle = self.throttle(mode='defer')
+        self.assertFalse(throttle.acquire(['b@gov.be']))
+        self.assertEqual(self.slept, [])
+        self.assertEqual(throttle.stats()['gov.be']['deferred'], 1)
+        self.now += 6
+        self.assertTrue(throttle.acquire(['b@gov.be']))
+
+    def test_max_wait(self):
+        throttle = self.throttle(max_wait=20)
+        self.assertTrue(throttle.acquire(['a@gov.be'] * 10))
+        self.assertFalse(throttle.acquire(['a@gov.be'] * 5))
+        self.assertEqual(self.slept, [])
+
+    def test_deadline_per_message(self):
+        """ max_wait bounds the pacing of all the batches of a message """
+        throttle = self.throttle(max_wait=40)
+        deadline = throttle.deadline()
+        self.assertTrue(throttle.acquire(['a@gov.be'] * 10, deadline))
+        self.assertTrue(throttle.acquire(['a@gov.be'] * 5, deadline))
+        self.assertEqual(self.slept, [30])
+        # 30 more seconds would end after the deadline
+        self.assertFalse(throttle.acquire(['a@gov.be'] * 5, deadline))
+        self.assertTrue(throttle.acquire(['a@gov.be'] * 5))
+        self.assertEqual(self.slept, [30, 30])
+
+    def test_batch_bigger_than_burst(self):
+        throttle = self.throttle()
+        self.assertTrue(throttle.acquire(['a@example.com'] * 5))
+        # The bucket is in debt for the 3 extra recipients
+        self.assertTrue(throttle.acquire(['a@example.com']))
+        self.assertEqual(self.slept, [2])
+
+    def test_from_config(self):
+        self.assertEqual(throttle_from_config({}), None)
+        throttle = throttle_from_config({'throttle_rates': 'gov.be=1/1',
+                                         'throttle_state': self.path,
+                                         'throttle_mode': 'Defer'})
+        self.assertEqual((throttle.mode, throttle.max_wait), ('defer', 60))
+
+    def test_corrupt_state(self):
+        os.makedirs(os.path.dirname(self.path))
+        open(self.path, 'w').write('{"buck')
+        self.assertTrue(self.throttle().acquire(['a@gov.be']))
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+""" Per-domain rate limits on the outbound mail.
+
+Sending the batches of a large role at once to a few domains gets us
+throttled (and our queue deferred) by their servers. `DomainThrottle` keeps
+a token bucket for every rate limited domain in a small JSON state file,
+locked with `fcntl`, so all the expander processes share the budget.
+
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+__version__ = """$Id$"""
+
+log = logging.getLogger('rolesexpander')
+
+
+def parse_rates(value):
+    """ `gov.be=100/60, example.com=20/1` -> {domain: (count, seconds)} """
+    rates = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        domain, rate = item.split('=', 1)
+        count, seconds = rate.split('/', 1)
+        rates[domain.strip().lower()] = (float(count), float(seconds))
+    return rates
+
+
+class DomainThrottle(object):
+    """ Allows `count` recipients every `seconds` for each domain of
+    `rates` (and its subdomains), in bursts of up to `count`.
+
+    A batch over the budget of one of its domains is paced: `acquire` waits
+    for the tokens, up to the `deadline` shared by all the batches of a
+    message (`max_wait` seconds after it started sending). With `mode:
+    defer`, or when that is not enough, it gives up and the message is
+    deferred.
+
+    """
+
+    def __init__(self, path, rates, mode='pace', max_wait=60):
+        self.path = path
+        self.rates = rates
+        self.mode = mode
+        self.max_wait = float(max_wait)
+        self._lock = threading.Lock()  # lockf only locks between processes
+
+    def domain_of(self, address):
+        """ The rate limited domain `address` belongs to, or None """
+        domain = address.rpartition('@')[2].strip().lower()
+        while domain:
+            if domain in self.rates:
+                return domain
+            domain = domain.partition('.')[2]
+        return None
+
+    @contextmanager
+    def _state(self):
+        """ The locked state: {'buckets': {domain: [tokens, time]},
+        'counters': {domain: {name: value}}} """
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            f = open(self.path, 'a+')
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    log.warning("Resetting the corrupt throttle state %s",
+                                self.path)
+                    state = {}
+                state.setdefault('buckets', {})
+                state.setdefault('counters', {})
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                f.close()  # Releases the lock
+
+    def _count(self, state, domain, name, increment=1):
+        counters = state['counters'].setdefault(domain, {})
+        counters[name] = counters.get(name, 0) + increment
+
+    def _take(self, needs):
+        """ Take the tokens for `needs` ({domain: recipients}) if all the
+        buckets have enough. Returns 0, or how long to wait for them. """
+        now = time.time()
+        with self._state() as state:
+            wait = 0
+            buckets = {}
+            for domain, needed in needs.items():
+                count, seconds = self.rates[domain]
+                tokens, last = state['buckets'].get(domain, (count, now))
+                tokens = min(count, tokens + (now - last) * count / seconds)
+                buckets[domain] = tokens
+                # A batch bigger than the burst waits for a full bucket and
+                # leaves it in debt
+                needed = min(needed, count)
+                if tokens < needed:
+                    wait = max(wait, (needed - tokens) * seconds / count)
+            if not wait:
+                for domain, needed in needs.items():
+                    buckets[domain] -= needed
+                    self._count(state, domain, 'recipients', needed)
+            for domain, tokens in buckets.items():
+                state['buckets'][domain] = (tokens, now)
+        return wait
+
+    def _record(self, needs, name, increment=1):
+        with self._state() as state:
+            for domain in needs:
+                self._count(state, domain, name, increment)
+
+    def deadline(self):
+        """ Until when the batches of a message starting now may wait """
+        return time.time() + self.max_wait
+
+    def acquire(self, emails, deadline=None):
+        """ Wait until `emails` may be sent, at most until `deadline` (by
+        default `max_wait` seconds). Returns False when the batch must be
+        deferred. """
+        needs = {}
+        for email in emails:
+            domain = self.domain_of(email)
+            if domain is not None:
+                needs[domain] = needs.get(domain, 0) + 1
+        if not needs:
+            return True
+        if deadline is None:
+            deadline = self.deadline()
+
+        waited = 0.0
+        while True:
+            wait = self._take(needs)
+            if not wait:
+                if waited:
+                    self._record(needs, 'waited', waited)
+                return True
+            if self.mode == 'defer' or time.time() + wait > deadline:
+                log.warning("Deferring %d recipients over the rate limit of "
+                            "%s", len(emails), ', '.join(sorted(needs)))
+                self._record(needs, 'deferred')
+                return False
+            if not waited:
+                log.info("Pacing %d recipients of %s for %.1fs", len(emails),
+                         ', '.join(sorted(needs)), wait)
+                self._record(needs, 'throttled')
+            time.sleep(wait)
+            waited += wait
+
+    def stats(self):
+        """ {domain: counters}: the recipients sent, how many batches were
+        throttled (paced) or deferred and the seconds waited """
+        with self._state() as state:
+            return state['counters']
+
+    def reset(self):
+        with self._state() as state:
+            state['buckets'].clear()
+            state['counters'].clear()
+
+
+def throttle_from_config(config):
+    """ Build the throttle from the `throttle_*` options of [expander].
+    Returns None when no `throttle_rates` are configured. """
+    rates = parse_rates(config.get('throttle_rates', ''))
+    if not rates:
+        return None
+    return DomainThrottle(
+        config.get('throttle_state',
+                   '/var/local/envcoord.mailexpander/var/throttle.json'),
+        rates, config.get('throttle_mode', 'pace').strip().lower(),
+        config.get('throttle_max_wait', 60))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+""" Compare the compiled `SenderACL` with the linear permittedSender walk
+that `Expander.can_expand` used to do on every message.
+
+    bin/python misc/bench_acl.py [members] [patterns]
+
+"""
+from envcoord.mailexpander.acl import SenderACL
+from fnmatch import fnmatch
+import sys
+import timeit
+
+USERS_DN = 'ou=Users,o=EIONET,l=Europe'
+
+
+class Agent(object):
+    """ In-memory stand-in for LdapAgent: users are found by e-mail through
+    an index, like the directory does """
+
+    def __init__(self, members_data):
+        self.by_mail = {}
+        for dn, attrs in members_data.items():
+            for mail in attrs['mail']:
+                self.by_mail.setdefault(mail.lower(), {})[dn.lower()] = \
+                    [m.lower() for m in attrs['mail']]
+
+    def _normalize_dn(self, dn):
+        return dn.lower()
+
+    def _is_user_dn(self, dn):
+        return dn.endswith(',' + USERS_DN)
+
+    def users_with_email(self, email):
+        return self.by_mail.get(email, {})
+
+    def _query_many(self, dns, attrlist=None):
+        return {}
+
+
+def legacy_can_expand(from_email, role_data):
+    """ The permittedSender loop of can_expand before SenderACL """
+    if 'anyone' in role_data['permittedSender']:
+        return True
+    for sender_pattern in role_data['permittedSender']:
+        sender_pattern = sender_pattern.lower()
+        if sender_pattern == 'members':
+            for user_dn, user_attrs in role_data['members_data'].iteritems():
+                if from_email in map(str.lower, user_attrs['mail']):
+                    return True
+        elif fnmatch(from_email, sender_pattern):
+            return True
+    return False
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    patterns = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    members_data = {}
+    for i in range(members):
+        members_data['uid=user%d,%s' % (i, USERS_DN)] = {
+            'mail': ['User.%d@Example.com' % i, 'alias%d@example.org' % i]}
+    permitted = ['sender%d@example.net' % i for i in range(patterns)]
+    permitted += ['*@domain%d.eu' % i for i in range(patterns)]
+    permitted.append('members')
+    role_data = {'permittedSender': permitted,
+                 'uniqueMember': members_data.keys(),
+                 'members_data': members_data}
+
+    agent = Agent(members_data)
+    acl = SenderACL.from_role(role_data, agent)
+
+    cases = [
+        ('literal', 'sender%d@example.net' % (patterns - 1)),
+        ('glob', 'someone@domain%d.eu' % (patterns - 1)),
+        ('member', 'alias%d@example.org' % (members - 1)),
+        ('rejected', 'nobody@example.com'),
+    ]
+    print("%d members, %d addresses, %d patterns" % (
+        members, patterns, patterns))
+    print("%-10s %14s %14s" % ('case', 'legacy (ms)', 'SenderACL (ms)'))
+    for name, email in cases:
+        assert legacy_can_expand(email, role_data) == \
+            acl.allows(email, agent), name
+        number = 20
+        legacy = timeit.Timer(
+            lambda: legacy_can_expand(email, role_data)).timeit(number)
+        compiled = timeit.Timer(
+            lambda: acl.allows(email, agent)).timeit(number)
+        print("%-10s %14.3f %14.3f" % (name, legacy * 1000 / number,
+                                       compiled * 1000 / number))
+
+
+if __name__ == '__main__':
+    main()
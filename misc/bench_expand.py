@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+""" Time `Expander.expand` end to end: an in-memory directory stands in for
+LDAP and the messages are delivered to a maildir, so no MTA is needed.
+
+    bin/python misc/bench_expand.py [members] [messages] [max_concurrency]
+
+"""
+from envcoord.mailexpander.expander import Expander, RETURN_CODES
+from envcoord.mailexpander.ldap_agent import LdapAgent
+import ldap
+import shutil
+import sys
+import tempfile
+import time
+
+
+class Connection(object):
+    """ Answers base searches from a dictionary of entries """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def simple_bind_s(self, user_dn, user_pw):
+        pass
+
+    def search_s(self, base, scope, filterstr=None, attrlist=None):
+        if scope == ldap.SCOPE_BASE and base in self.entries:
+            return [(base, self.entries[base])]
+        return []
+
+
+class Agent(LdapAgent):
+
+    def __init__(self, entries, **config):
+        self.entries = entries
+        super(Agent, self).__init__(**config)
+
+    def connect(self):
+        return Connection(self.entries)
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    max_concurrency = sys.argv[3] if len(sys.argv) > 3 else '1'
+
+    config = {'ldap_server': 'ldap://localhost', 'user_dn': '',
+              'user_pw': ''}
+    probe = LdapAgent(**config)
+    entries = {}
+    member_dns = []
+    for i in range(members):
+        dn = probe._user_dn('user%d' % i)
+        entries[dn] = {'mail': ['user.%d@example.com' % i]}
+        member_dns.append(dn)
+    entries[probe._role_dn('bench')] = {
+        'objectClass': ['groupOfUniqueNames'],
+        'uniqueMember': member_dns,
+        'permittedSender': ['anyone'],
+    }
+
+    maildir = tempfile.mkdtemp()
+    try:
+        expander = Expander(Agent(entries, **config), delivery='maildir',
+                            maildir_path=maildir,
+                            max_concurrency=max_concurrency,
+                            skip_confirmation_email='true')
+        content = ('From: sender@example.com\nSubject: bench\n\n' +
+                   'x' * 2000 + '\n')
+        start = time.time()
+        for i in range(messages):
+            assert expander.expand('sender@example.com',
+                                   'bench@roles.eionet.europa.eu',
+                                   content) == RETURN_CODES['EX_OK']
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(maildir)
+
+    stats = expander.transport.stats()
+    print("%d members, %d messages, max_concurrency %s" % (
+        members, messages, max_concurrency))
+    print("expand: %.1f ms per message" % (elapsed * 1000 / messages))
+    print("delivery: %(messages)d transactions, %(recipients)d recipients, "
+          "%(recipients_per_second).0f recipients/s" % stats)
+
+
+if __name__ == '__main__':
+    main()